@@ -58,11 +58,14 @@ DROP FUNCTION stoq_create_language_plpgsql();
 -- Enable unaccent extension
 CREATE EXTENSION IF NOT EXISTS unaccent;
 
+-- This is used by indexes, so the unaccent dictionary is schema qualified
+-- to make sure the result doesn't depend on the search_path (which is empty
+-- when restoring a dump, for example)
 CREATE OR REPLACE FUNCTION stoq_normalize_string(input_string text) RETURNS text AS $$
 BEGIN
-  return LOWER(public.unaccent(input_string));
+  return LOWER(public.unaccent('public.unaccent'::regdictionary, input_string));
 END;
-$$ LANGUAGE plpgsql IMMUTABLE;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
 
 CREATE OR REPLACE FUNCTION validate_stock_item() RETURNS trigger AS $$
 DECLARE
@@ -0,0 +1,20 @@
+-- Notify the running instances when a parameter changes, so they can
+-- update their cached values. The payload is the parameter name.
+
+CREATE OR REPLACE FUNCTION notify_parameter_data_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('parameter_data', OLD.field_name);
+    ELSE
+        PERFORM pg_notify('parameter_data', NEW.field_name);
+        IF TG_OP = 'UPDATE' AND OLD.field_name <> NEW.field_name THEN
+            PERFORM pg_notify('parameter_data', OLD.field_name);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER parameter_data_changed_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON parameter_data
+    FOR EACH ROW EXECUTE PROCEDURE notify_parameter_data_changed();
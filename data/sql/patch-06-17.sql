@@ -0,0 +1,34 @@
+-- Indexes for the date columns used to filter the searches and reports.
+-- The date filters are compiled to ranges (col >= start AND col < end),
+-- so btree indexes on the columns themselves can be used.
+
+CREATE INDEX IF NOT EXISTS sale_open_date_idx ON sale (open_date);
+CREATE INDEX IF NOT EXISTS sale_confirm_date_idx ON sale (confirm_date);
+CREATE INDEX IF NOT EXISTS sale_close_date_idx ON sale (close_date);
+CREATE INDEX IF NOT EXISTS sale_return_date_idx ON sale (return_date);
+CREATE INDEX IF NOT EXISTS sale_expire_date_idx ON sale (expire_date);
+
+CREATE INDEX IF NOT EXISTS payment_open_date_idx ON payment (open_date);
+CREATE INDEX IF NOT EXISTS payment_due_date_idx ON payment (due_date);
+CREATE INDEX IF NOT EXISTS payment_paid_date_idx ON payment (paid_date);
+CREATE INDEX IF NOT EXISTS payment_cancel_date_idx ON payment (cancel_date);
+
+CREATE INDEX IF NOT EXISTS account_transaction_date_idx
+    ON account_transaction (date);
+CREATE INDEX IF NOT EXISTS fiscal_book_entry_date_idx
+    ON fiscal_book_entry (date);
+CREATE INDEX IF NOT EXISTS stock_transaction_history_date_idx
+    ON stock_transaction_history (date);
+
+CREATE INDEX IF NOT EXISTS purchase_order_open_date_idx
+    ON purchase_order (open_date);
+CREATE INDEX IF NOT EXISTS receiving_order_receival_date_idx
+    ON receiving_order (receival_date);
+CREATE INDEX IF NOT EXISTS returned_sale_return_date_idx
+    ON returned_sale (return_date);
+CREATE INDEX IF NOT EXISTS stock_decrease_confirm_date_idx
+    ON stock_decrease (confirm_date);
+CREATE INDEX IF NOT EXISTS transfer_order_open_date_idx
+    ON transfer_order (open_date);
+CREATE INDEX IF NOT EXISTS till_opening_date_idx ON till (opening_date);
+CREATE INDEX IF NOT EXISTS work_order_open_date_idx ON work_order (open_date);
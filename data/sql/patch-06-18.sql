@@ -0,0 +1,21 @@
+-- Trigram indexes on the normalized text of the columns used by the
+-- search dialogs. The searches compare stoq_normalize_string(column)
+-- using LIKE '%word%', which GIN trigram indexes can be used for.
+
+-- Replaces the gist index from schema-06, gin is faster for lookups
+DROP INDEX IF EXISTS sellable_description_normalized_idx;
+CREATE INDEX sellable_description_normalized_idx ON sellable
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+CREATE INDEX sellable_code_normalized_idx ON sellable
+    USING gin (stoq_normalize_string(code) gin_trgm_ops);
+CREATE INDEX sellable_barcode_normalized_idx ON sellable
+    USING gin (stoq_normalize_string(barcode) gin_trgm_ops);
+CREATE INDEX sellable_category_description_normalized_idx ON sellable_category
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+
+CREATE INDEX person_name_normalized_idx ON person
+    USING gin (stoq_normalize_string(name) gin_trgm_ops);
+CREATE INDEX company_fancy_name_normalized_idx ON company
+    USING gin (stoq_normalize_string(fancy_name) gin_trgm_ops);
+CREATE INDEX product_manufacturer_name_normalized_idx ON product_manufacturer
+    USING gin (stoq_normalize_string(name) gin_trgm_ops);
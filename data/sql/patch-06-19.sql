@@ -0,0 +1,54 @@
+-- Keep the stock quantity and total cost of each storable on each branch,
+-- so that the stock views don't need to aggregate all the
+-- product_stock_item rows (one for each batch) every time.
+
+CREATE TABLE product_stock_summary (
+    id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
+    quantity numeric(20, 3) NOT NULL DEFAULT 0,
+    total_cost numeric NOT NULL DEFAULT 0,
+    storable_id uuid NOT NULL REFERENCES storable(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    branch_id uuid NOT NULL REFERENCES branch(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    UNIQUE (storable_id, branch_id)
+);
+
+INSERT INTO product_stock_summary (storable_id, branch_id, quantity, total_cost)
+    SELECT storable_id, branch_id,
+           COALESCE(SUM(quantity), 0),
+           COALESCE(SUM(quantity * stock_cost), 0)
+        FROM product_stock_item
+        WHERE storable_id IS NOT NULL
+        GROUP BY storable_id, branch_id;
+
+-- product_stock_item is only changed by upsert_stock_item(), when a
+-- stock_transaction_history is inserted, so this keeps the summary in sync
+-- with the stock transactions
+CREATE OR REPLACE FUNCTION update_product_stock_summary() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.storable_id IS NOT NULL THEN
+        UPDATE product_stock_summary SET
+                quantity = quantity - COALESCE(OLD.quantity, 0),
+                total_cost = total_cost - COALESCE(OLD.quantity * OLD.stock_cost, 0)
+            WHERE storable_id = OLD.storable_id AND branch_id = OLD.branch_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.storable_id IS NOT NULL THEN
+        INSERT INTO product_stock_summary
+                (storable_id, branch_id, quantity, total_cost)
+            VALUES
+                (NEW.storable_id, NEW.branch_id, COALESCE(NEW.quantity, 0),
+                 COALESCE(NEW.quantity * NEW.stock_cost, 0))
+            ON CONFLICT (storable_id, branch_id) DO UPDATE SET
+                quantity = product_stock_summary.quantity + EXCLUDED.quantity,
+                total_cost = product_stock_summary.total_cost + EXCLUDED.total_cost;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_product_stock_summary_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON product_stock_item
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_product_stock_summary();
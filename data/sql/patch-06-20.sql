@@ -0,0 +1,10 @@
+-- Keep a hash of the content of each row imported by the importers
+-- running on upsert mode, so that unchanged rows can be skipped when the
+-- same file is imported again.
+
+CREATE TABLE importer_row_hash (
+    importer text NOT NULL,
+    row_key text NOT NULL,
+    content_hash text NOT NULL,
+    PRIMARY KEY (importer, row_key)
+);
@@ -0,0 +1,29 @@
+-- Indexes for the case insensitive lookups done when a barcode is scanned
+-- on the POS, and notifications so the POS can keep an in memory index
+-- of the barcodes, codes and batch numbers up to date.
+-- The payload is the table name and the id of the row, eg sellable:<id>
+
+CREATE INDEX sellable_lower_barcode_idx ON sellable (lower(barcode));
+CREATE INDEX sellable_lower_code_idx ON sellable (lower(code));
+CREATE INDEX storable_batch_lower_batch_number_idx
+    ON storable_batch (lower(batch_number));
+
+CREATE OR REPLACE FUNCTION notify_sellable_lookup_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('sellable_lookup', TG_TABLE_NAME || ':' || OLD.id);
+    ELSE
+        PERFORM pg_notify('sellable_lookup', TG_TABLE_NAME || ':' || NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sellable_lookup_changed_trigger
+    AFTER INSERT OR DELETE OR UPDATE OF barcode, code, status ON sellable
+    FOR EACH ROW EXECUTE PROCEDURE notify_sellable_lookup_changed();
+
+CREATE TRIGGER storable_batch_lookup_changed_trigger
+    AFTER INSERT OR DELETE OR UPDATE OF batch_number, storable_id
+    ON storable_batch
+    FOR EACH ROW EXECUTE PROCEDURE notify_sellable_lookup_changed();
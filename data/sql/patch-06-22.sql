@@ -0,0 +1,10 @@
+-- Keep the last number allocated for each key of a numbering, like the
+-- invoice numbers of each branch, series and mode, so the next one can be
+-- reserved by updating a single row instead of looking for the max value.
+
+CREATE TABLE number_allocation (
+    name text NOT NULL,
+    key text NOT NULL,
+    last_value bigint NOT NULL,
+    PRIMARY KEY (name, key)
+);
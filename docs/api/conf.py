@@ -302,6 +302,8 @@ rst_epilog = """
     :class:`production <stoqlib.domain.production.ProductionOrder>`
 .. |productstockitem| replace::
     :class:`product stock item <stoqlib.domain.product.ProductStockItem>`
+.. |productstocksummary| replace::
+    :class:`product stock summary <stoqlib.domain.product.ProductStockSummary>`
 .. |purchase| replace::
     :class:`purchase <stoqlib.domain.purchase.PurchaseOrder>`
 .. |purchaseitem| replace::
@@ -340,6 +342,8 @@ rst_epilog = """
     :class:`stock decrease <stoqlib.domain.stockdecrease.StockDecrease>`
 .. |stockdecreases| replace::
     :class:`stock decreases <stoqlib.domain.stockdecrease.StockDecrease>`
+.. |stocktransactionqueue| replace::
+    :class:`stock transaction queue <stoqlib.domain.product.StockTransactionQueue>`
 .. |storable| replace::
     :class:`storable <stoqlib.domain.product.Storable>`
 .. |storables| replace::
@@ -29,7 +29,7 @@ import os
 from kiwi.component import get_utility
 from storm.expr import And
 
-from stoqlib.database.expr import Date
+from stoqlib.database.expr import date_range
 from stoqlib.database.runtime import get_current_branch
 from stoqlib.domain.devices import FiscalDayHistory
 from stoqlib.domain.sale import Sale
@@ -96,24 +96,26 @@ class StoqlibCATGenerator(object):
         self.cat.write(fullname)
 
     def _get_z_reductions(self):
-        return self.store.find(FiscalDayHistory,
-                               And(Date(FiscalDayHistory.emission_date) == self.start,
-                                   FiscalDayHistory.serial == self.printer.device_serial))
+        query = And(date_range(FiscalDayHistory.emission_date,
+                               self.start, self.start),
+                    FiscalDayHistory.serial == self.printer.device_serial)
+        return self.store.find(FiscalDayHistory, query)
 
     def _get_sales(self, returned=False):
         # TODO: We need to add station_id to the sales table
-        query = And(Date(Sale.confirm_date) == self.start,
+        query = And(date_range(Sale.confirm_date, self.start, self.start),
                     # Sale.station_id == self.printer.station_id
                     )
         if returned:
-            query = And(Date(Sale.return_date) == self.end, )
+            query = And(date_range(Sale.return_date, self.end, self.end), )
 
         return self.store.find(Sale, query)
 
     def _get_other_documents(self):
-        return self.store.find(ECFDocumentHistory,
-                               And(Date(ECFDocumentHistory.emission_date) == self.start,
-                                   ECFDocumentHistory.printer_id == self.printer.id))
+        query = And(date_range(ECFDocumentHistory.emission_date,
+                               self.start, self.start),
+                    ECFDocumentHistory.printer_id == self.printer.id)
+        return self.store.find(ECFDocumentHistory, query)
 
     def _add_registers(self):
         appinfo = get_utility(IAppInfo)
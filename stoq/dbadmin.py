@@ -427,6 +427,33 @@ class StoqCommandHandler:
 
         return 0 if retval else 1
 
+    def cmd_snapshot(self, options):
+        """Recreate the database and update the schema snapshot"""
+        self._read_config(options, register_station=False,
+                          check_schema=False, load_plugins=False)
+
+        from kiwi.environ import environ
+        from stoqlib.database.admin import create_schema_snapshot
+        filename = create_schema_snapshot(
+            environ.get_resource_filename('stoq', 'sql'))
+        print('Schema snapshot written to %s' % (filename, ))
+        return 0
+
+    def cmd_checksnapshot(self, options):
+        """Recreate the database and check the schema snapshot"""
+        self._read_config(options, register_station=False,
+                          check_schema=False, load_plugins=False)
+
+        from stoqlib.database.admin import check_schema_snapshot
+        diff = check_schema_snapshot()
+        if diff:
+            sys.stdout.writelines(diff)
+            print("Run 'stoqdbadmin snapshot' to update the schema snapshot")
+            return 1
+
+        print('The schema snapshot is up to date')
+        return 0
+
     def cmd_dump(self, options, output):
         """Create a database dump"""
         self._read_config(options)
@@ -527,9 +554,25 @@ class StoqCommandHandler:
     def cmd_import(self, options):
         """Import data into Stoq"""
         self._read_config(options, register_station=False)
+        if options.import_directory:
+            from stoqlib.importers.parallelimporter import ParallelImporter
+            importer = ParallelImporter(options.import_directory,
+                                        workers=options.workers)
+            for stat in importer.process():
+                print('%-20s %8d items %8.2f sec %10.1f items/sec' % (
+                    stat.importer_type, stat.items, stat.seconds,
+                    stat.items / stat.seconds if stat.seconds else 0))
+            return
+
         from stoqlib.importers import importer
         importer = importer.get_by_type(options.type)
         importer.feed_file(options.import_filename)
+        if options.items_per_commit:
+            importer.set_items_per_commit(options.items_per_commit)
+        if options.checkpoint:
+            importer.set_checkpoint_file(options.checkpoint)
+        if options.upsert:
+            importer.set_upsert(True)
         importer.process()
 
     def opt_import(self, parser, group):
@@ -541,6 +584,29 @@ class StoqCommandHandler:
                          action="store",
                          help="Filename to import",
                          dest="import_filename")
+        group.add_option('', '--import-directory',
+                         action="store",
+                         help="Directory with csv files to import in parallel",
+                         dest="import_directory")
+        group.add_option('', '--workers',
+                         action="store",
+                         type="int",
+                         help="Number of processes used to import a directory",
+                         dest="workers")
+        group.add_option('', '--items-per-commit',
+                         action="store",
+                         type="int",
+                         help="Number of items imported before committing",
+                         dest="items_per_commit")
+        group.add_option('', '--upsert',
+                         action="store_true",
+                         help="Update the items changed since the last import "
+                              "instead of creating them again",
+                         dest="upsert")
+        group.add_option('', '--checkpoint',
+                         action="store",
+                         help="File used to resume an interrupted import",
+                         dest="checkpoint")
 
     def cmd_console(self, options):
         """Drop to a Stoq python console"""
@@ -34,7 +34,6 @@ from kiwi.datatypes import converter, ValidationError
 from kiwi.python import Settable
 from kiwi.ui.objectlist import Column
 from kiwi.ui.widgets.contextmenu import ContextMenu, ContextMenuItem
-from storm.expr import And, Lower
 
 from stoqdrivers.enum import UnitType
 from stoqlib.api import api
@@ -42,7 +41,6 @@ from stoqlib.gui.base.dialogs import (get_current_toplevel, add_current_toplevel
                                       _pop_current_toplevel)
 from stoqlib.domain.payment.group import PaymentGroup
 from stoqlib.domain.person import Transporter, Client
-from stoqlib.domain.product import StorableBatch
 from stoqlib.domain.sale import Delivery, Sale, SaleToken
 from stoqlib.domain.sellable import Sellable
 from stoqlib.exceptions import StoqlibError, TaxError
@@ -58,6 +56,8 @@ from stoqlib.lib.formatters import (format_sellable_description,
 from stoqlib.lib.message import warning, info, yesno, marker
 from stoqlib.lib.parameters import sysparam
 from stoqlib.lib.pluginmanager import get_plugin_manager
+from stoqlib.lib.sellableindex import (find_sellable_and_batch,
+                                       get_sellable_index)
 from stoqlib.lib.translation import stoqlib_gettext as _
 from stoqlib.gui.base.dialogs import push_fullscreen, pop_fullscreen
 from stoqlib.gui.dialogs.batchselectiondialog import BatchDecreaseSelectionDialog
@@ -336,6 +336,10 @@ class PosApp(ShellApp):
         self.price.set_visible(self._confirm_quantity)
         self.price.set_editable(sysparam.get_bool('POS_ALLOW_CHANGE_PRICE'))
 
+        # Keep the barcodes in memory, so scanning doesn't need to
+        # query the database
+        get_sellable_index().start()
+
         self.check_open_inventory()
         self._update_parameter_widgets()
         self._update_widgets()
@@ -356,6 +360,7 @@ class PosApp(ShellApp):
         CloseLoanWizardFinishEvent.disconnect(self._on_CloseLoanWizardFinishEvent)
 
         self._printer.disable_midnight_check()
+        get_sellable_index().stop()
 
     def setup_focus(self):
         if sysparam.get_bool('USE_SALE_TOKEN') and self._token is None:
@@ -627,31 +632,9 @@ class PosApp(ShellApp):
             text = barinfo.code
             weight = barinfo.weight
 
-        batch = None
-        query = Sellable.status == Sellable.STATUS_AVAILABLE
-
-        # FIXME: Put this logic for getting the sellable based on
-        # barcode/code/batch_number on domain. Note that something very
-        # simular is done on abstractwizard.py
-
-        sellable = self.store.find(
-            Sellable, And(query, Lower(Sellable.barcode) == text.lower())).one()
-
-        # If the barcode didnt match, maybe the user typed the product code
-        if not sellable:
-            sellable = self.store.find(
-                Sellable, And(query, Lower(Sellable.code) == text.lower())).one()
-
-        # If none of the above found, try to get the batch number
-        if not sellable:
-            query = Lower(StorableBatch.batch_number) == text.lower()
-            batch = self.store.find(StorableBatch, query).one()
-            if batch:
-                sellable = batch.storable.product.sellable
-                if not sellable.is_available:
-                    # If the sellable is not available, reset both
-                    sellable = None
-                    batch = None
+        # FIXME: Note that something very simular is done on
+        # abstractwizard.py
+        sellable, batch = find_sellable_and_batch(self.store, text)
 
         # The user can't add the parent product of a grid directly to the sale.
         # TODO: Display a dialog to let the user choose an specific grid product.
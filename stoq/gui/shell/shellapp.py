@@ -207,8 +207,11 @@ class ShellApp(GladeDelegate):
         if self.search_spec is None:  # pragma no cover
             raise NotImplementedError
 
-        # Print all the results
-        results = list(self.search.get_last_results())
+        # Print all the results. When they are not all loaded on the
+        # model, let the report fetch them while it is rendered
+        results = self.search.get_last_results()
+        if not isinstance(self.results.get_model(), LazyObjectModel):
+            results = list(results)
         self.print_report(self.report_table, self.results, results)
 
     def export_spreadsheet_activate(self):
@@ -216,12 +219,16 @@ class ShellApp(GladeDelegate):
         if self.search_spec is None:  # pragma no cover
             raise NotImplementedError
 
+        data = None
         model = self.results.get_model()
         if isinstance(model, LazyObjectModel):
-            model.load_items_from_results(0, model._count)
+            # Export straight from the results, so they don't need to be
+            # all loaded on the model
+            data = self.search.get_last_results()
 
         sse = SpreadSheetExporter()
         sse.export(object_list=self.results,
+                   data=data,
                    name=self.app_name,
                    filename_prefix=self.app_name)
 
@@ -99,6 +99,11 @@ class UpdateSchemaStep(BaseWizardStep):
         elif line.startswith('BACKUP-START:'):
             text = _("Creating a database backup")
             longer = _('Creating a database backup in case anything goes wrong.')
+        elif line.startswith('BACKUP-PROGRESS:'):
+            size, speed = line.split(':')[1:3]
+            text = _("Creating a database backup (%d MB at %d MB/s)") % (
+                int(size) // 1024 ** 2, int(speed) // 1024 ** 2)
+            longer = _('Creating a database backup in case anything goes wrong.')
         elif line.startswith('RESTORE-START:'):
             text = _("Restoring database backup")
             longer = _(
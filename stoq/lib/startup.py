@@ -138,6 +138,10 @@ def setup(config=None, options=None, register_station=True, check_schema=True,
 
         set_current_branch_station(default_store, station_name=None)
 
+        # Parameters can be changed by other stations while we are running
+        from stoqlib.lib.parameters import sysparam
+        sysparam.start_listening()
+
     if load_plugins:
         from stoqlib.lib.pluginmanager import get_plugin_manager
         manager = get_plugin_manager()
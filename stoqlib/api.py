@@ -121,6 +121,35 @@ class StoqAPI(object):
             items.insert(0, (empty, None))
         return items
 
+    def for_category_combo(self, categories, empty=None):
+        """
+        This is similar to :py:func:`~stoqlib.api.StoqAPI.for_combo` but
+        takes :py:class:`~stoqlib.domain.sellable.SellableCategory` objects,
+        using their full description. The full descriptions of all
+        categories are fetched with a single query.
+
+        :param categories: a resultset or a sequence of categories
+        :param empty: if set, add an initial None item with this parameter as
+          a label
+
+        Example::
+
+          categories = self.store.find(SellableCategory)
+          self.category_combo.prefill(api.for_category_combo(categories))
+        """
+        from stoqlib.domain.sellable import SellableCategory
+        categories = list(categories)
+        descriptions = {}
+        if categories:
+            descriptions = SellableCategory.get_full_descriptions(
+                categories[0].store)
+
+        items = [(descriptions[c.id], c) for c in categories]
+        items = locale_sorted(items, key=operator.itemgetter(0))
+        if empty is not None:
+            items.insert(0, (empty, None))
+        return items
+
     def for_person_combo(self, resultset):
         """
         This is similar to :py:func:`~stoqlib.api.StoqAPI.for_combo` but
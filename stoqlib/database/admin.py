@@ -28,6 +28,7 @@ Helper functions related to administration of the database, creating
 tables, removing tables and configuring administration user.
 """
 
+import difflib
 import glob
 import logging
 import os
@@ -43,7 +44,8 @@ from stoqdrivers.constants import describe_constant
 from stoqlib.database.expr import TransactionTimestamp
 from stoqlib.database.interfaces import ICurrentBranch, ICurrentUser
 from stoqlib.database.migration import StoqlibSchemaMigration
-from stoqlib.database.runtime import get_default_store, new_store
+from stoqlib.database.runtime import (get_default_store, new_store,
+                                      set_default_store)
 from stoqlib.database.settings import db_settings
 from stoqlib.domain.person import (Branch, Company, Employee, EmployeeRole,
                                    Individual, LoginUser, Person, SalesPerson)
@@ -307,6 +309,42 @@ def _get_latest_schema():
     return schemas[-1]
 
 
+def _get_snapshots(directory):
+    return sorted(glob.glob(os.path.join(directory, "snapshot-??-??.sql")))
+
+
+def _get_latest_snapshot():
+    snapshots = _get_snapshots(environ.get_resource_filename('stoq', 'sql'))
+    if not snapshots:
+        return None
+    return snapshots[-1]
+
+
+def _get_snapshot_version(filename):
+    # "snapshot-06-21.sql" -> (6, 21), the version of its last patch
+    base = os.path.basename(filename).split('.')[0]
+    return tuple(int(part) for part in base.split('-')[1:])
+
+
+def _get_schema_dump():
+    with tempfile.NamedTemporaryFile(prefix='stoqschema-', delete=False) as tmp_f:
+        pass
+    try:
+        if not db_settings.dump_database(tmp_f.name, schema_only=True,
+                                         format='plain', no_owner=True):
+            error(u'Failed to dump the database schema')
+        with open(tmp_f.name, encoding='utf-8') as f:
+            return f.readlines()
+    finally:
+        os.unlink(tmp_f.name)
+
+
+def _recreate_database():
+    # The default store is connected to the database we are dropping
+    set_default_store(None)
+    db_settings.clean_database(db_settings.dbname, force=True)
+
+
 def create_database_functions():
     """Create some functions we define on the database
 
@@ -321,21 +359,105 @@ def create_database_functions():
             error(u'Failed to create functions')
 
 
-def create_base_schema():
+def create_base_schema(use_snapshot=True):
+    """Creates the database schema, up to the latest patch
+
+    If there is a schema snapshot in data/sql, it is loaded in one step
+    and only the patches newer than it are applied. Otherwise the base
+    schema is created and all the patches are applied, one by one.
+
+    :param use_snapshot: if the schema snapshot should be used
+    """
     log.info('Creating base schema')
     create_log.info("SCHEMA")
 
-    create_database_functions()
-
-    # A Base schema shared between all RDBMS implementations
-    schema = _get_latest_schema()
-    if db_settings.execute_sql(schema) != 0:
-        error(u'Failed to create base schema')
+    snapshot = use_snapshot and _get_latest_snapshot()
+    if snapshot:
+        log.info('Loading schema snapshot %s' % (snapshot, ))
+        if db_settings.execute_sql(snapshot) != 0:
+            error(u'Failed to load the schema snapshot')
+        # The functions depend on the database server version, replace
+        # the ones from the server where the snapshot was generated
+        create_database_functions()
+    else:
+        create_database_functions()
+
+        # A Base schema shared between all RDBMS implementations
+        schema = _get_latest_schema()
+        if db_settings.execute_sql(schema) != 0:
+            error(u'Failed to create base schema')
 
     migration = StoqlibSchemaMigration()
     migration.apply_all_patches()
 
 
+def create_schema_snapshot(directory):
+    """Creates a schema snapshot at the latest patch
+
+    This recreates the current database by applying all the patches and
+    dumps its schema and data, which is loaded by :func:`create_base_schema`
+    to create new databases. The older snapshots in *directory* are
+    removed.
+
+    :param directory: where to write the snapshot, usually data/sql
+    :returns: the filename of the snapshot
+    """
+    _recreate_database()
+    create_base_schema(use_snapshot=False)
+    migration = StoqlibSchemaMigration()
+    filename = os.path.join(directory, 'snapshot-%02d-%02d.sql' % (
+        migration.get_current_version()))
+
+    with tempfile.NamedTemporaryFile(prefix='stoqsnapshot-', delete=False) as tmp_f:
+        pass
+    try:
+        if not db_settings.dump_database(tmp_f.name, format='plain',
+                                         no_owner=True):
+            error(u'Failed to dump the database')
+        with open(tmp_f.name, encoding='utf-8') as src, \
+                open(filename, 'w', encoding='utf-8') as dst:
+            dst.write("-- Generated by 'stoqdbadmin snapshot', do not edit\n")
+            for line in src:
+                # Only the owner of an extension can comment on it
+                if line.startswith('COMMENT ON EXTENSION'):
+                    continue
+                dst.write(line)
+    finally:
+        os.unlink(tmp_f.name)
+
+    for snapshot in _get_snapshots(directory):
+        if snapshot != filename:
+            os.unlink(snapshot)
+    return filename
+
+
+def check_schema_snapshot():
+    """Checks that the schema snapshot is up to date
+
+    This recreates the current database twice, by applying all the patches
+    and by loading the snapshot, and compares their schemas.
+
+    :returns: a list of lines describing the differences, in the unified
+      diff format, or an empty list if the snapshot is up to date
+    """
+    snapshot = _get_latest_snapshot()
+    if snapshot is None:
+        return [u'There is no schema snapshot\n']
+
+    _recreate_database()
+    create_base_schema(use_snapshot=False)
+    version = StoqlibSchemaMigration().get_current_version()
+    if _get_snapshot_version(snapshot) != version:
+        return [u'The schema snapshot %s is older than the latest patch '
+                u'(%d.%d)\n' % ((os.path.basename(snapshot), ) + version)]
+    expected = _get_schema_dump()
+
+    _recreate_database()
+    create_base_schema()
+    return list(difflib.unified_diff(expected, _get_schema_dump(),
+                                     'patches', os.path.basename(snapshot)))
+
+
 def create_default_profiles():
     store = new_store()
 
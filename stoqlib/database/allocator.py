@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+##
+
+"""Allocate sequential numbers, like invoice numbers and identifiers
+
+The last number allocated for each key is kept on the ``number_allocation``
+table, so reserving the next ones is a single update of a row, which is
+also what serializes concurrent reservations of the same key.
+"""
+
+from stoqlib.database.runtime import new_store
+
+_UPDATE_QUERY = """
+    UPDATE number_allocation SET last_value = last_value + ?
+     WHERE name = ? AND key = ?
+    RETURNING last_value"""
+
+# Another transaction may have inserted the row after our update
+_INSERT_QUERY = """
+    INSERT INTO number_allocation (name, key, last_value) VALUES (?, ?, ?)
+    ON CONFLICT (name, key) DO UPDATE
+        SET last_value = number_allocation.last_value + ?
+    RETURNING last_value"""
+
+_PEEK_QUERY = """
+    SELECT last_value FROM number_allocation WHERE name = ? AND key = ?"""
+
+_SET_LAST_QUERY = """
+    INSERT INTO number_allocation (name, key, last_value) VALUES (?, ?, ?)
+    ON CONFLICT (name, key) DO UPDATE SET last_value = EXCLUDED.last_value"""
+
+
+class NumberAllocator(object):
+    """Allocates the numbers of a numbering, like the invoice numbers
+
+    Each *key* of the numbering, eg the branch of the invoice, has its
+    own numbers. How the reservation behaves on concurrent transactions
+    depends on the *policy*:
+
+    * :attr:`.GAPLESS`: the numbers are reserved on the given store, so
+      they are released if it is rolled back. Other transactions
+      reserving numbers for the same key will wait until it is committed
+      or rolled back.
+    * :attr:`.GAPS_ALLOWED`: the numbers are reserved and committed on a
+      separate store, so other transactions never wait, but they are lost
+      if the given store is rolled back.
+
+    :param name: the name of the numbering
+    :param policy: :attr:`.GAPLESS` or :attr:`.GAPS_ALLOWED`
+    :param step: the difference between two consecutive numbers, use a
+      negative one to allocate decreasing numbers
+    """
+
+    #: No numbers are skipped, for documents that need to be numbered
+    #: sequentially, like invoices
+    GAPLESS = u'gapless'
+
+    #: Numbers may be skipped, for numbers that only need to be unique
+    GAPS_ALLOWED = u'gaps-allowed'
+
+    def __init__(self, name, policy=GAPS_ALLOWED, step=1):
+        assert policy in [self.GAPLESS, self.GAPS_ALLOWED]
+        assert step != 0
+        self.name = name
+        self.policy = policy
+        self.step = step
+
+    #
+    #  Public API
+    #
+
+    def reserve(self, store, key, count=1, initial=None):
+        """Reserves the next numbers of a key
+
+        This can be used to reserve a block of numbers for a station that
+        will work offline.
+
+        :param store: a store
+        :param key: the key of the numbering
+        :param count: how many numbers to reserve
+        :param initial: a callable receiving a store and returning the last
+          number used, called only the first time a number of *key* is
+          reserved. If not given, the numbers will start at *step*
+        :returns: a list with the reserved numbers, in order
+        """
+        assert count > 0
+        if self.policy == self.GAPLESS:
+            return self._reserve(store, key, count, initial)
+
+        with new_store() as allocation_store:
+            return self._reserve(allocation_store, key, count, initial)
+
+    def get_next(self, store, key, initial=None):
+        """Reserves the next number of a key
+
+        :param store: a store
+        :param key: the key of the numbering
+        :param initial: see :meth:`.reserve`
+        :returns: the reserved number
+        """
+        return self.reserve(store, key, initial=initial)[0]
+
+    def peek(self, store, key, initial=None):
+        """Gets the next number of a key, without reserving it
+
+        Useful to show the number that will probably be used, but another
+        transaction may reserve it first.
+
+        :param store: a store
+        :param key: the key of the numbering
+        :param initial: see :meth:`.reserve`
+        :returns: the next number
+        """
+        row = store.execute(_PEEK_QUERY, (self.name, key)).get_one()
+        if row is not None:
+            last = row[0]
+        else:
+            last = initial(store) if initial is not None else 0
+        return last + self.step
+
+    def set_last(self, store, key, value):
+        """Sets the last number used of a key
+
+        The numbers reserved after this will continue from *value*, which
+        is useful when numbers were used without being reserved.
+
+        :param store: a store
+        :param key: the key of the numbering
+        :param value: the last number used
+        """
+        if self.policy == self.GAPLESS:
+            self._set_last(store, key, value)
+            return
+
+        with new_store() as allocation_store:
+            self._set_last(allocation_store, key, value)
+
+    #
+    #  Private
+    #
+
+    def _reserve(self, store, key, count, initial):
+        increment = self.step * count
+        row = store.execute(_UPDATE_QUERY,
+                            (increment, self.name, key)).get_one()
+        if row is None:
+            start = initial(store) if initial is not None else 0
+            row = store.execute(_INSERT_QUERY,
+                                (self.name, key, start + increment,
+                                 increment)).get_one()
+
+        last = row[0]
+        return list(range(last - increment + self.step, last + self.step,
+                          self.step))
+
+    def _set_last(self, store, key, value):
+        store.execute(_SET_LAST_QUERY, (self.name, key, value),
+                      noresult=True)
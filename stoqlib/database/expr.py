@@ -28,7 +28,9 @@ This contains a list of expressions that are unsupported by Storm.
 Most of them are specific to PostgreSQL
 """
 
-from storm.expr import (Expr, NamedFunc, PrefixExpr, SuffixExpr, SQL, ComparableExpr,
+import datetime
+
+from storm.expr import (And, Expr, NamedFunc, PrefixExpr, SuffixExpr, SQL, ComparableExpr,
                         compile as expr_compile, FromExpr, Undef, EXPR, is_safe_token,
                         BinaryOper, SetExpr)
 
@@ -216,9 +218,10 @@ class StoqNormalizeString(NamedFunc):
     it's similar to NLKD normailzation in unicode, but it is run
     inside the database.
 
-    Note, this is very slow and should be avoided.
-    In the future this will be replaced by fulltext search which
-    does normalization in a cheaper way.
+    Note that this is slow when it needs to be computed for every row.
+    Columns that are searched often should have a trigram index
+    on ``stoq_normalize_string(column)``, so that ``LIKE`` comparisons
+    on it can use the index (see patch-06-18).
     """
     # See functions.sql
     __slots__ = ()
@@ -352,6 +355,37 @@ def is_sql_identifier(identifier):
             is_safe_token(identifier))
 
 
+def _get_day_start(value):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return datetime.datetime(value.year, value.month, value.day)
+
+
+def date_range(column, start=None, end=None):
+    """Check if the day of a date/datetime column is between start and end
+
+    This is the same as ``And(Date(column) >= start, Date(column) <= end)``,
+    but it is compiled to a half-open range (``column >= start AND
+    column < end + 1 day``), allowing the database to use an index on
+    *column*. Only the date part of *start* and *end* is used.
+
+    :param column: the column to check
+    :param start: the first day of the range or ``None`` for no lower limit
+    :param end: the last day of the range (inclusive) or ``None``
+        for no upper limit
+    :returns: the query or ``None`` if both *start* and *end* are ``None``
+    """
+    queries = []
+    if start is not None:
+        queries.append(column >= _get_day_start(start))
+    if end is not None:
+        queries.append(column < _get_day_start(end) + datetime.timedelta(days=1))
+
+    if not queries:
+        return None
+    return And(*queries)
+
+
 class Over(ComparableExpr):
     """Check if value is between start and end
 
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Listen to PostgreSQL notifications sent by ``NOTIFY``/``pg_notify()``
+
+The notifications are received on a dedicated connection, in a background
+thread, so they can be used to invalidate caches kept by each process
+when another one changes something on the database.
+"""
+
+import collections
+import logging
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from stoqlib.database.settings import db_settings
+
+log = logging.getLogger(__name__)
+
+#: Seconds to wait for notifications before checking if we should stop
+POLL_TIMEOUT = 5
+#: Seconds to wait before trying to connect again after losing the connection
+RECONNECT_TIMEOUT = 10
+
+
+class NotifyListener(threading.Thread):
+    """A thread that listens to notifications on some channels
+
+    The *callback* will be called on the listener thread as
+    ``callback(conn, channel, payloads)``, where *conn* is the
+    listener's connection (that can be used to query the changes),
+    *channel* is the channel name and *payloads* is a set with the
+    payloads of all the notifications received at once on that channel.
+
+    Notifications sent while the connection was lost cannot be recovered,
+    so after reconnecting the callback will be called for each
+    channel with *payloads* being ``None``, meaning that anything
+    could have changed.
+
+    :param channels: a sequence of channel names to listen to
+    :param callback: the callable described above
+    :param dsn: the dsn used to connect to the database, if ``None``,
+        the one from :obj:`stoqlib.database.settings.db_settings` will be used
+    :param notify_on_connect: if the callback should also be called with
+        *payloads* being ``None`` after the first connection. Use it to load
+        the data that will be kept up to date by the notifications, since
+        nothing changed after that will be missed
+    """
+
+    def __init__(self, channels, callback, dsn=None, notify_on_connect=False):
+        super(NotifyListener, self).__init__(name='NotifyListener')
+        self.daemon = True
+
+        self.channels = list(channels)
+        self.callback = callback
+        self.dsn = dsn
+        self.notify_on_connect = notify_on_connect
+        self._stop_event = threading.Event()
+
+    #
+    #  Public API
+    #
+
+    def stop(self):
+        """Stop listening
+
+        The thread will stop in at most :data:`POLL_TIMEOUT` seconds
+        """
+        self._stop_event.set()
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    #
+    #  threading.Thread
+    #
+
+    def run(self):
+        connected_before = self.notify_on_connect
+        while not self.is_stopped():
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                log.warning("Could not connect to listen to notifications: %s", e)
+                self._stop_event.wait(RECONNECT_TIMEOUT)
+                continue
+
+            try:
+                if connected_before:
+                    for channel in self.channels:
+                        self._notify(conn, channel, None)
+                connected_before = True
+                self._listen(conn)
+            except psycopg2.Error as e:
+                log.warning("Lost the connection listening to notifications: %s", e)
+                self._stop_event.wait(RECONNECT_TIMEOUT)
+            finally:
+                conn.close()
+
+    #
+    #  Private
+    #
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn or db_settings.get_store_dsn())
+        # LISTEN only takes effect after commit, and we don't want to
+        # keep a transaction open while waiting for notifications
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        for channel in self.channels:
+            cursor.execute('LISTEN "%s"' % (channel.replace('"', '""'), ))
+        cursor.close()
+        return conn
+
+    def _listen(self, conn):
+        while not self.is_stopped():
+            readable, writable, failed = select.select([conn], [], [],
+                                                       POLL_TIMEOUT)
+            if not readable:
+                continue
+
+            conn.poll()
+            # Group the notifications, so if something was changed lots of
+            # times we will only call the callback once for it
+            payloads = collections.OrderedDict()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                payloads.setdefault(notify.channel, set()).add(notify.payload)
+
+            for channel, channel_payloads in payloads.items():
+                self._notify(conn, channel, channel_payloads)
+
+    def _notify(self, conn, channel, payloads):
+        try:
+            self.callback(conn, channel, payloads)
+        except psycopg2.Error:
+            raise
+        except Exception:
+            log.exception("Error handling notifications on %s", channel)
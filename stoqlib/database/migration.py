@@ -33,12 +33,14 @@ import re
 import shutil
 import sys
 import tempfile
+import time
 import traceback
 
 from kiwi.environ import environ
 
 from stoqlib.database.runtime import get_default_store, new_store
-from stoqlib.database.settings import db_settings, check_extensions
+from stoqlib.database.settings import (db_settings, check_extensions,
+                                       get_dump_size)
 from stoqlib.domain.plugin import InstalledPlugin
 from stoqlib.domain.profile import update_profile_applications
 from stoqlib.exceptions import (DatabaseInconsistency, StoqlibError,
@@ -54,6 +56,13 @@ log = logging.getLogger(__name__)
 # Used by the wizard
 create_log = logging.getLogger('stoqlib.database.create')
 
+# The number of tables dumped and restored in parallel by the backup made
+# before updating. Each one uses a database connection
+_BACKUP_JOBS = min(os.cpu_count() or 1, 4)
+
+# A COMMIT or BEGIN statement on its own line of an SQL patch
+_TRANSACTION_RE = re.compile(r'^\s*(COMMIT|BEGIN)\s*;', re.IGNORECASE)
+
 
 @functools.total_ordering
 class Patch(object):
@@ -90,7 +99,8 @@ class Patch(object):
 
     def apply(self, store):
         """Apply the patch
-        :param store: a store
+        :param store: a store, the patch is applied in its transaction
+          unless :meth:`.requires_psql`
         """
 
         # Dont lock the database here, since StoqlibSchemaMigration.update has
@@ -100,23 +110,40 @@ class Patch(object):
         sql = self._migration.generate_sql_for_patch(self)
 
         if self.filename.endswith('.sql'):
-            # Create a temporary file used for writing SQL statements
-            temporary = tempfile.mktemp(prefix="patch-%d-%d-" % self.get_version())
-
-            # Overwrite the temporary file with the sql patch we want to apply
-            shutil.copy(self.filename, temporary)
-
-            # After successfully executing the SQL statements, we need to
-            # make sure that the system_table is updated with the correct
+            if self.requires_psql():
+                self._apply_with_psql(sql)
+                return
+
+            with open(self.filename, encoding='utf-8') as f:
+                data = f.read()
+            # Rename serial into bigserial, for 64-bit id columns, the same
+            # as DatabaseSettings.execute_sql does
+            data = data.replace('id serial', 'id bigserial')
+
+            # Use a raw cursor, storm would replace the ? on the patch with
+            # parameter marks. After successfully executing the SQL
+            # statements, the system_table is updated with the correct
             # schema generation and patchlevel
-            open(temporary, 'a').write(sql)
-
-            retcode = db_settings.execute_sql(temporary)
-            if retcode != 0:
-                error('Failed to apply %s, psql returned error code: %d' % (
-                    os.path.basename(self.filename), retcode))
-
-            os.unlink(temporary)
+            cursor = store._connection.build_raw_cursor()
+            # Like psql on DatabaseSettings.execute_sql, fail on warnings
+            notices = store._connection._raw_connection.notices
+            del notices[:]
+            try:
+                cursor.execute(data + '\n' + sql)
+            except Exception as e:
+                raise DatabaseError('Failed to apply %s: %s' % (
+                    os.path.basename(self.filename), e)) from e
+            finally:
+                cursor.close()
+            warnings = [n.strip() for n in notices
+                        if n.startswith('WARNING:')]
+            if warnings:
+                raise DatabaseError('Failed to apply %s: %s' % (
+                    os.path.basename(self.filename), '\n'.join(warnings)))
+
+            # The patch changed the database behind storm's back, make
+            # sure the python patches after it don't see stale objects
+            store.invalidate()
         elif self.filename.endswith('.py'):
             # Execute the patch, we cannot use __import__() since there are
             # hyphens in the filename and data/sql lacks an __init__.py
@@ -124,21 +151,62 @@ class Patch(object):
             exec(compile(open(self.filename).read(), self.filename, 'exec'), ns, ns)
             function = ns['apply_patch']
 
-            # Create a new store that will be used to apply the patch and
-            # to update the system tables after the patch has been successfully
-            # applied
-            patch_store = new_store()
-
             # Apply the patch itself
-            function(patch_store)
+            function(store)
 
             # After applying the patch, update the system_table within the same
             # transaction
-            patch_store.execute(sql)
-            patch_store.commit(close=True)
+            store.execute(sql)
         else:
             raise AssertionError("Unknown filename: %s" % (self.filename, ))
 
+    def requires_psql(self):
+        """If the patch needs to be applied by psql
+
+        That is the case for the SQL patches that use psql meta-commands,
+        like \\set or the data of a COPY FROM stdin, and for the ones that
+        commit the transaction by themselves, like the ones that add values
+        to enums with ALTER TYPE. They are applied in a transaction of their
+        own, after the patches before them are committed.
+
+        :returns: ``True`` if the patch requires psql
+        """
+        if not self.filename.endswith('.sql'):
+            return False
+        with open(self.filename, encoding='utf-8') as f:
+            return any(line.startswith('\\') or _TRANSACTION_RE.match(line)
+                       for line in f)
+
+    def is_transactional(self):
+        """If the patch is applied in the transaction of the migration
+
+        That is the case for the SQL patches that don't
+        :meth:`.requires_psql`, which includes the ones that have COMMIT or
+        BEGIN statements. Python patches may commit by themselves.
+
+        :returns: ``True`` if the patch is transactional
+        """
+        return self.filename.endswith('.sql') and not self.requires_psql()
+
+    def _apply_with_psql(self, sql):
+        # Create a temporary file used for writing SQL statements
+        temporary = tempfile.mktemp(prefix="patch-%d-%d-" % self.get_version())
+
+        # Overwrite the temporary file with the sql patch we want to apply
+        shutil.copy(self.filename, temporary)
+
+        # After successfully executing the SQL statements, we need to
+        # make sure that the system_table is updated with the correct
+        # schema generation and patchlevel
+        open(temporary, 'a').write(sql)
+
+        retcode = db_settings.execute_sql(temporary)
+        if retcode != 0:
+            error('Failed to apply %s, psql returned error code: %d' % (
+                os.path.basename(self.filename), retcode))
+
+        os.unlink(temporary)
+
     def get_version(self):
         """Returns the patch version
         :returns: a tuple with the patch generation and level
@@ -201,6 +269,46 @@ class SchemaMigration(object):
 
         return sorted(patches)
 
+    def _get_pending_patches(self):
+        current_version = self.get_current_version()
+        return [patch for patch in self._get_patches()
+                if patch.get_version() > current_version]
+
+    def _apply_patches(self, patches, log_patch):
+        """Applies the patches in a single transaction
+
+        If any of them fails, none of them is applied, unless there are
+        patches that :meth:`Patch.requires_psql` or that commit by
+        themselves, as they split the transaction.
+
+        :param patches: the patches to apply, in order
+        :param log_patch: a callable that will be called with the index
+          of each patch and the patch before applying it
+        :returns: a list of (patch, seconds to apply it) tuples
+        """
+        timings = []
+        with new_store() as store:
+            for i, patch in enumerate(patches):
+                log_patch(i, patch)
+                if patch.requires_psql():
+                    # psql uses another connection, that needs to see the
+                    # patches that were already applied
+                    store.commit()
+
+                start = time.monotonic()
+                patch.apply(store)
+                elapsed = time.monotonic() - start
+                log.info("Applied patch %d.%d in %.3f seconds" % (
+                    patch.generation, patch.level, elapsed))
+                timings.append((patch, elapsed))
+
+        if timings:
+            slowest = sorted(timings, key=lambda t: t[1], reverse=True)[:5]
+            log.info("Slowest patches: %s" % (', '.join(
+                '%d.%d (%.3fs)' % (p.generation, p.level, elapsed)
+                for p, elapsed in slowest), ))
+        return timings
+
     def _update_schema(self):
         """Check the current version of database and update the schema if
         it's needed
@@ -217,19 +325,15 @@ class SchemaMigration(object):
 
         last_level = None
         if current_version != latest_available:
-            patches_to_apply = []
-            for patch in patches:
-                if patch.get_version() <= current_version:
-                    continue
-                patches_to_apply.append(patch)
+            patches_to_apply = self._get_pending_patches()
 
             log.info("Applying %d patches" % (len(patches_to_apply), ))
             create_log.info("PATCHES:%d" % (len(patches_to_apply), ))
 
-            for patch in patches_to_apply:
-                create_log.info("PATCH:%d.%d" % (patch.generation,
-                                                 patch.level))
-                patch.apply(self.default_store)
+            self._apply_patches(
+                patches_to_apply,
+                lambda i, patch: create_log.info("PATCH:%d.%d" % (
+                    patch.generation, patch.level)))
 
             assert patches_to_apply
             log.info("All patches (%s) applied." % (
@@ -281,16 +385,11 @@ class SchemaMigration(object):
         """Apply all available patches
         """
         log.info("Applying all patches")
-        current_version = self.get_current_version()
-        to_apply = []
-        for patch in self._get_patches():
-            if patch.get_version() > current_version:
-                to_apply.append(patch)
+        to_apply = self._get_pending_patches()
 
         self._log("PATCHES:%d" % (len(to_apply), ))
-        for i, patch in enumerate(to_apply):
-            self._log("PATCH:%d" % (i, ))
-            patch.apply(self.default_store)
+        self._apply_patches(to_apply,
+                            lambda i, patch: self._log("PATCH:%d" % (i, )))
 
         self._log("PATCHES APPLIED")
 
@@ -381,16 +480,53 @@ class StoqlibSchemaMigration(SchemaMigration):
 
         return True
 
+    def _needs_backup(self, plugins):
+        # A backup is not needed when all the pending patches can be rolled
+        # back. The patches of stoqlib and of each plugin are committed
+        # separately, so if a plugin fails after stoqlib was committed the
+        # database would be left half updated, which also needs a backup
+        migrations = [self]
+        if plugins:
+            for plugin in self._get_plugins():
+                migration = plugin.get_migration()
+                if migration:
+                    migrations.append(migration)
+
+        n_pending = 0
+        for migration in migrations:
+            patches = migration._get_pending_patches()
+            if patches:
+                n_pending += 1
+            for patch in patches:
+                if not patch.is_transactional():
+                    return True
+        return n_pending > 1
+
     def _backup_database(self):
-        temporary = tempfile.mktemp(prefix="stoq-dump-")
-        log.info("Making a backup to %s" % (temporary, ))
+        # pg_dump creates the directory, it must not exist
+        temporary = os.path.join(tempfile.mkdtemp(prefix="stoq-dump-"), 'dump')
+        log.info("Making a backup to %s using %d jobs" % (
+            temporary, _BACKUP_JOBS))
         create_log.info("BACKUP-START:")
-        success = db_settings.dump_database(temporary)
+        start = time.monotonic()
+
+        def progress_callback(size):
+            speed = size / max(time.monotonic() - start, 1)
+            create_log.info("BACKUP-PROGRESS:%d:%d" % (size, speed))
+
+        success = db_settings.dump_database(
+            temporary, format='directory', jobs=_BACKUP_JOBS,
+            progress_callback=progress_callback)
         if not success:
+            shutil.rmtree(os.path.dirname(temporary))
             info(_(u'Could not create backup! Aborting.'))
             info(_(u'Please contact stoq team to inform this problem.\n'))
             return
 
+        elapsed = time.monotonic() - start
+        size = get_dump_size(temporary)
+        log.info("Backup of %d bytes done in %.1f seconds (%.1f MB/s)" % (
+            size, elapsed, size / max(elapsed, 1) / 1024 ** 2))
         self._backup = temporary
         return True
 
@@ -398,16 +534,21 @@ class StoqlibSchemaMigration(SchemaMigration):
         if not self._backup:
             return
 
-        log.info("Restoring backup %s" % (self._backup, ))
+        log.info("Restoring backup %s using %d jobs" % (self._backup,
+                                                        _BACKUP_JOBS))
         create_log.info("RESTORE-START:")
-        new_name = db_settings.restore_database(self._backup)
+        start = time.monotonic()
+        new_name = db_settings.restore_database(self._backup,
+                                                jobs=_BACKUP_JOBS)
+        log.info("Backup restored in %.1f seconds" % (
+            time.monotonic() - start, ))
         create_log.info("RESTORE-DONE:%s" % (new_name, ))
 
     def _remove_backup(self):
         if not self._backup:
             return
 
-        os.unlink(self._backup)
+        shutil.rmtree(os.path.dirname(self._backup))
 
     def _get_transaction_entry_tables(self, store):
         """Returns a list of all tables that reference transaction_entry"""
@@ -438,6 +579,10 @@ class StoqlibSchemaMigration(SchemaMigration):
         if check_database and not self._check_database():
             return False
 
+        if backup and not self._needs_backup(plugins):
+            log.info("Not making a backup, all the patches can be rolled back")
+            backup = False
+
         if backup:
             self._backup_database()
 
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Connection pooling for stores created by
+:func:`stoqlib.database.runtime.new_store`
+
+Opening a new backend connection for every editor, wizard or background
+task is expensive. The :class:`ConnectionPool` keeps a bounded set of idle
+raw connections around, so that a new store can reuse one instead of
+connecting (and configuring the session) again.
+"""
+
+import collections
+import logging
+import threading
+import time
+import weakref
+
+log = logging.getLogger(__name__)
+
+#: Maximum number of idle connections kept by the pool
+DEFAULT_POOL_SIZE = 5
+#: Seconds an idle connection can stay in the pool before being closed
+DEFAULT_IDLE_TIMEOUT = 300
+#: Seconds to wait for a connection when ``max_connections`` is reached
+DEFAULT_WAIT_TIMEOUT = 30
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection became available in the pool in time"""
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of raw database connections
+
+    Connections are created using ``database.raw_connect()`` and, when
+    released, are reset (any pending transaction is rolled back) before
+    going back to the pool.
+
+    :param database: the storm database used to create new connections
+    :param size: the maximum number of idle connections to keep
+    :param max_connections: the maximum number of connections checked out
+        at the same time or ``None`` for no limit. When the limit is reached,
+        :meth:`.acquire` will wait for a connection to be released
+    :param idle_timeout: seconds an idle connection will be kept
+        before being closed, ``None`` to keep it forever
+    :param wait_timeout: seconds to wait for a connection when
+        *max_connections* was reached
+    :param setup_connection: a callable that will be called with every new
+        raw connection, before it's used for the first time
+    """
+
+    def __init__(self, database, size=DEFAULT_POOL_SIZE, max_connections=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 wait_timeout=DEFAULT_WAIT_TIMEOUT, setup_connection=None):
+        if size < 0:
+            raise ValueError("size must be a positive integer, got %r" % (size, ))
+        if max_connections is not None and max_connections < 1:
+            raise ValueError("max_connections must be greater than 0, got %r" % (
+                max_connections, ))
+
+        self.database = database
+        self.size = size
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.setup_connection = setup_connection
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+        self._closed = False
+        self._condition = threading.Condition()
+        # A deque of (raw_connection, released_at) tuples
+        self._idle = collections.deque()
+        # Connections that are checked out. If a store is garbage collected
+        # without being closed, storm will close the raw connection and it
+        # will disappear from here, so we don't count it as being in use.
+        self._in_use = weakref.WeakSet()
+        # Number of connections being created right now
+        self._connecting = 0
+
+    #
+    #  Public API
+    #
+
+    def acquire(self):
+        """Get a raw connection from the pool
+
+        If there's an idle connection available it will be reused, otherwise
+        a new one will be created.
+
+        :returns: a raw connection
+        :raises: :exc:`PoolTimeoutError` if *max_connections* is reached
+            and no connection was released in *wait_timeout* seconds
+        """
+        with self._condition:
+            if self._closed:
+                raise ValueError("The connection pool was closed")
+
+            self._expire_idle_connections()
+            deadline = None
+            while True:
+                if self._idle:
+                    raw_connection, released_at = self._idle.pop()
+                    self._in_use.add(raw_connection)
+                    self.hits += 1
+                    return raw_connection
+
+                if (self.max_connections is None or
+                        self._count_in_use() < self.max_connections):
+                    self.misses += 1
+                    self._connecting += 1
+                    break
+
+                if deadline is None:
+                    self.waits += 1
+                    deadline = time.monotonic() + self.wait_timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        "Timed out waiting for a database connection "
+                        "(%d connections in use)" % (self._count_in_use(), ))
+                # Wake up from time to time, connections leaked by a store
+                # that was not closed will disappear from _in_use without
+                # anyone notifying us.
+                self._condition.wait(min(remaining, 1))
+
+        # Connect outside the lock, this is the slow part
+        raw_connection = None
+        try:
+            raw_connection = self.database.raw_connect()
+            if self.setup_connection is not None:
+                self.setup_connection(raw_connection)
+        except Exception:
+            if raw_connection is not None:
+                self._close_connection(raw_connection)
+            raw_connection = None
+            raise
+        finally:
+            with self._condition:
+                self._connecting -= 1
+                if raw_connection is not None:
+                    self._in_use.add(raw_connection)
+                self._condition.notify()
+        return raw_connection
+
+    def release(self, raw_connection):
+        """Give a connection back to the pool
+
+        The connection will be reset and kept for later reuse. If it could
+        not be reset or the pool is full, it will be closed instead.
+
+        :param raw_connection: a raw connection obtained by :meth:`.acquire`
+        """
+        reusable = self._reset_connection(raw_connection)
+
+        with self._condition:
+            self._in_use.discard(raw_connection)
+            if reusable and not self._closed and len(self._idle) < self.size:
+                self._idle.append((raw_connection, time.monotonic()))
+                raw_connection = None
+            self._condition.notify()
+
+        if raw_connection is not None:
+            self._close_connection(raw_connection)
+
+    def close(self):
+        """Close all idle connections and disable the pool
+
+        Connections that are still in use will be closed when released.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [raw_connection for raw_connection, released_at in self._idle]
+            self._idle.clear()
+            self._condition.notify_all()
+
+        for raw_connection in idle:
+            self._close_connection(raw_connection)
+
+    def get_stats(self):
+        """Get statistics about the pool usage
+
+        :returns: a dict containing the number of *hits* (connections that
+            were reused), *misses* (connections that had to be created),
+            *waits* (times we had to wait for a connection to be released),
+            and the number of *idle* and *in_use* connections
+        """
+        with self._condition:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        waits=self.waits,
+                        idle=len(self._idle),
+                        in_use=self._count_in_use())
+
+    #
+    #  Private
+    #
+
+    def _count_in_use(self):
+        return len(self._in_use) + self._connecting
+
+    def _expire_idle_connections(self):
+        if self.idle_timeout is None:
+            return
+
+        limit = time.monotonic() - self.idle_timeout
+        # The oldest connections are on the left, since we always
+        # append/pop them on the right
+        while self._idle and self._idle[0][1] < limit:
+            raw_connection, released_at = self._idle.popleft()
+            self._close_connection(raw_connection)
+
+    def _reset_connection(self, raw_connection):
+        if getattr(raw_connection, 'closed', False):
+            return False
+        try:
+            raw_connection.rollback()
+        except Exception as e:
+            log.info("Could not reset pooled connection: %s" % (e, ))
+            return False
+        return True
+
+    def _close_connection(self, raw_connection):
+        try:
+            raw_connection.close()
+        except Exception as e:
+            log.info("Could not close pooled connection: %s" % (e, ))
+
+
+class PooledDatabase(object):
+    """A storm database that gets its connections from a :class:`ConnectionPool`
+
+    Everything else is delegated to the real database.
+
+    :param database: the storm database to proxy
+    :param pool: the :class:`ConnectionPool` to use
+    """
+
+    def __init__(self, database, pool):
+        self.database = database
+        self.pool = pool
+
+    def __getattr__(self, attr):
+        return getattr(self.database, attr)
+
+    def connect(self, event=None):
+        # Storm connections call raw_connect() on the database they received,
+        # both when created and when reconnecting.
+        return self.database.connection_factory(self, event)
+
+    def raw_connect(self):
+        return self.pool.acquire()
@@ -24,25 +24,34 @@
 Kiwi integration for Stoq/Storm
 """
 
+import json
+import logging
 import re
 import threading
 import queue
+import weakref
 
 from gi.repository import GLib, GObject
 from kiwi.python import Settable
 from kiwi.utils import gsignal
 from storm import Undef
 from storm.database import Connection, convert_param_marks
-from storm.expr import compile, And, Or, Like, Not, Alias, State, Lower
+from storm.expr import (compile, And, Or, Like, Not, Alias, State, Lower,
+                        Column, Desc, Eq, Ne)
 from storm.tracer import trace
 import psycopg2
 import psycopg2.extensions
 
-from stoqlib.database.expr import Date, StoqNormalizeString
+from stoqlib.database.expr import StoqNormalizeString, date_range
 from stoqlib.database.interfaces import ISearchFilter
 from stoqlib.database.settings import db_settings
 from stoqlib.database.viewable import Viewable
 
+log = logging.getLogger(__name__)
+
+#: Number of threads executing queries for :meth:`QueryExecuter.search_async`
+ASYNC_QUERY_WORKERS = 3
+
 
 class QueryState(object):
     def __init__(self, search_filter):
@@ -199,7 +208,8 @@ class AsyncQueryOperation(GObject.GObject):
     (STATUS_WAITING,
      STATUS_EXECUTING,
      STATUS_FINISHED,
-     STATUS_CANCELLED) = range(4)
+     STATUS_CANCELLED,
+     STATUS_FAILED) = range(5)
 
     gsignal('finish')
 
@@ -215,12 +225,22 @@ class AsyncQueryOperation(GObject.GObject):
         self.status = self.STATUS_WAITING
         self.resultset = resultset
         self.expr = expr
+        #: the exception raised when executing the query, if the status
+        #: is :attr:`.STATUS_FAILED`
+        self.error = None
+        #: if the server was asked to cancel the query. The connection
+        #: should not be reused after that, since the cancel request may
+        #: reach the server only when another query is executing
+        self.cancel_sent = False
 
         self._conn = store._connection
         self._async_cursor = None
         self._async_conn = None
         self._statement = None
         self._parameters = None
+        # Protects the status changes between the executer thread
+        # and the thread calling cancel()
+        self._lock = threading.Lock()
 
     #
     #  Public API
@@ -229,17 +249,17 @@ class AsyncQueryOperation(GObject.GObject):
     def execute(self, async_conn):
         """Executes a query within an asyncronous psycopg2 connection
         """
-        if self.status == self.STATUS_CANCELLED:
-            return
-
-        self.status = self.STATUS_EXECUTING
-
         # Async variant of Connection.execute() in storm/database.py
         state = State()
         statement = compile(self.expr, state)
         stmt = convert_param_marks(statement, "?", "%s")
-        self._async_cursor = async_conn.cursor()
-        self._async_conn = async_conn
+
+        with self._lock:
+            if self.status == self.STATUS_CANCELLED:
+                return
+            self._async_cursor = async_conn.cursor()
+            self._async_conn = async_conn
+            self.status = self.STATUS_EXECUTING
 
         # This is postgres specific, see storm/databases/postgres.py
         self._statement = stmt
@@ -247,22 +267,51 @@ class AsyncQueryOperation(GObject.GObject):
 
         trace("connection_raw_execute", self._conn,
               self._async_cursor, self._statement, self._parameters)
-        self._async_cursor.execute(self._statement,
-                                   self._parameters)
-
-        # This can happen if another thread cancelled this while the cursor was
-        # executing. In that case, it is not interested in the retval anymore
-        if self.status == self.STATUS_CANCELLED:
+        try:
+            self._async_cursor.execute(self._statement,
+                                       self._parameters)
+        except psycopg2.extensions.QueryCanceledError:
+            # Cancelled by cancel() while it was executing
+            if self.status != self.STATUS_CANCELLED:
+                raise
             return
+        finally:
+            # After this, cancel() will not touch the connection anymore,
+            # making it safe to be used by another operation
+            with self._lock:
+                self._async_conn = None
+
+        with self._lock:
+            # This can happen if another thread cancelled this after the query
+            # finished. In that case, it is not interested in the retval anymore
+            if self.status == self.STATUS_CANCELLED:
+                return
+            self.status = self.STATUS_FINISHED
+
+        GLib.idle_add(self._on_finish)
+
+    def set_error(self, error):
+        """Marks the operation as failed
+
+        The *finish* signal will be emitted, so the caller can check
+        :attr:`.error`.
+
+        :param error: the exception raised when executing the operation
+        """
+        with self._lock:
+            if self.status == self.STATUS_CANCELLED:
+                return
+            self.error = error
+            self.status = self.STATUS_FAILED
+            self._async_conn = None
 
-        self.status = self.STATUS_FINISHED
         GLib.idle_add(self._on_finish)
 
     def get_result(self):
         """Get operation result.
 
         Note that this can only be called when the *finish* signal
-        has been emitted.
+        has been emitted and the operation didn't fail.
 
         :returns: a :class:`AsyncResultSet` containing the result
         """
@@ -276,8 +325,17 @@ class AsyncQueryOperation(GObject.GObject):
         return AsyncResultSet(self.resultset, result)
 
     def cancel(self):
-        """Cancel the operation scheduling"""
-        self.status = self.STATUS_CANCELLED
+        """Cancel the operation
+
+        If the query is waiting to be executed it will just be skipped.
+        If it is already executing, the database server will be asked to
+        cancel it, freeing the connection for other operations.
+        """
+        with self._lock:
+            if self._async_conn is not None:
+                self._async_conn.cancel()
+                self.cancel_sent = True
+            self.status = self.STATUS_CANCELLED
 
     #
     #  Private
@@ -292,32 +350,88 @@ class AsyncQueryOperation(GObject.GObject):
 GObject.type_register(AsyncQueryOperation)
 
 
-class _OperationExecuter(threading.Thread):
+class _OperationWorker(threading.Thread):
 
-    _SINGLETON = None
+    def __init__(self, operation_queue):
+        super(_OperationWorker, self).__init__()
+        self.daemon = True
+
+        self._queue = operation_queue
+        self._conn = None
+
+    def run(self):
+        while True:
+            operation = self._queue.get()
+            try:
+                self._execute(operation)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, operation):
+        if operation.status == operation.STATUS_CANCELLED:
+            return
 
-    def __init__(self):
-        super(_OperationExecuter, self).__init__()
+        try:
+            # The connection is lazily created just before executing the
+            # first query. It is also recreated if the server closed it.
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(db_settings.get_store_dsn())
+                # The queries here are read only, there's no need to keep
+                # a transaction open after them
+                self._conn.autocommit = True
+
+            operation.execute(self._conn)
+        except Exception as e:
+            log.exception("Error executing async query")
+            operation.set_error(e)
+        finally:
+            # A pending cancel request could cancel the next query
+            # executed on this connection, so don't reuse it
+            if operation.cancel_sent and self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _OperationExecuter(object):
+    """Schedules :class:`AsyncQueryOperation` to be executed by a pool of
+    worker threads, each one with its own connection to the database.
+    """
 
-        self._conn = psycopg2.connect(db_settings.get_store_dsn())
+    _SINGLETON = None
+
+    def __init__(self, workers=ASYNC_QUERY_WORKERS):
         self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # The last operation scheduled by each owner
+        self._operations = weakref.WeakKeyDictionary()
+        self._workers = []
+        for i in range(workers):
+            worker = _OperationWorker(self._queue)
+            worker.start()
+            self._workers.append(worker)
 
     @classmethod
     def get_instance(cls):
         if cls._SINGLETON is None:
             cls._SINGLETON = cls()
-            cls._SINGLETON.daemon = True
-            cls._SINGLETON.start()
         return cls._SINGLETON
 
-    def run(self):
-        while True:
-            operation = self._queue.get()
-            operation.execute(self._conn)
-            self._queue.task_done()
+    def schedule(self, operation, owner=None):
+        """Schedule the operation to be executed
 
-    def schedule(self, operation):
+        :param operation: the :class:`AsyncQueryOperation` to execute
+        :param owner: if not ``None``, a previous operation scheduled by
+            the same owner that was not executed yet will be replaced by
+            this one
+        """
         assert isinstance(operation, AsyncQueryOperation)
+        if owner is not None:
+            with self._lock:
+                last_operation = self._operations.get(owner)
+                if (last_operation is not None and
+                        last_operation.status == AsyncQueryOperation.STATUS_WAITING):
+                    last_operation.cancel()
+                self._operations[owner] = operation
         self._queue.put(operation)
 
 
@@ -374,8 +488,10 @@ class QueryExecuter(object):
     def search_async(self, states=None, resultset=None, limit=None):
         """
         Execute a search asynchronously.
-        This uses a separate psycopg2 connection which is lazily
-        created just before executing the first async query.
+        The query is executed by a pool of threads, each one using a
+        separate psycopg2 connection which is lazily created just before
+        executing its first async query. Calling this again before the
+        previous operation started executing will cancel it.
         This method returns an operation for which a signal **finish** is
         emitted when the query has finished executing. In that callback,
         :meth:`.AsyncQueryOperation.finish` should be called, eg:
@@ -413,7 +529,9 @@ class QueryExecuter(object):
         operation = AsyncQueryOperation(self.store,
                                         resultset,
                                         resultset._get_select())
-        self._operation_executer.schedule(operation)
+        # A newer search from this executer replaces an older one
+        # that is still waiting to be executed
+        self._operation_executer.schedule(operation, owner=self)
         return operation
 
     def set_limit(self, limit):
@@ -519,8 +637,107 @@ class QueryExecuter(object):
 
         return result.order_by(attribute)
 
+    def get_estimated_count(self, result):
+        """Get an estimate of the number of rows in a result set
+
+        This uses the planner statistics instead of executing the query,
+        which is a lot faster than ``result.count()`` for big tables.
+        Note that the estimate can be very wrong for queries with
+        lots of filters, so use ``result.count()`` if the exact number
+        is needed.
+
+        :param result: a result set
+        :returns: the estimated number of rows
+        """
+        state = State()
+        statement = compile(result._get_select(), state)
+        plan = self.store.execute('EXPLAIN (FORMAT JSON) ' + statement,
+                                  state.parameters).get_one()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def supports_keyset(self, attribute):
+        """Checks if the results can be paginated by attribute using
+        :meth:`.get_keyset_page`
+
+        That is only possible when sorting by a column of the search spec,
+        not by python properties or expressions (like aggregates)
+
+        :param attribute: the name of the attribute used to sort the results
+        """
+        return self._get_keyset_columns(attribute) is not None
+
+    def get_keyset_key(self, item, attribute):
+        """Get the keyset pagination key of an item
+
+        :param item: an item returned by :meth:`.get_keyset_page`
+        :param attribute: the name of the attribute used to sort the results
+        :returns: the key to be used as the *after* argument of
+          :meth:`.get_keyset_page`
+        """
+        return (getattr(item, attribute), item.id)
+
+    def get_keyset_page(self, result, attribute, limit, after=None, offset=0,
+                        descending=False):
+        """Get a page of results using keyset pagination
+
+        Instead of using ``OFFSET`` to skip all the rows before the page,
+        which makes the database compute and discard all of them, the rows are
+        filtered by the key of the last row before the page, so the query
+        can use an index on the sorted column.
+
+        The results are sorted by attribute and then by id, to make sure
+        the keys are unique.
+
+        :param result: a result set
+        :param attribute: the name of the attribute used to sort the results,
+          see :meth:`.supports_keyset`
+        :param limit: the maximum number of rows to return
+        :param after: the key (see :meth:`.get_keyset_key`) of the row just
+          before the page or ``None`` to start from the first row
+        :param offset: the number of rows to skip after *after*, used when
+          jumping to a row after the ones we know the keys
+        :param descending: if the results should be sorted in descending order
+        :returns: a list with the rows
+        """
+        column, id_column = self._get_keyset_columns(attribute)
+        if after is not None:
+            result = result.find(
+                self._get_keyset_query(column, id_column, after, descending))
+        if descending:
+            result = result.order_by(Desc(column), Desc(id_column))
+        else:
+            result = result.order_by(column, id_column)
+        return list(result[offset:offset + limit])
+
     # Private API
 
+    def _get_keyset_columns(self, attribute):
+        column = getattr(self.search_spec, attribute, None)
+        id_column = getattr(self.search_spec, 'id', None)
+        if not isinstance(column, Column) or not isinstance(id_column, Column):
+            return None
+        return column, id_column
+
+    def _get_keyset_query(self, column, id_column, key, descending):
+        value, id_ = key
+        # Postgres puts NULLs after everything else when sorting in
+        # ascending order and before everything else when sorting in
+        # descending order.
+        if descending:
+            if value is None:
+                return Or(And(Eq(column, None), id_column < id_),
+                          Ne(column, None))
+            return Or(column < value,
+                      And(column == value, id_column < id_))
+
+        if value is None:
+            return And(Eq(column, None), id_column > id_)
+        return Or(column > value,
+                  And(column == value, id_column > id_),
+                  Eq(column, None))
+
     def _default_query(self, store):
         return store.find(self.search_spec)
 
@@ -639,9 +856,10 @@ class QueryExecuter(object):
             return
 
         def _like(value):
+            # Both sides are already lowercased by stoq_normalize_string, and
+            # a plain LIKE on it can use the trigram indexes (see patch-06-18)
             return Like(StoqNormalizeString(table_field),
-                        StoqNormalizeString(u'%%%s%%' % value.lower()),
-                        case_sensitive=False)
+                        StoqNormalizeString(u'%%%s%%' % value.lower()))
 
         if state.mode == StringQueryState.CONTAINS_ALL:
             queries = [_like(word) for word in re.split('[ \n\r]', state.text) if word]
@@ -660,16 +878,10 @@ class QueryExecuter(object):
 
     def _parse_date_state(self, state, table_field):
         if state.date:
-            return Date(table_field) == Date(state.date)
+            return date_range(table_field, state.date, state.date)
 
     def _parse_date_interval_state(self, state, table_field):
-        queries = []
-        if state.start:
-            queries.append(Date(table_field) >= Date(state.start))
-        if state.end:
-            queries.append(Date(table_field) <= Date(state.end))
-        if queries:
-            return And(*queries)
+        return date_range(table_field, state.start or None, state.end or None)
 
     def _parse_bool_state(self, state, table_field):
         return table_field == state.value
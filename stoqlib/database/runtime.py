@@ -24,16 +24,18 @@
 """ Runtime routines for applications"""
 
 from collections import namedtuple
+import itertools
 import logging
 import sys
+import threading
 import warnings
 import weakref
 import os
 
 from kiwi.component import get_utility, provide_utility
 from storm import Undef
-from storm.expr import SQL, Avg
-from storm.info import get_obj_info
+from storm.expr import SQL, Avg, State
+from storm.info import get_cls_info, get_obj_info
 from storm.store import Store, ResultSet, PENDING_REMOVE, PENDING_ADD
 from storm.tracer import trace
 
@@ -43,6 +45,7 @@ from stoqlib.database.interfaces import (
     ICurrentBranchStation, ICurrentUser)
 from stoqlib.database.expr import is_sql_identifier
 from stoqlib.database.orm import ORMObject
+from stoqlib.database.pool import ConnectionPool, PooledDatabase
 from stoqlib.database.properties import Identifier
 from stoqlib.database.settings import db_settings
 from stoqlib.database.viewable import Viewable
@@ -63,29 +66,113 @@ _default_store = None
 #: should not be used by anything except autoreload_object()
 _stores = weakref.WeakSet()
 
+#: the database used by stores created by new_store(), it gets its
+#: connections from a :class:`stoqlib.database.pool.ConnectionPool`
+_pooled_database = None
+
+# Used to give an unique name to the cursors declared by fast_iter()
+_cursor_counter = itertools.count()
+
+
+class _AliveIndex(object):
+    """An index of the objects alive in all the stores
+
+    Maps the key storm uses to identify an object in a store,
+    ``(cls, primary_values)``, to the stores where it's alive, so that
+    we can find them without going through every open store.
+
+    Objects that were garbage collected are not removed from here
+    right away, so :meth:`.get_stores` may return stores where the
+    object is not alive anymore.
+    """
+
+    #: Minimum number of keys in the index before pruning it
+    PRUNE_THRESHOLD = 10000
+
+    def __init__(self):
+        self._index = {}
+        self._lock = threading.Lock()
+        self._prune_size = self.PRUNE_THRESHOLD
+
+    def add(self, key, store):
+        with self._lock:
+            stores = self._index.get(key)
+            if stores is None:
+                stores = self._index[key] = weakref.WeakSet()
+            stores.add(store)
+
+            if len(self._index) > self._prune_size:
+                self._prune()
+
+    def discard(self, key, store):
+        with self._lock:
+            stores = self._index.get(key)
+            if stores is None:
+                return
+            stores.discard(store)
+            if not stores:
+                del self._index[key]
+
+    def get_stores(self, key):
+        with self._lock:
+            return list(self._index.get(key, ()))
+
+    def _prune(self):
+        # Remove stores where the object is not alive anymore. This is
+        # amortized by only being done when the index doubles its size
+        for key, stores in list(self._index.items()):
+            for store in list(stores):
+                if key not in store._alive:
+                    stores.discard(store)
+            if not stores:
+                del self._index[key]
+        self._prune_size = max(self.PRUNE_THRESHOLD, len(self._index) * 2)
+
+
+#: the index of objects alive in _stores, used by autoreload_object()
+_alive_index = _AliveIndex()
+
+
+def _get_alive_key(obj_info):
+    # This is the same key storm uses in Store._alive
+    return (obj_info.cls_info.cls,
+            tuple(var.get(to_db=True) for var in obj_info.primary_vars))
+
+
+def _get_alive_objects(key, exclude=None):
+    for store in _alive_index.get_stores(key):
+        if store is exclude:
+            continue
+
+        alive = store._alive.get(key)
+        if alive is None:
+            _alive_index.discard(key, store)
+            continue
+        yield store, alive
+
 
 def autoreload_object(obj, obj_store=False):
     """Autoreload object in any other existing store.
 
-    This will go through every open store and see if the object is alive in the
-    store. If it is, it will be marked for autoreload the next time its used.
+    This will go through every open store where the object is alive.
+    It will be marked for autoreload the next time its used.
 
     :param obj_store: if we should also autoreload the current store
         of the object
     """
-    # Since _stores is a weakref, copy it to a list to avoid it changing size during iteration
-    # (specially when running threaded operations).
-    stores = list(_stores)
-    for store in stores:
-        if not obj_store and Store.of(obj) is store:
-            continue
-
-        alive = store._alive.get((obj.__class__, (obj.id,)))
-        if alive:
-            # Just to make sure its not modified before reloading it, otherwise,
-            # we would lose the changes
-            assert not store._is_dirty(get_obj_info(obj))
-            store.autoreload(alive)
+    obj_info = get_obj_info(obj)
+    key = _get_alive_key(obj_info)
+    store_of = Store.of(obj)
+    if isinstance(store_of, StoqlibStore):
+        # The object was changed on the database by its store, the other
+        # stores will need to reload it again after that is committed
+        store_of._changed_keys.add(key)
+    exclude = None if obj_store else store_of
+    for store, alive in _get_alive_objects(key, exclude=exclude):
+        # Just to make sure its not modified before reloading it, otherwise,
+        # we would lose the changes
+        assert not store._is_dirty(obj_info)
+        store.autoreload(alive)
 
 
 class StoqlibResultSet(ResultSet):
@@ -158,6 +245,17 @@ class StoqlibResultSet(ResultSet):
 
         return super(StoqlibResultSet, self).find(*args, **kwargs)
 
+    def set(self, *args, **kwargs):
+        super(StoqlibResultSet, self).set(*args, **kwargs)
+        # We don't know which rows were updated, so all the objects of
+        # this class will need to be reloaded on other stores after commit
+        self._store._bulk_changed.add(self._find_spec.default_cls_info.cls)
+
+    def remove(self):
+        rowcount = super(StoqlibResultSet, self).remove()
+        self._store._bulk_changed.add(self._find_spec.default_cls_info.cls)
+        return rowcount
+
     def _load_fast_object(self, named_tuples, values):
         objects = []
         values_start = values_end = 0
@@ -176,7 +274,25 @@ class StoqlibResultSet(ResultSet):
         else:
             return objects[0]
 
-    def fast_iter(self):
+    def is_viewable(self):
+        """If the results are loaded as viewables
+
+        See :meth:`.set_viewable`
+        """
+        return hasattr(self, '_viewable')
+
+    def fast_iter(self, batch_size=None):
+        """Iterate over the results bypassing storm object creation
+
+        The results are named tuples with the columns of each class, or
+        viewables when the results are viewables.
+
+        :param batch_size: if not ``None``, the rows will be fetched from a
+          server side cursor, *batch_size* rows at a time, instead of all at
+          once. Use it to keep the memory usage low when iterating over lots
+          of rows. Note that the store must not be committed nor rolled back
+          while iterating.
+        """
         # First build all named tuples
         named_tuples = []
         for is_expr, info in self._find_spec._cls_spec_info:
@@ -186,14 +302,57 @@ class StoqlibResultSet(ResultSet):
                 named_tuples.append(namedtuple(info.cls.__name__,
                                                [i.name for i in info.columns]))
 
-        is_viewable = hasattr(self, '_viewable')
+        is_viewable = self.is_viewable()
+        if batch_size is None:
+            rows = self._store._connection.execute(self._get_select())
+        else:
+            rows = (row for result, row in self._iter_cursor(batch_size))
+
         # Then interate over the results bypassing storm object creation
-        for values in self._store._connection.execute(self._get_select()):
+        for values in rows:
             value = self._load_fast_object(named_tuples, values)
             if is_viewable:
                 value = self._load_viewable(value)
             yield value
 
+    def iter_pages(self, page_size):
+        """Iterate over the results fetching *page_size* rows at a time
+
+        Unlike :meth:`.fast_iter`, the results are the same objects (or
+        viewables) returned when iterating over the result set itself, but
+        they are not all fetched at once, which keeps the memory usage low
+        when iterating over lots of rows.
+
+        The rows are fetched from a server side cursor, so the query is
+        executed only once. Note that the store must not be committed nor
+        rolled back while iterating.
+
+        :param page_size: the number of rows to fetch at a time
+        """
+        for result, values in self._iter_cursor(page_size):
+            yield self._load_objects(result, values)
+
+    def _iter_cursor(self, batch_size):
+        connection = self._store._connection
+        state = State()
+        statement = connection.compile(self._get_select(), state)
+        name = 'fast_iter_%d' % (next(_cursor_counter), )
+
+        connection.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (
+            name, statement), state.parameters, noresult=True)
+        try:
+            while True:
+                # The result is needed by storm to load the objects
+                result = connection.execute('FETCH %d FROM %s' % (
+                    batch_size, name))
+                rows = result.get_all()
+                if not rows:
+                    break
+                for row in rows:
+                    yield result, row
+        finally:
+            connection.execute('CLOSE %s' % (name, ), noresult=True)
+
 
 class StoqlibStore(Store):
     """The Stoqlib Store.
@@ -241,15 +400,25 @@ class StoqlibStore(Store):
         # When using savepoints, this stack will hold what objects were changed
         # (created, deleted or edited) inside that savepoint.
         self._dirties = [[]]
+        # Classes that had rows changed by ResultSet.set()/remove(), raw
+        # SQL or triggers. See mark_bulk_changed()
+        self._bulk_changed = set()
+        # Objects changed outside the ORM. See autoreload_object()
+        self._changed_keys = set()
         self.retval = True
         self.obsolete = False
 
         if database is None:
-            database = get_default_store().get_database()
+            database = get_pooled_database()
+        # Pooled connections have their application name set when they
+        # are created and keep it when they are reused
+        self._pooled = isinstance(database, PooledDatabase)
+
         Store.__init__(self, database=database, cache=cache)
         _stores.add(self)
         trace('transaction_create', self)
-        self._setup_application_name()
+        if not self._pooled:
+            self._setup_application_name()
 
     def __enter__(self):
         return self
@@ -265,6 +434,15 @@ class StoqlibStore(Store):
         self._dirties[-1].append((obj_info, obj_info.get("pending")))
         super(StoqlibStore, self)._set_dirty(obj_info)
 
+    def _add_to_alive(self, obj_info):
+        super(StoqlibStore, self)._add_to_alive(obj_info)
+        _alive_index.add(_get_alive_key(obj_info), self)
+
+    def _remove_from_alive(self, obj_info):
+        if obj_info.get("primary_vars") is not None:
+            _alive_index.discard(_get_alive_key(obj_info), self)
+        super(StoqlibStore, self)._remove_from_alive(obj_info)
+
     def find(self, cls_spec, *args, **kwargs):
         # Overwrite the default find method so we can support querying our own
         # viewables. If the cls_spec is a Viewable, we first get the real
@@ -444,23 +622,29 @@ class StoqlibStore(Store):
         self._check_obsolete()
         self._committing = True
 
-        # the cache will be cleared when commiting, so store them here
-        # and autoreload them after commit
-        touched_objs = []
-        for obj_info in self._cache.get_cached():
-            obj = obj_info.get_obj()
-            if obj is not None:
-                touched_objs.append(obj)
-
         super(StoqlibStore, self).commit()
         trace('transaction_commit', self)
 
+        # Only the objects that were changed (created, deleted or edited)
+        # need to be reloaded on the other opened stores. Their ids are
+        # only known for sure after the flush done by the commit
+        changed_keys = set(_get_alive_key(obj_info)
+                           for dirties in self._dirties
+                           for obj_info, pending in dirties)
+        changed_keys.update(self._changed_keys)
+        bulk_changed = self._bulk_changed
+
         self._savepoints = []
         self._dirties = [[]]
+        self._bulk_changed = set()
+        self._changed_keys = set()
 
         # Reload objects on all other opened stores
-        for obj in touched_objs:
-            autoreload_object(obj)
+        for key in changed_keys:
+            for store, alive in _get_alive_objects(key, exclude=self):
+                store.autoreload(alive)
+        if bulk_changed:
+            self._autoreload_classes(bulk_changed)
 
         if close:
             self.close()
@@ -518,9 +702,12 @@ class StoqlibStore(Store):
             # If we rollback completely, we need to clear all savepoints
             self._savepoints = []
             self._dirties = [[]]
+            self._bulk_changed = set()
+            self._changed_keys = set()
 
         # Rolling back resets the application name.
-        self._setup_application_name()
+        if not self._pooled:
+            self._setup_application_name()
 
         # sqlobject closes the connection after a rollback
         if close:
@@ -536,9 +723,22 @@ class StoqlibStore(Store):
         trace('transaction_close', self)
         self._check_obsolete()
 
+        # Take the raw connection from storm before closing, so it
+        # goes back to the pool instead of being closed
+        raw_connection = None
+        if self._pooled:
+            raw_connection = self._connection._raw_connection
+            self._connection._raw_connection = None
+
+        for key in list(self._alive.keys()):
+            _alive_index.discard(key, self)
+
         super(StoqlibStore, self).close()
         self.obsolete = True
 
+        if raw_connection is not None:
+            self.get_database().pool.release(raw_connection)
+
     @public(since="1.5.0")
     def fetch(self, obj):
         """Fetches an existing object in the context of this store.
@@ -560,6 +760,22 @@ class StoqlibStore(Store):
         else:
             raise TypeError("obj must be a ORMObject or a Viewable, not %r" % (obj, ))
 
+    def is_alive(self, cls, id_):
+        """Checks if an object is loaded on this store
+
+        If it is, getting it with :meth:`.get` or through a reference
+        will not query the database.
+
+        :param cls: the class of the object, with a single column
+          primary key
+        :param id_: the primary key of the object
+        :returns: ``True`` if the object is loaded
+        """
+        column = get_cls_info(cls).primary_key[0]
+        value = column.variable_factory(value=id_).get(to_db=True)
+        obj_info = self._alive.get((cls, (value, )))
+        return obj_info is not None and not obj_info.get("invalidated")
+
     def remove(self, obj):
         """Remove an objet from the store
 
@@ -647,6 +863,18 @@ class StoqlibStore(Store):
         """
         return self.table_exists('sync')
 
+    def mark_bulk_changed(self, *classes):
+        """Marks the rows of some classes as changed outside the ORM
+
+        This should be called when the rows of *classes* were changed by
+        raw SQL or by triggers, so that all their objects alive on the other
+        stores are reloaded after this store is committed. Otherwise their
+        stale values could be written back over the changes.
+
+        :param classes: the classes that had their rows changed
+        """
+        self._bulk_changed.update(classes)
+
     #
     #  Private
     #
@@ -657,21 +885,40 @@ class StoqlibStore(Store):
         This name will appear when selecting from pg_stat_activity, for instance,
         and will allow to better debug the queries (specially when there is a deadlock)
         """
-        try:
-            appinfo = get_utility(IAppInfo)
-        except Exception:
-            appname = 'stoq'
-        else:
-            appname = appinfo.get('name') or 'stoq'
+        self.execute("SET application_name = '%s'" % (_get_application_name(), ))
 
-        self.execute("SET application_name = '%s - %s - %s'" % (
-            (appname.lower(), get_hostname(), os.getpid())))
+    def _autoreload_classes(self, classes):
+        for store in list(_stores):
+            if store is self or store.obsolete:
+                continue
+            for (cls, primary_values), alive in list(store._alive.items()):
+                if cls in classes:
+                    store.autoreload(alive)
 
     def _check_obsolete(self):
         if self.obsolete:
             raise InterfaceError("This transaction has already been closed")
 
 
+def _get_application_name():
+    try:
+        appinfo = get_utility(IAppInfo)
+    except Exception:
+        appname = 'stoq'
+    else:
+        appname = appinfo.get('name') or 'stoq'
+
+    return '%s - %s - %s' % (appname.lower(), get_hostname(), os.getpid())
+
+
+def _setup_pooled_connection(raw_connection):
+    # Commit the SET so that it is not lost when the store rolls back
+    cursor = raw_connection.cursor()
+    cursor.execute("SET application_name = %s", (_get_application_name(), ))
+    cursor.close()
+    raw_connection.commit()
+
+
 def get_default_store():
     """This function returns the default/primary store.
     Notice that this store is considered read-only inside Stoqlib
@@ -698,11 +945,46 @@ def set_default_store(store):
     :param store: the new store to set
     """
 
-    global _default_store
+    global _default_store, _pooled_database
     if store is None and _default_store is not None:
         _default_store.close()
     _default_store = store
 
+    # The pool was created for the old default store's database
+    if _pooled_database is not None:
+        _pooled_database.pool.close()
+        _pooled_database = None
+
+
+def get_pooled_database():
+    """Get the database used by stores created by :func:`.new_store`
+
+    It's a proxy to the default store's database that reuses connections
+    from a :class:`stoqlib.database.pool.ConnectionPool`, configured by
+    the pool settings in :obj:`stoqlib.database.settings.db_settings`.
+
+    :returns: a :class:`stoqlib.database.pool.PooledDatabase`
+    """
+    global _pooled_database
+    if _pooled_database is None:
+        database = get_default_store().get_database()
+        pool = ConnectionPool(database,
+                              size=db_settings.pool_size,
+                              max_connections=db_settings.pool_max_connections,
+                              idle_timeout=db_settings.pool_idle_timeout,
+                              setup_connection=_setup_pooled_connection)
+        _pooled_database = PooledDatabase(database, pool)
+    return _pooled_database
+
+
+def get_connection_pool_stats():
+    """Get the usage statistics of the connection pool used by
+    :func:`.new_store`
+
+    :returns: a dict, see :meth:`stoqlib.database.pool.ConnectionPool.get_stats`
+    """
+    return get_pooled_database().pool.get_stats()
+
 
 def new_store():
     """
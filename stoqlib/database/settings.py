@@ -40,6 +40,7 @@ from storm.database import create_database
 from storm.uri import URI
 
 from stoqlib.database.exceptions import OperationalError, SQLError
+from stoqlib.database.pool import DEFAULT_IDLE_TIMEOUT, DEFAULT_POOL_SIZE
 from stoqlib.exceptions import ConfigError, DatabaseError
 from stoqlib.lib.message import warning
 from stoqlib.lib.osutils import get_username
@@ -108,6 +109,25 @@ def _extension_exists(cur, extension):
     return cur.fetchone()[0] == 1
 
 
+def get_dump_size(filename):
+    """Returns the size of a database dump
+
+    :param filename: the dump file or directory, for the ``directory``
+      format, which has a file for each table
+    :returns: the size in bytes
+    """
+    if not os.path.isdir(filename):
+        return os.path.getsize(filename) if os.path.exists(filename) else 0
+    size = 0
+    for entry in os.scandir(filename):
+        try:
+            size += entry.stat().st_size
+        except OSError:
+            # pg_dump may be renaming it
+            pass
+    return size
+
+
 def _create_empty_database(store, dbname, ifNotExists=False):
     if not validate_database_name(dbname):
         raise ValueError(
@@ -223,6 +243,15 @@ class DatabaseSettings(object):
         self.password = password
         self.first = True
 
+        #: Maximum number of idle connections kept by the connection pool
+        #: used by :func:`stoqlib.database.runtime.new_store`
+        self.pool_size = DEFAULT_POOL_SIZE
+        #: Maximum number of connections that the pool will open at the
+        #: same time, ``None`` means no limit
+        self.pool_max_connections = None
+        #: Seconds an idle connection will be kept in the pool
+        self.pool_idle_timeout = DEFAULT_IDLE_TIMEOUT
+
     def __repr__(self):
         return '<DatabaseSettings rdbms=%s address=%s port=%d dbname=%s username=%s' % (
             self.rdbms, self.address, self.port, self.dbname, self.username)
@@ -335,12 +364,16 @@ class DatabaseSettings(object):
         return self._get_store_internal(None)
 
     def copy(self):
-        return DatabaseSettings(address=self.address,
-                                dbname=self.dbname,
-                                rdbms=self.rdbms,
-                                port=self.port,
-                                username=self.username,
-                                password=self.password)
+        settings = DatabaseSettings(address=self.address,
+                                    dbname=self.dbname,
+                                    rdbms=self.rdbms,
+                                    port=self.port,
+                                    username=self.username,
+                                    password=self.password)
+        settings.pool_size = self.pool_size
+        settings.pool_max_connections = self.pool_max_connections
+        settings.pool_idle_timeout = self.pool_idle_timeout
+        return settings
 
     # FIXME: Remove/Rethink
     def check_database_address(self):
@@ -641,13 +674,21 @@ class DatabaseSettings(object):
             raise NotImplementedError(self.rdbms)
 
     def dump_database(self, filename, schema_only=False,
-                      gzip=False, format='custom'):
+                      gzip=False, format='custom', no_owner=False,
+                      jobs=None, progress_callback=None):
         """Dump the contents of the current database
 
         :param filename: filename to write the database dump to
         :param schema_only: If only the database schema will be dumped
         :param gzip: if the dump should be compressed using gzip -9
         :param format: database dump format, defaults to ``custom``
+        :param no_owner: if the ownership and the privileges of the objects
+          should be left out of the dump, so it can be restored by any user
+        :param jobs: the number of tables to dump in parallel, only
+          supported by the ``directory`` format
+        :param progress_callback: if not ``None``, it will be called every
+          second, while dumping, with the number of bytes already written
+          to *filename*
         """
         log.info("Dumping database to %s" % filename)
 
@@ -659,6 +700,10 @@ class DatabaseSettings(object):
                 args.append('--compress=9')
             if schema_only:
                 args.append('--schema-only')
+            if no_owner:
+                args.extend(['--no-owner', '--no-privileges'])
+            if jobs:
+                args.append('--jobs=%d' % (jobs, ))
             if filename is not None:
                 args.extend(['-f', filename])
             args.extend(self.get_tool_args())
@@ -666,16 +711,23 @@ class DatabaseSettings(object):
 
             log.debug('executing %s' % (' '.join(args), ))
             proc = Process(args)
+            if progress_callback is not None and filename is not None:
+                while proc.poll() is None:
+                    time.sleep(1)
+                    progress_callback(get_dump_size(filename))
             return proc.wait() == 0
         else:
             raise NotImplementedError(self.rdbms)
 
-    def restore_database(self, dump, new_name=None, clean_first=True):
+    def restore_database(self, dump, new_name=None, clean_first=True,
+                         jobs=None):
         """Restores the current database.
 
         :param dump: a database dump file to be used to restore the database.
         :param new_name: optional name for the new restored database.
         :param clean_first: if a clean_database will be performed before restoring.
+        :param jobs: the number of tables to restore in parallel, only
+          supported by the ``custom`` and ``directory`` formats
         """
         log.info("Restoring database %s using %s" % (self.dbname, dump))
 
@@ -688,6 +740,8 @@ class DatabaseSettings(object):
                 self.clean_database(new_name)
 
             args = ['pg_restore', '-d', new_name]
+            if jobs:
+                args.append('--jobs=%d' % (jobs, ))
             args.extend(self.get_tool_args())
             args.append(dump)
 
@@ -113,6 +113,7 @@ _tables = [
                  "ProductSupplierInfo",
                  'StockTransactionHistory',
                  "ProductStockItem",
+                 "ProductStockSummary",
                  "GridGroup",
                  "GridAttribute",
                  "GridOption",
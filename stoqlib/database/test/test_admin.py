@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+""" This module tests the schema snapshots of stoqlib/database/admin.py """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from kiwi.environ import environ
+
+from stoqlib.database import admin
+from stoqlib.database.settings import db_settings
+
+
+class SchemaSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.sql_dir = tempfile.mkdtemp(prefix='stoqsql-')
+        self.addCleanup(shutil.rmtree, self.sql_dir)
+        self._create_file('schema-06.sql')
+
+        self.migration = mock.Mock()
+        self.migration.get_current_version.return_value = (6, 22)
+        self.dumps = []
+
+        for target, attr, kwargs in [
+                (environ, 'get_resource_filename',
+                 dict(return_value=self.sql_dir)),
+                (db_settings, 'execute_sql', dict(return_value=0)),
+                (db_settings, 'dump_database',
+                 dict(side_effect=self._dump_database)),
+                (admin, 'StoqlibSchemaMigration',
+                 dict(return_value=self.migration)),
+                (admin, 'create_database_functions', {}),
+                (admin, '_recreate_database', {}),
+                (admin, 'error', {})]:
+            patcher = mock.patch.object(target, attr, **kwargs)
+            setattr(self, attr, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def _create_file(self, name, content=''):
+        filename = os.path.join(self.sql_dir, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+    def _dump_database(self, filename, **kwargs):
+        with open(filename, 'w') as f:
+            f.write(self.dumps.pop(0))
+        return True
+
+    def test_create_base_schema_snapshot(self):
+        self._create_file('snapshot-06-20.sql')
+        snapshot = self._create_file('snapshot-06-21.sql')
+        admin.create_base_schema()
+
+        # Only the latest snapshot is loaded, the patches newer than it
+        # are applied by the migration
+        self.execute_sql.assert_called_once_with(snapshot)
+        self.create_database_functions.assert_called_once_with()
+        self.migration.apply_all_patches.assert_called_once_with()
+        self.assertFalse(self.error.called)
+
+    def test_create_base_schema_snapshot_error(self):
+        self._create_file('snapshot-06-21.sql')
+        self.execute_sql.return_value = 1
+        admin.create_base_schema()
+        self.error.assert_called_once_with(
+            u'Failed to load the schema snapshot')
+
+    def test_create_base_schema_without_snapshot(self):
+        admin.create_base_schema()
+        self.execute_sql.assert_called_once_with(
+            os.path.join(self.sql_dir, 'schema-06.sql'))
+        self.migration.apply_all_patches.assert_called_once_with()
+
+        self._create_file('snapshot-06-21.sql')
+        self.execute_sql.reset_mock()
+        admin.create_base_schema(use_snapshot=False)
+        self.execute_sql.assert_called_once_with(
+            os.path.join(self.sql_dir, 'schema-06.sql'))
+
+    def test_create_schema_snapshot(self):
+        old = self._create_file('snapshot-06-20.sql')
+        self.dumps.append("CREATE TABLE foo ();\n"
+                          "COMMENT ON EXTENSION plpgsql IS 'PL/pgSQL';\n"
+                          "INSERT INTO foo VALUES ();\n")
+
+        filename = admin.create_schema_snapshot(self.sql_dir)
+        self.assertEqual(filename,
+                         os.path.join(self.sql_dir, 'snapshot-06-22.sql'))
+        self._recreate_database.assert_called_once_with()
+        # The snapshot is generated from the patches, not from itself
+        self.execute_sql.assert_called_once_with(
+            os.path.join(self.sql_dir, 'schema-06.sql'))
+        self.dump_database.assert_called_once_with(
+            mock.ANY, format='plain', no_owner=True)
+
+        with open(filename) as f:
+            self.assertEqual(
+                f.read(),
+                "-- Generated by 'stoqdbadmin snapshot', do not edit\n"
+                "CREATE TABLE foo ();\n"
+                "INSERT INTO foo VALUES ();\n")
+        # The older snapshot was removed
+        self.assertFalse(os.path.exists(old))
+
+    def test_check_schema_snapshot_missing(self):
+        self.assertEqual(admin.check_schema_snapshot(),
+                         [u'There is no schema snapshot\n'])
+        self.assertFalse(self._recreate_database.called)
+
+    def test_check_schema_snapshot_old(self):
+        self._create_file('snapshot-06-21.sql')
+        self.assertEqual(
+            admin.check_schema_snapshot(),
+            [u'The schema snapshot snapshot-06-21.sql is older than '
+             u'the latest patch (6.22)\n'])
+
+    def test_check_schema_snapshot(self):
+        snapshot = self._create_file('snapshot-06-22.sql')
+        self.dumps.extend(["CREATE TABLE foo ();\n"] * 2)
+        self.assertEqual(admin.check_schema_snapshot(), [])
+
+        # The database is created once by the patches and once by the
+        # snapshot, and their schemas are compared
+        self.assertEqual(self._recreate_database.call_count, 2)
+        self.assertEqual(self.execute_sql.call_args_list,
+                         [mock.call(os.path.join(self.sql_dir,
+                                                 'schema-06.sql')),
+                          mock.call(snapshot)])
+        self.dump_database.assert_called_with(
+            mock.ANY, schema_only=True, format='plain', no_owner=True)
+
+    def test_check_schema_snapshot_differences(self):
+        self._create_file('snapshot-06-22.sql')
+        self.dumps.extend(["CREATE TABLE foo ();\n",
+                           "CREATE TABLE bar ();\n"])
+        diff = admin.check_schema_snapshot()
+        self.assertIn(u'-CREATE TABLE foo ();\n', diff)
+        self.assertIn(u'+CREATE TABLE bar ();\n', diff)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.allocator`"""
+
+import contextlib
+
+import mock
+
+from stoqlib.database.allocator import NumberAllocator
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class NumberAllocatorTest(DomainTest):
+
+    key = u'key'
+
+    def test_reserve(self):
+        allocator = NumberAllocator(u'test', NumberAllocator.GAPLESS)
+        self.assertEqual(allocator.reserve(self.store, self.key), [1])
+        self.assertEqual(allocator.reserve(self.store, self.key, 3),
+                         [2, 3, 4])
+        self.assertEqual(allocator.get_next(self.store, self.key), 5)
+
+        # Each key and name has its own numbers
+        self.assertEqual(allocator.get_next(self.store, self.key + u'x'), 1)
+        other = NumberAllocator(u'other', NumberAllocator.GAPLESS)
+        self.assertEqual(other.get_next(self.store, self.key), 1)
+
+    def test_reserve_initial(self):
+        allocator = NumberAllocator(u'test', NumberAllocator.GAPLESS, step=2)
+
+        def initial(store):
+            return 10
+
+        self.assertEqual(
+            allocator.reserve(self.store, self.key, 2, initial=initial),
+            [12, 14])
+        # The initial value is only used the first time
+        self.assertEqual(
+            allocator.get_next(self.store, self.key, initial=initial), 16)
+
+        allocator.set_last(self.store, self.key, 100)
+        self.assertEqual(allocator.get_next(self.store, self.key), 102)
+
+    def test_reserve_gapless(self):
+        allocator = NumberAllocator(u'test', NumberAllocator.GAPLESS)
+        self.assertEqual(allocator.get_next(self.store, self.key), 1)
+        self.store.rollback(close=False)
+        self.assertEqual(allocator.get_next(self.store, self.key), 1)
+
+    def test_reserve_gaps_allowed(self):
+        allocator = NumberAllocator(u'test', NumberAllocator.GAPS_ALLOWED,
+                                    step=-1)
+        stores = []
+
+        @contextlib.contextmanager
+        def new_store():
+            # Use the test store, so nothing is committed
+            stores.append(self.store)
+            yield self.store
+
+        with mock.patch('stoqlib.database.allocator.new_store', new_store):
+            self.assertEqual(allocator.reserve(self.store, self.key, 2),
+                             [-1, -2])
+            allocator.set_last(self.store, self.key, -10)
+            self.assertEqual(allocator.get_next(self.store, self.key), -11)
+        # The numbers are reserved on a separate store every time
+        self.assertEqual(len(stores), 3)
+
+    def test_peek(self):
+        allocator = NumberAllocator(u'test', NumberAllocator.GAPLESS)
+
+        def initial(store):
+            return 10
+
+        self.assertEqual(allocator.peek(self.store, self.key), 1)
+        self.assertEqual(
+            allocator.peek(self.store, self.key, initial=initial), 11)
+        # Peeking doesn't reserve the number
+        self.assertEqual(
+            allocator.peek(self.store, self.key, initial=initial), 11)
+        self.assertEqual(
+            allocator.get_next(self.store, self.key, initial=initial), 11)
+        self.assertEqual(allocator.peek(self.store, self.key), 12)
@@ -29,6 +29,7 @@ import unittest
 from stoqlib.database.migration import StoqlibSchemaMigration
 from stoqlib.database.runtime import new_store
 from stoqlib.domain.person import Person
+from stoqlib.exceptions import DatabaseError
 
 from storm.exceptions import ClosedError
 
@@ -95,3 +96,104 @@ class DatabaseTest(unittest.TestCase):
         self.assertFalse(migration.check(check_plugins=True))
         check_plugins.return_value = True
         self.assertTrue(migration.check(check_plugins=True))
+
+    def test_patch_requires_psql(self):
+        migration = StoqlibSchemaMigration()
+        patches = dict((p.get_version(), p) for p in migration._get_patches())
+        # COPY FROM stdin and \set
+        self.assertTrue(patches[(3, 16)].requires_psql())
+        self.assertTrue(patches[(4, 20)].requires_psql())
+        self.assertFalse(patches[(6, 21)].requires_psql())
+        # COMMIT; ALTER TYPE ... ADD VALUE; BEGIN;
+        for version in [(5, 31), (5, 36), (5, 42), (5, 47), (5, 48),
+                        (6, 1), (6, 10)]:
+            self.assertTrue(patches[version].requires_psql())
+        # Python patches
+        self.assertFalse(patches[(1, 6)].requires_psql())
+
+    def test_patch_is_transactional(self):
+        migration = StoqlibSchemaMigration()
+        patches = dict((p.get_version(), p) for p in migration._get_patches())
+        self.assertTrue(patches[(6, 21)].is_transactional())
+        self.assertFalse(patches[(4, 20)].is_transactional())
+        # COMMIT; ALTER TYPE ... ADD VALUE; BEGIN;
+        self.assertFalse(patches[(5, 31)].is_transactional())
+        self.assertFalse(patches[(6, 10)].is_transactional())
+        # Python patches
+        self.assertFalse(patches[(1, 6)].is_transactional())
+
+    def test_patch_apply_sql(self):
+        migration = StoqlibSchemaMigration()
+        patches = dict((p.get_version(), p) for p in migration._get_patches())
+        store = mock.Mock()
+        notices = store._connection._raw_connection.notices = []
+        cursor = store._connection.build_raw_cursor.return_value
+
+        patches[(6, 21)].apply(store)
+        self.assertEqual(cursor.execute.call_count, 1)
+        cursor.close.assert_called_once_with()
+        # Python patches applied after it must not see stale objects
+        store.invalidate.assert_called_once_with()
+
+        # psql would fail on warnings
+        cursor.execute.side_effect = lambda data: notices.append(
+            'WARNING:  there is no transaction in progress\n')
+        store.invalidate.reset_mock()
+        with self.assertRaises(DatabaseError):
+            patches[(6, 21)].apply(store)
+        self.assertFalse(store.invalidate.called)
+
+    @mock.patch('stoqlib.database.migration.new_store')
+    def test_apply_patches(self, new_store):
+        store = new_store.return_value.__enter__.return_value
+        migration = StoqlibSchemaMigration()
+        patches = []
+        for level, requires_psql in [(1, False), (2, True), (3, False)]:
+            patch = mock.Mock(generation=99, level=level)
+            patch.requires_psql.return_value = requires_psql
+            patches.append(patch)
+
+        log_patch = mock.Mock()
+        timings = migration._apply_patches(patches, log_patch)
+
+        self.assertEqual([p for p, elapsed in timings], patches)
+        self.assertEqual(log_patch.call_args_list,
+                         [mock.call(i, p) for i, p in enumerate(patches)])
+        for patch in patches:
+            patch.apply.assert_called_once_with(store)
+        # The patches applied before the psql one are committed first
+        store.commit.assert_called_once_with()
+        self.assertEqual(new_store.call_count, 1)
+
+    @mock.patch('stoqlib.database.migration.StoqlibSchemaMigration._get_plugins')
+    @mock.patch('stoqlib.database.migration.SchemaMigration._get_pending_patches')
+    def test_needs_backup(self, get_pending_patches, get_plugins):
+        migration = StoqlibSchemaMigration()
+        transactional = mock.Mock()
+        transactional.is_transactional.return_value = True
+        other = mock.Mock()
+        other.is_transactional.return_value = False
+
+        get_plugins.return_value = []
+        get_pending_patches.return_value = [transactional, transactional]
+        self.assertFalse(migration._needs_backup(plugins=True))
+        get_pending_patches.return_value = [transactional, other]
+        self.assertTrue(migration._needs_backup(plugins=True))
+
+        plugin_migration = mock.Mock()
+        plugin_migration._get_pending_patches.return_value = [other]
+        plugin = mock.Mock()
+        plugin.get_migration.return_value = plugin_migration
+        get_plugins.return_value = [plugin]
+        get_pending_patches.return_value = [transactional]
+        self.assertTrue(migration._needs_backup(plugins=True))
+        self.assertFalse(migration._needs_backup(plugins=False))
+
+        # stoqlib and the plugin are committed separately
+        plugin_migration._get_pending_patches.return_value = [transactional]
+        self.assertTrue(migration._needs_backup(plugins=True))
+        plugin_migration._get_pending_patches.return_value = []
+        self.assertFalse(migration._needs_backup(plugins=True))
+        get_pending_patches.return_value = []
+        plugin_migration._get_pending_patches.return_value = [transactional]
+        self.assertFalse(migration._needs_backup(plugins=True))
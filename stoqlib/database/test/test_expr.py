@@ -28,7 +28,8 @@ import datetime
 
 from storm.expr import Cast, Sum
 
-from stoqlib.database.expr import Case, Between, GenerateSeries, Field, Over
+from stoqlib.database.expr import (Case, Between, GenerateSeries, Field, Over,
+                                   date_range)
 from stoqlib.domain.event import Event
 from stoqlib.domain.test.domaintest import DomainTest
 
@@ -59,6 +60,26 @@ class ViewableTest(DomainTest):
               event_type=Event.TYPE_SYSTEM, description=u'')
         self.assertEqual(self.store.find(Event, query).count(), 2)
 
+    def test_date_range(self):
+        self.clean_domain([Event])
+        self.assertIsNone(date_range(Event.date))
+
+        # The time part of start and end is ignored
+        query = date_range(Event.date, datetime.datetime(2012, 1, 5, 12),
+                           datetime.date(2012, 1, 10))
+        for date in [datetime.datetime(2012, 1, 4, 23, 59, 59),
+                     datetime.datetime(2012, 1, 5),
+                     datetime.datetime(2012, 1, 10, 23, 59, 59),
+                     datetime.datetime(2012, 1, 11)]:
+            Event(store=self.store, date=date,
+                  event_type=Event.TYPE_SYSTEM, description=u'')
+        self.assertEqual(self.store.find(Event, query).count(), 2)
+
+        query = date_range(Event.date, start=datetime.date(2012, 1, 10))
+        self.assertEqual(self.store.find(Event, query).count(), 2)
+        query = date_range(Event.date, end=datetime.date(2012, 1, 10))
+        self.assertEqual(self.store.find(Event, query).count(), 3)
+
     def test_generate_series_date(self):
         a = datetime.datetime(2012, 1, 1)
         b = datetime.datetime(2012, 4, 1)
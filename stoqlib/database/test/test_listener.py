@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.listener`"""
+
+import queue
+
+import mock
+
+from stoqlib.database.listener import NotifyListener
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class NotifyListenerTest(DomainTest):
+
+    def _notify(self, *payloads):
+        store = new_store()
+        for payload in payloads:
+            store.execute("SELECT pg_notify('test_listener', ?)", (payload, ))
+        store.commit(close=True)
+
+    def test_listen(self):
+        received = queue.Queue()
+
+        def callback(conn, channel, payloads):
+            # The connection can be used to query the database
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            self.assertEqual(cursor.fetchone(), (1, ))
+            received.put((channel, payloads))
+
+        listener = NotifyListener(['test_listener'], callback)
+        listener.start()
+        try:
+            # Wait for the listener to connect
+            with mock.patch('stoqlib.database.listener.log') as log:
+                for i in range(50):
+                    self._notify(u'ping')
+                    try:
+                        received.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    break
+                self.assertFalse(log.warning.called)
+
+            self._notify(u'foo', u'bar', u'foo')
+            channel, payloads = received.get(timeout=5)
+            # Some late pings may still be arriving
+            while payloads == set([u'ping']):
+                channel, payloads = received.get(timeout=5)
+            self.assertEqual(channel, 'test_listener')
+            self.assertEqual(payloads - set([u'ping']), set([u'foo', u'bar']))
+        finally:
+            listener.stop()
+            listener.join()
+        self.assertTrue(listener.is_stopped())
+
+    def test_notify_on_connect(self):
+        received = queue.Queue()
+        listener = NotifyListener(
+            ['test_listener'],
+            lambda conn, channel, payloads: received.put((channel, payloads)),
+            notify_on_connect=True)
+        listener.start()
+        try:
+            self.assertEqual(received.get(timeout=5), ('test_listener', None))
+        finally:
+            listener.stop()
+            listener.join()
+
+    def test_callback_error(self):
+        listener = NotifyListener(['test_listener'], mock.Mock(
+            side_effect=ValueError))
+        with mock.patch('stoqlib.database.listener.log') as log:
+            listener._notify(None, 'test_listener', set([u'foo']))
+            log.exception.assert_called_once_with(
+                "Error handling notifications on %s", 'test_listener')
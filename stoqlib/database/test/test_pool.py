@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.pool`"""
+
+import threading
+import unittest
+
+import mock
+
+from stoqlib.database.pool import (ConnectionPool, PooledDatabase,
+                                   PoolTimeoutError)
+
+
+class _FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeDatabase(object):
+    def __init__(self):
+        self.connections = []
+
+    def raw_connect(self):
+        conn = _FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = _FakeDatabase()
+
+    def test_acquire_reuses_connection(self):
+        setup = mock.Mock()
+        pool = ConnectionPool(self.database, setup_connection=setup)
+
+        conn = pool.acquire()
+        self.assertEqual(pool.get_stats()['in_use'], 1)
+        setup.assert_called_once_with(conn)
+
+        pool.release(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertFalse(conn.closed)
+
+        self.assertIs(pool.acquire(), conn)
+        # The connection was already setup
+        self.assertEqual(setup.call_count, 1)
+        self.assertEqual(len(self.database.connections), 1)
+        self.assertEqual(pool.get_stats(),
+                         dict(hits=1, misses=1, waits=0, idle=0, in_use=1))
+
+    def test_release_pool_full(self):
+        pool = ConnectionPool(self.database, size=1)
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+
+        pool.release(conn1)
+        pool.release(conn2)
+        self.assertFalse(conn1.closed)
+        self.assertTrue(conn2.closed)
+        self.assertEqual(pool.get_stats()['idle'], 1)
+
+    def test_release_broken_connection(self):
+        pool = ConnectionPool(self.database)
+        conn = pool.acquire()
+        conn.rollback = mock.Mock(side_effect=Exception('connection lost'))
+
+        pool.release(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.get_stats()['idle'], 0)
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(self.database, idle_timeout=10)
+        with mock.patch('stoqlib.database.pool.time.monotonic') as monotonic:
+            monotonic.return_value = 100
+            conn = pool.acquire()
+            pool.release(conn)
+
+            monotonic.return_value = 111
+            self.assertIsNot(pool.acquire(), conn)
+            self.assertTrue(conn.closed)
+
+    def test_max_connections(self):
+        pool = ConnectionPool(self.database, max_connections=1,
+                              wait_timeout=0)
+        conn = pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+        self.assertEqual(pool.get_stats()['waits'], 1)
+
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+
+    def test_max_connections_wait(self):
+        pool = ConnectionPool(self.database, max_connections=1)
+        conn = pool.acquire()
+
+        timer = threading.Timer(0.1, pool.release, args=(conn, ))
+        timer.start()
+        self.assertIs(pool.acquire(), conn)
+        timer.join()
+        self.assertEqual(pool.get_stats()['waits'], 1)
+
+    def test_close(self):
+        pool = ConnectionPool(self.database)
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+        pool.release(conn1)
+
+        pool.close()
+        self.assertTrue(conn1.closed)
+        self.assertFalse(conn2.closed)
+        with self.assertRaises(ValueError):
+            pool.acquire()
+
+        # Connections released after closing the pool are closed
+        pool.release(conn2)
+        self.assertTrue(conn2.closed)
+
+
+class PooledDatabaseTest(unittest.TestCase):
+
+    def test_connect(self):
+        database = _FakeDatabase()
+        database.connection_factory = mock.Mock()
+        pool = ConnectionPool(database)
+        pooled = PooledDatabase(database, pool)
+
+        pooled.connect('event')
+        database.connection_factory.assert_called_once_with(pooled, 'event')
+
+        conn = pooled.raw_connect()
+        self.assertEqual(database.connections, [conn])
+        self.assertEqual(pool.get_stats()['in_use'], 1)
+        # Everything else is delegated to the real database
+        self.assertIs(pooled.connections, database.connections)
@@ -23,12 +23,24 @@
 ##
 """ This module tests stoq/database/database.py """
 
+import time
+
 import mock
+import psycopg2
+from storm.expr import And, Desc, SQL, Select, State, compile
 
 from stoqlib.domain.test.domaintest import DomainTest
-from stoqlib.domain.person import ClientCategory
+from stoqlib.domain.person import ClientCategory, Company, Person
+from stoqlib.domain.product import ProductManufacturer
+from stoqlib.domain.sale import Sale
+from stoqlib.domain.sellable import Sellable, SellableCategory
 from stoqlib.database.queryexecuter import (QueryExecuter,
-                                            StringQueryState)
+                                            DateQueryState,
+                                            DateIntervalQueryState,
+                                            StringQueryState,
+                                            AsyncQueryOperation,
+                                            _OperationExecuter)
+from stoqlib.lib.dateutils import localdate, localdatetime
 
 
 class QueryExecuterTest(DomainTest):
@@ -135,3 +147,203 @@ class QueryExecuterTest(DomainTest):
         finally:
             self.clean_domain([ClientCategory])
             self.store.commit()
+
+    def test_search_async_cancel_executing(self):
+        executer = self.qe._operation_executer
+        operation = AsyncQueryOperation(self.store,
+                                        self.store.find(ClientCategory),
+                                        SQL("SELECT pg_sleep(60)"))
+        executer.schedule(operation)
+        while operation.status == AsyncQueryOperation.STATUS_WAITING:
+            time.sleep(0.01)
+        # Give some time for the query to reach the server
+        time.sleep(0.5)
+
+        start = time.time()
+        operation.cancel()
+        executer._queue.join()
+        # The query was cancelled on the server, so we didn't have to
+        # wait for it to finish
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(operation.status, AsyncQueryOperation.STATUS_CANCELLED)
+        self.assertTrue(operation.cancel_sent)
+        # The connection that received the cancel request is not reused
+        for worker in executer._workers:
+            self.assertNotEqual(worker._conn, operation._async_cursor.connection)
+
+        # The worker can still be used to execute other queries
+        self.assertEqual(len(self._search_string_all_async(u'eye')), 0)
+
+    def test_search_async_error(self):
+        executer = self.qe._operation_executer
+        operation = AsyncQueryOperation(self.store,
+                                        self.store.find(ClientCategory),
+                                        SQL("SELECT * FROM does_not_exist"))
+        with mock.patch('stoqlib.database.queryexecuter.GLib') as glib:
+            executer.schedule(operation)
+            executer._queue.join()
+
+        self.assertEqual(operation.status, AsyncQueryOperation.STATUS_FAILED)
+        self.assertIsInstance(operation.error, psycopg2.ProgrammingError)
+        # The finish signal will be emitted so the caller can report it
+        glib.idle_add.assert_called_once_with(operation._on_finish)
+
+        # The worker can still be used to execute other queries
+        self.assertEqual(len(self._search_string_all_async(u'eye')), 0)
+
+    def test_schedule_replaces_waiting_operation(self):
+        # No workers, so the operations will stay on the queue
+        executer = _OperationExecuter(workers=0)
+        resultset = self.store.find(ClientCategory)
+
+        op1 = AsyncQueryOperation(self.store, resultset, SQL("SELECT 1"))
+        executer.schedule(op1, owner=self.qe)
+        op2 = AsyncQueryOperation(self.store, resultset, SQL("SELECT 2"))
+        executer.schedule(op2, owner=self.qe)
+        self.assertEqual(op1.status, AsyncQueryOperation.STATUS_CANCELLED)
+        self.assertEqual(op2.status, AsyncQueryOperation.STATUS_WAITING)
+
+        # Operations from other owners are not affected
+        other_qe = QueryExecuter(self.store)
+        op3 = AsyncQueryOperation(self.store, resultset, SQL("SELECT 3"))
+        executer.schedule(op3, owner=other_qe)
+        self.assertEqual(op2.status, AsyncQueryOperation.STATUS_WAITING)
+        self.assertEqual(op3.status, AsyncQueryOperation.STATUS_WAITING)
+
+    def _get_sale_query(self, state):
+        qe = QueryExecuter(self.store)
+        qe.set_search_spec(Sale)
+        qe.set_filter_columns(self.sfilter, ['open_date'])
+        queries, having = qe.parse_states([state])
+        return And(*queries)
+
+    def test_date_query(self):
+        sale1 = self.create_sale()
+        sale1.open_date = localdatetime(2012, 1, 1)
+        sale2 = self.create_sale()
+        sale2.open_date = localdatetime(2012, 1, 1, 23, 59, 59)
+        sale3 = self.create_sale()
+        sale3.open_date = localdatetime(2012, 1, 2)
+        sale4 = self.create_sale()
+        sale4.open_date = localdatetime(2012, 1, 3, 12)
+
+        def search(state):
+            return set(self.store.find(
+                Sale, self._get_sale_query(state),
+                Sale.id.is_in([sale1.id, sale2.id, sale3.id, sale4.id])))
+
+        self.assertEqual(
+            search(DateQueryState(filter=self.sfilter,
+                                  date=localdate(2012, 1, 1).date())),
+            set([sale1, sale2]))
+        # The time part of the date is ignored
+        self.assertEqual(
+            search(DateQueryState(filter=self.sfilter,
+                                  date=localdatetime(2012, 1, 1, 12))),
+            set([sale1, sale2]))
+        self.assertEqual(
+            search(DateIntervalQueryState(filter=self.sfilter,
+                                          start=localdate(2012, 1, 1).date(),
+                                          end=localdate(2012, 1, 2).date())),
+            set([sale1, sale2, sale3]))
+        self.assertEqual(
+            search(DateIntervalQueryState(filter=self.sfilter,
+                                          start=localdate(2012, 1, 2).date(),
+                                          end=None)),
+            set([sale3, sale4]))
+        self.assertEqual(
+            search(DateIntervalQueryState(filter=self.sfilter,
+                                          start=None,
+                                          end=localdate(2012, 1, 2).date())),
+            set([sale1, sale2, sale3]))
+
+    def test_date_query_plan(self):
+        state = State()
+        query = self._get_sale_query(
+            DateIntervalQueryState(filter=self.sfilter,
+                                   start=localdate(2012, 1, 1).date(),
+                                   end=localdate(2012, 1, 31).date()))
+        statement = compile(Select(Sale.id, where=query, tables=Sale), state)
+
+        # The test database is too small for the planner to prefer an index
+        # over a sequential scan, so make the sequential scan very expensive
+        self.store.execute("SET LOCAL enable_seqscan = off")
+        plan = self.store.execute("EXPLAIN " + statement,
+                                  state.parameters).get_all()
+        self.assertIn('sale_open_date_idx',
+                      '\n'.join(line for line, in plan))
+
+    def test_string_query_plan(self):
+        # The test database is too small for the planner to prefer an index
+        # over a sequential scan, so make the sequential scan very expensive
+        self.store.execute("SET LOCAL enable_seqscan = off")
+        for spec, column, index in [
+                (Sellable, 'description', 'sellable_description_normalized_idx'),
+                (Sellable, 'code', 'sellable_code_normalized_idx'),
+                (Sellable, 'barcode', 'sellable_barcode_normalized_idx'),
+                (SellableCategory, 'description',
+                 'sellable_category_description_normalized_idx'),
+                (Person, 'name', 'person_name_normalized_idx'),
+                (Company, 'fancy_name', 'company_fancy_name_normalized_idx'),
+                (ProductManufacturer, 'name',
+                 'product_manufacturer_name_normalized_idx')]:
+            state = StringQueryState(filter=self.sfilter,
+                                     mode=StringQueryState.CONTAINS_ALL,
+                                     text=u'p\xe3o de queijo')
+            query = self.qe._parse_string_state(state, getattr(spec, column))
+            state = State()
+            statement = compile(Select(spec.id, where=query, tables=spec), state)
+            plan = self.store.execute("EXPLAIN " + statement,
+                                      state.parameters).get_all()
+            self.assertIn(index, '\n'.join(line for line, in plan))
+
+    def test_get_estimated_count(self):
+        for i in range(10):
+            self.create_client_category(u'category %d' % i)
+        self.store.execute("ANALYZE client_category")
+
+        result = self.store.find(ClientCategory)
+        # This is just an estimate, it doesn't need to be exact
+        count = result.count()
+        self.assertAlmostEqual(self.qe.get_estimated_count(result), count,
+                               delta=count // 2)
+
+    def test_supports_keyset(self):
+        self.assertTrue(self.qe.supports_keyset('name'))
+        self.assertTrue(self.qe.supports_keyset('max_discount'))
+        # Only columns can be used to filter the query
+        self.assertFalse(self.qe.supports_keyset('get_description'))
+
+    def test_get_keyset_page(self):
+        for i, max_discount in enumerate([10, 10, None, 5, 10, None, 20]):
+            category = self.create_client_category(u'category %d' % i)
+            category.max_discount = max_discount
+
+        result = self.store.find(ClientCategory)
+        for descending in [False, True]:
+            if descending:
+                order_by = (Desc(ClientCategory.max_discount),
+                            Desc(ClientCategory.id))
+            else:
+                order_by = (ClientCategory.max_discount, ClientCategory.id)
+            expected = list(result.order_by(*order_by))
+
+            items = []
+            after = None
+            while True:
+                page = self.qe.get_keyset_page(result, 'max_discount', 2,
+                                               after=after,
+                                               descending=descending)
+                if not page:
+                    break
+                items.extend(page)
+                after = self.qe.get_keyset_key(page[-1], 'max_discount')
+            self.assertEqual(items, expected)
+
+            # Jumping to rows after the last known key
+            after = self.qe.get_keyset_key(expected[1], 'max_discount')
+            self.assertEqual(
+                self.qe.get_keyset_page(result, 'max_discount', 2,
+                                        after=after, offset=2,
+                                        descending=descending),
+                expected[4:6])
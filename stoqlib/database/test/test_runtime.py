@@ -25,10 +25,13 @@
 """Tests for module :class:`stoqlib.database.runtime`"""
 
 import mock
+from storm.info import get_obj_info
+from storm.store import AutoReload
 
 from stoqlib.database.exceptions import InterfaceError
 from stoqlib.database.properties import UnicodeCol
-from stoqlib.database.runtime import new_store, StoqlibStore, autoreload_object
+from stoqlib.database.runtime import (new_store, StoqlibStore, autoreload_object,
+                                      get_pooled_database)
 from stoqlib.domain.base import Domain
 from stoqlib.domain.person import Person, Client, ClientView
 from stoqlib.domain.test.domaintest import DomainTest
@@ -301,6 +304,23 @@ class StoqlibStoreTest(DomainTest):
         self.assertRaises(InterfaceError, store.savepoint, 'XXX')
         self.assertRaises(InterfaceError, store.rollback_to_savepoint, 'XXX')
 
+    def test_close_returns_connection_to_pool(self):
+        pool = get_pooled_database().pool
+        store = new_store()
+        raw_connection = store._connection._raw_connection
+        store.execute("SELECT 1")
+        store.close()
+
+        hits = pool.hits
+        store = new_store()
+        self.assertIs(store._connection._raw_connection, raw_connection)
+        self.assertEqual(pool.hits, hits + 1)
+        # The application name was set when the connection was created
+        # and survives the reset done when releasing it
+        application_name = store.execute("SHOW application_name").get_one()[0]
+        self.assertTrue(application_name.startswith('stoq'))
+        store.close()
+
     def test_autoreload(self):
         # Create 3 stores.
         store1 = new_store()
@@ -316,6 +336,66 @@ class StoqlibStoreTest(DomainTest):
 
         autoreload_object(obj1)
 
+    def test_commit_autoreloads_changed_objects(self):
+        store1 = new_store()
+        store2 = new_store()
+
+        obj1 = WillBeCommitted(store=store1, test_var=u'ID1')
+        obj2 = WillBeCommitted(store=store1, test_var=u'ID2')
+        store1.commit()
+
+        other1 = store2.get(WillBeCommitted, obj1.id)
+        other2 = store2.get(WillBeCommitted, obj2.id)
+        self.assertEqual(other1.test_var, u'ID1')
+        self.assertEqual(other2.test_var, u'ID2')
+
+        obj1.test_var = u'ID1+'
+        store1.commit()
+        # Only the object that changed was marked for autoreload
+        variables = get_obj_info(other2).variables
+        self.assertIsNot(variables[WillBeCommitted.test_var].get_lazy(),
+                         AutoReload)
+        self.assertEqual(other1.test_var, u'ID1+')
+
+        # We can't know which rows a ResultSet.set() changed, so every
+        # object of that class is reloaded
+        store1.find(WillBeCommitted, id=obj2.id).set(test_var=u'ID2+')
+        store1.commit()
+        self.assertEqual(other2.test_var, u'ID2+')
+
+        store1.close()
+        store2.close()
+
+    def test_commit_autoreloads_changed_outside_orm(self):
+        store1 = new_store()
+        store2 = new_store()
+
+        obj1 = WillBeCommitted(store=store1, test_var=u'ID1')
+        obj2 = WillBeCommitted(store=store1, test_var=u'ID2')
+        store1.commit()
+        other1 = store2.get(WillBeCommitted, obj1.id)
+        other2 = store2.get(WillBeCommitted, obj2.id)
+        self.assertEqual(other1.test_var, u'ID1')
+        self.assertEqual(other2.test_var, u'ID2')
+
+        # Changes done by raw SQL (or by triggers) are only visible to the
+        # other stores after the commit, so they need to reload the objects
+        # again after it
+        store1.execute("UPDATE will_be_committed SET test_var = 'ID1+' "
+                       "WHERE id = ?", (obj1.id, ))
+        autoreload_object(obj1, obj_store=True)
+        self.assertEqual(other1.test_var, u'ID1')
+        store1.commit()
+        self.assertEqual(other1.test_var, u'ID1+')
+
+        store1.execute("UPDATE will_be_committed SET test_var = 'ID2+'")
+        store1.mark_bulk_changed(WillBeCommitted)
+        store1.commit()
+        self.assertEqual(other2.test_var, u'ID2+')
+
+        store1.close()
+        store2.close()
+
     def test_transaction_commit_hook(self):
         # Dummy will only be asserted for creation on the first commit.
         # After that it should pass all assert for nothing made.
@@ -462,3 +542,53 @@ class TestStoqlibResultSet(DomainTest):
         for obj, tpl in zip(results, results.fast_iter()):
             for prop in ['name', 'status', 'cpf']:
                 self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_fast_iter_batch_size(self):
+        results = self.store.find(Person).order_by(Person.te_id)
+        # Make sure there are more results than the batch size
+        assert results.count() > 3
+        self.assertEqual(
+            [tpl.id for tpl in results.fast_iter(batch_size=3)],
+            [obj.id for obj in results])
+
+        # The cursor was closed
+        self.assertEqual(self.store.execute(
+            "SELECT COUNT(*) FROM pg_cursors").get_one()[0], 0)
+
+    def test_fast_iter_batch_size_viewable(self):
+        results = self.store.find(ClientView).order_by(Client.te_id)
+        self.assertTrue(results.is_viewable())
+        self.assertFalse(self.store.find(Person).is_viewable())
+
+        for obj, tpl in zip(results, results.fast_iter(batch_size=2)):
+            for prop in ['name', 'status', 'cpf']:
+                self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_iter_pages(self):
+        results = self.store.find(Person).order_by(Person.name)
+        # Make sure there are more results than the page size
+        assert results.count() > 3
+        items = list(results.iter_pages(3))
+        self.assertEqual(len(items), results.count())
+        self.assertEqual(set(items), set(results))
+        self.assertEqual([obj.name for obj in items],
+                         [obj.name for obj in results])
+
+        # The query is executed only once, without paging it with OFFSET
+        with self.count_tracer() as tracer:
+            list(results.iter_pages(3))
+        self.assertFalse([s for s in tracer.statements if 'OFFSET' in s])
+        self.assertEqual(
+            len([s for s in tracer.statements if s.startswith('DECLARE')]), 1)
+
+        # The cursor was closed
+        self.assertEqual(self.store.execute(
+            "SELECT COUNT(*) FROM pg_cursors").get_one()[0], 0)
+
+    def test_iter_pages_viewable(self):
+        results = self.store.find(ClientView).order_by(Client.te_id)
+        items = list(results.iter_pages(2))
+        # The viewables themselves, not the fast_iter tuples
+        self.assertTrue(all(isinstance(item, ClientView) for item in items))
+        self.assertEqual([item.id for item in items],
+                         [item.id for item in results])
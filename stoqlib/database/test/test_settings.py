@@ -25,6 +25,8 @@
 """Tests for module :class:`stoqlib.database.settings`"""
 
 import os
+import shutil
+import tempfile
 
 import mock
 
@@ -181,3 +183,64 @@ class DatabaseSettingsTest(DomainTest):
                          ['-U', 'username',
                           '-h', 'address',
                           '-p', '12345'])
+
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_dump_database(self, Process):
+        Process.return_value.wait.return_value = 0
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345',
+                                    dbname='stoq')
+        self.assertTrue(settings.dump_database('dump.sql', format='plain',
+                                               no_owner=True))
+        Process.assert_called_once_with(
+            ['pg_dump', '--format=plain', '--encoding=UTF-8',
+             '--no-owner', '--no-privileges', '-f', 'dump.sql',
+             '-U', 'username', '-h', 'address', '-p', '12345', 'stoq'])
+
+    @mock.patch('stoqlib.database.settings.time.sleep')
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_dump_database_directory(self, Process, sleep):
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345',
+                                    dbname='stoq')
+        dump = os.path.join(tempfile.mkdtemp(), 'dump')
+        self.addCleanup(shutil.rmtree, os.path.dirname(dump))
+
+        def poll():
+            # Write a table to the dump each time
+            if not os.path.exists(dump):
+                os.mkdir(dump)
+            tables = len(os.listdir(dump))
+            if tables == 2:
+                return 0
+            with open(os.path.join(dump, '%d.dat' % tables), 'wb') as f:
+                f.write(b'x' * 10)
+        Process.return_value.poll.side_effect = poll
+        Process.return_value.wait.return_value = 0
+
+        callback = mock.Mock()
+        self.assertTrue(settings.dump_database(dump, format='directory',
+                                               jobs=4,
+                                               progress_callback=callback))
+        Process.assert_called_once_with(
+            ['pg_dump', '--format=directory', '--encoding=UTF-8',
+             '--jobs=4', '-f', dump,
+             '-U', 'username', '-h', 'address', '-p', '12345', 'stoq'])
+        self.assertEqual(callback.call_args_list,
+                         [mock.call(10), mock.call(20)])
+
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_restore_database(self, Process):
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345',
+                                    dbname='stoq')
+        self.assertEqual(settings.restore_database('dump', new_name='restored',
+                                                   clean_first=False, jobs=4),
+                         'restored')
+        Process.assert_called_once_with(
+            ['pg_restore', '-d', 'restored', '--jobs=4',
+             '-U', 'username', '-h', 'address', '-p', '12345', 'dump'],
+            stderr=mock.ANY)
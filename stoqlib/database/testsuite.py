@@ -69,14 +69,17 @@ class StoqlibTestsuiteTracer(object):
 
     def reset(self):
         self.count = 0
+        self.statements = []
 
     def connection_raw_execute_success(self, connection, raw_cursor,
                                        statement, params):
         self.count += 1
+        self.statements.append(statement)
 
     def connection_raw_execute_error(self, connection, raw_cursor,
                                      statement, params, error):
         self.count += 1
+        self.statements.append(statement)
 
 
 # This notifier implementation is here to workaround trial; which
@@ -37,6 +37,7 @@ from storm.properties import Property
 from storm.references import Reference
 from storm.store import AutoReload, PENDING_ADD, PENDING_REMOVE
 
+from stoqlib.database.allocator import NumberAllocator
 from stoqlib.database.expr import CharLength, Field, LPad, UnionAll
 from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import IntCol, IdCol, UnicodeCol, Identifier
@@ -50,6 +51,10 @@ log = logging.getLogger(__name__)
  _OBJ_DELETED,
  _OBJ_UPDATED) = range(3)
 
+_temporary_identifiers = NumberAllocator(u'temporary_identifier',
+                                         NumberAllocator.GAPS_ALLOWED,
+                                         step=-1)
+
 
 class Domain(ORMObject):
     """The base domain for Stoq.
@@ -418,9 +423,17 @@ class Domain(ORMObject):
 
         The sincronizer will be responsible for setting the definitive
         identifier once the order arives at the destination
+
+        The identifiers are reserved on a separate transaction, so two
+        stations never get the same one, but they are not reused if *store*
+        is rolled back.
         """
-        lower_value = store.find(cls).min(cls.identifier)
-        return min(lower_value or 0, 0) - 1
+        def get_lowest(allocation_store):
+            lower_value = allocation_store.find(cls).min(cls.identifier)
+            return min(lower_value or 0, 0)
+
+        return _temporary_identifiers.get_next(
+            store, cls.__storm_table__, initial=get_lowest)
 
     @classmethod
     def find_distinct_values(cls, store, attr, exclude_empty=True):
@@ -45,6 +45,26 @@ from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
 
+# The commission values of each sellable, from its own commission source
+# or from the one of the nearest category up in the category tree
+_SELLABLES_VALUES_QUERY = """
+    WITH RECURSIVE ancestors(sellable_id, category_id, depth) AS (
+        SELECT id, category_id, 1 FROM sellable WHERE id IN (%(ids)s)
+        UNION ALL
+        SELECT a.sellable_id, c.category_id, a.depth + 1
+          FROM sellable_category c JOIN ancestors a ON c.id = a.category_id)
+    SELECT DISTINCT ON (sellable_id) sellable_id, direct_value,
+           installments_value
+      FROM (SELECT sellable_id, 0 AS depth, direct_value, installments_value
+              FROM commission_source WHERE sellable_id IN (%(ids)s)
+            UNION ALL
+            SELECT a.sellable_id, a.depth, s.direct_value,
+                   s.installments_value
+              FROM ancestors a
+              JOIN commission_source s ON s.category_id = a.category_id)
+           AS sources
+     ORDER BY sellable_id, depth"""
+
 
 class CommissionSource(Domain):
     """Commission Source object implementation
@@ -81,6 +101,32 @@ class CommissionSource(Domain):
     #: the |sellable|
     sellable = Reference(sellable_id, 'Sellable.id')
 
+    @classmethod
+    def get_sellables_values(cls, store, sellable_ids):
+        """Get the commission values of some sellables
+
+        The values of a sellable come from its own commission source or,
+        if it doesn't have one, from the one of its category or of the
+        nearest parent category that has one. They are all resolved
+        with a single query.
+
+        :param store: a store
+        :param sellable_ids: the ids of the |sellables|
+        :returns: a dict mapping the id of the sellables to a tuple with
+          their direct and installments values. The sellables without a
+          commission source are not included
+        """
+        sellable_ids = list(set(sellable_ids))
+        if not sellable_ids:
+            return {}
+
+        query = _SELLABLES_VALUES_QUERY % dict(
+            ids=', '.join(['?'] * len(sellable_ids)))
+        results = store.execute(query, sellable_ids * 2)
+        return dict((sellable_id, (direct_value, installments_value))
+                    for sellable_id, direct_value, installments_value
+                    in results)
+
 
 class Commission(Domain):
     """Commission object implementation
@@ -121,20 +167,51 @@ class Commission(Domain):
     #  Domain
     #
 
-    def __init__(self, store=None, **kwargs):
+    def __init__(self, store=None, item_rates=None, **kwargs):
         need_calculate_value = not 'value' in kwargs
         super(Commission, self).__init__(store=store, **kwargs)
         if need_calculate_value:
-            self._calculate_value()
+            self._calculate_value(item_rates)
+
+    #
+    #  Classmethods
+    #
+
+    @classmethod
+    def get_item_rates(cls, sale):
+        """Get the commission rates of each item of a sale
+
+        The result can be passed as *item_rates* when creating the
+        commissions of all the payments of *sale*, so the rates are only
+        resolved once.
+
+        :param sale: a |sale|
+        :returns: a list with a tuple for each item of the sale, with its
+          total, its direct rate and its installments rate
+        """
+        items = list(sale.get_items())
+        values = CommissionSource.get_sellables_values(
+            sale.store, [item.sellable_id for item in items])
+
+        item_rates = []
+        for item in items:
+            direct_value, installments_value = values.get(
+                item.sellable_id, (0, 0))
+            item_rates.append((item.get_total(),
+                               direct_value / Decimal(100),
+                               installments_value / Decimal(100)))
+        return item_rates
 
     #
     #  Private
     #
 
-    def _calculate_value(self):
+    def _calculate_value(self, item_rates=None):
         """Calculates the commission amount to be paid"""
+        if item_rates is None:
+            item_rates = self.get_item_rates(self.sale)
 
-        relative_percentage = self._get_payment_percentage()
+        relative_percentage = self._get_payment_percentage(item_rates)
 
         # The commission is calculated for all sellable items
         # in sale; a relative percentage is given for each payment
@@ -146,51 +223,26 @@ class Commission(Domain):
         #   sales person is also going to be 20% and 80% of the complete
         #   commission amount for the sale when that specific payment is payed.
         value = Decimal(0)
-        for sellable_item in self.sale.get_items():
-            value += (self._get_commission(sellable_item.sellable) *
-                      sellable_item.get_total() *
-                      relative_percentage)
+        for total, direct_rate, installments_rate in item_rates:
+            if self.commission_type == self.DIRECT:
+                rate = direct_rate
+            else:
+                rate = installments_rate
+            value += rate * total * relative_percentage
 
         # The calculation above may have produced a number with more than two
         # digits. Round it to only two
         self.value = quantize(value)
 
-    def _get_payment_percentage(self):
+    def _get_payment_percentage(self, item_rates):
         """Return the payment percentage of sale"""
-        total = self.sale.get_sale_subtotal()
+        total = sum(total for total, direct_rate, installments_rate
+                    in item_rates)
         if total == 0:
             return 0
         else:
             return self.payment.value / total
 
-    def _get_commission(self, sellable):
-        """Return the properly commission percentage to be used to
-        calculate the commission amount, for a given sellable.
-        """
-
-        store = self.store
-        source = store.find(CommissionSource, sellable=sellable).one()
-        if not source and sellable.category:
-            source = self._get_category_commission(sellable.category)
-
-        value = 0
-        if source:
-            if self.commission_type == self.DIRECT:
-                value = source.direct_value
-            else:
-                value = source.installments_value
-            value /= Decimal(100)
-
-        return value
-
-    def _get_category_commission(self, category):
-        if category:
-            store = self.store
-            source = store.find(CommissionSource, category=category).one()
-            if not source:
-                return self._get_category_commission(category.category)
-            return source
-
 #
 # Views
 #
@@ -31,10 +31,11 @@ Note that this whole module is Brazil-specific.
 
 import collections
 
-from storm.expr import LeftJoin, Join, Or
+from storm.expr import In, LeftJoin, Join, Or
 from storm.references import Reference
 from zope.interface import implementer
 
+from stoqlib.database.allocator import NumberAllocator
 from stoqlib.database.expr import Date, TransactionTimestamp
 from stoqlib.database.properties import (UnicodeCol, DateTimeCol, IntCol, BoolCol,
                                          IdCol, EnumCol)
@@ -51,6 +52,8 @@ from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
 
+_invoice_numbers = NumberAllocator(u'invoice', NumberAllocator.GAPLESS)
+
 
 @implementer(IDescribable)
 class CfopData(Domain):
@@ -276,7 +279,79 @@ class Invoice(Domain):
 
     @classmethod
     def get_next_invoice_number(cls, store, branch: Branch, mode=None, series=None):
-        return Invoice.get_last_invoice_number(store, branch, series, mode) + 1
+        """Reserves the next invoice number
+
+        The number is reserved on *store*, and other stations reserving
+        a number for the same branch, mode and series will wait until it is
+        committed or rolled back, so no numbers are skipped.
+
+        :param store: a store
+        :param branch: the |branch| of the invoice
+        :param mode: one of the Invoice.mode
+        :param series: the series of the invoice
+        :returns: the invoice number
+        """
+        return cls.reserve_invoice_numbers(store, branch, 1, mode, series)[0]
+
+    @classmethod
+    def peek_next_invoice_number(cls, store, branch: Branch, mode=None,
+                                 series=None):
+        """Gets the next invoice number, without reserving it
+
+        Useful to suggest a number to the user, that should only be
+        reserved with :meth:`.get_next_invoice_number` when it is used, so
+        other stations don't wait while the user decides.
+
+        :param store: a store
+        :param branch: the |branch| of the invoice
+        :param mode: one of the Invoice.mode
+        :param series: the series of the invoice
+        :returns: the invoice number
+        """
+        def get_last(allocation_store):
+            return cls.get_last_invoice_number(allocation_store, branch,
+                                               series, mode)
+
+        number = _invoice_numbers.peek(
+            store, cls._get_allocation_key(branch, series, mode),
+            initial=get_last)
+        used = store.find(cls, invoice_number=number, branch=branch,
+                          series=series, mode=mode)
+        if used.is_empty():
+            return number
+        return get_last(store) + 1
+
+    @classmethod
+    def reserve_invoice_numbers(cls, store, branch: Branch, count, mode=None,
+                                series=None):
+        """Reserves a block of invoice numbers
+
+        Useful for stations that will issue invoices while offline.
+
+        :param store: a store
+        :param branch: the |branch| of the invoices
+        :param count: how many numbers to reserve
+        :param mode: one of the Invoice.mode
+        :param series: the series of the invoices
+        :returns: a list with the invoice numbers
+        """
+        def get_last(allocation_store):
+            return cls.get_last_invoice_number(allocation_store, branch,
+                                               series, mode)
+
+        key = cls._get_allocation_key(branch, series, mode)
+        numbers = _invoice_numbers.reserve(store, key, count,
+                                           initial=get_last)
+        used = store.find(cls, In(cls.invoice_number, numbers),
+                          branch=branch, series=series, mode=mode)
+        if used.is_empty():
+            return numbers
+
+        # Some of those numbers were used without being reserved, eg they
+        # were typed by the user, so continue from the last one used
+        last = get_last(store)
+        _invoice_numbers.set_last(store, key, last + count)
+        return list(range(last + 1, last + count + 1))
 
     @classmethod
     def get_last_invoice_number(cls, store, branch: Branch, series=None, mode=None):
@@ -290,6 +365,10 @@ class Invoice(Domain):
                           mode=mode).max(cls.invoice_number)
         return last or 0
 
+    @classmethod
+    def _get_allocation_key(cls, branch, series, mode):
+        return u'%s:%s:%s' % (branch.id, series, mode)
+
     @property
     def operation(self):
         from stoqlib.domain.loan import Loan
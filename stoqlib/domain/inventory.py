@@ -151,12 +151,15 @@ class InventoryItem(Domain):
     #  Public API
     #
 
-    def adjust(self, user: LoginUser, invoice_number):
+    def adjust(self, user: LoginUser, invoice_number, stock_queue=None):
         """Create an entry in fiscal book registering the adjustment
         with the related cfop data and change the product quantity
         available in stock.
 
         :param invoice_number: invoice number to register
+        :param stock_queue: a |stocktransactionqueue| or ``None``. If
+            provided, the stock change will be queued on it instead of being
+            applied right away, allowing to adjust lots of items at once
         """
         assert self.inventory.is_open()
         assert not self.is_adjusted
@@ -171,15 +174,22 @@ class InventoryItem(Domain):
         adjustment_qty = self.actual_quantity - self.recorded_quantity
         if not adjustment_qty:
             return
+
+        branch = self.inventory.branch
+        type_ = StockTransactionHistory.TYPE_INVENTORY_ADJUST
+        if stock_queue is not None:
+            if adjustment_qty > 0:
+                stock_queue.increase_stock(storable, adjustment_qty, branch,
+                                           type_, self.id, batch=self.batch)
+            else:
+                stock_queue.decrease_stock(storable, abs(adjustment_qty),
+                                           branch, type_, self.id,
+                                           batch=self.batch)
         elif adjustment_qty > 0:
-            storable.increase_stock(adjustment_qty,
-                                    self.inventory.branch,
-                                    StockTransactionHistory.TYPE_INVENTORY_ADJUST,
+            storable.increase_stock(adjustment_qty, branch, type_,
                                     self.id, user, batch=self.batch)
         else:
-            storable.decrease_stock(abs(adjustment_qty),
-                                    self.inventory.branch,
-                                    StockTransactionHistory.TYPE_INVENTORY_ADJUST,
+            storable.decrease_stock(abs(adjustment_qty), branch, type_,
                                     self.id, user, batch=self.batch)
 
         self._add_inventory_fiscal_entry(invoice_number)
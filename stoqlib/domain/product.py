@@ -89,6 +89,7 @@ from decimal import Decimal
 from kiwi.currency import currency
 from storm.references import Reference, ReferenceSet
 from storm.exceptions import NotOneError
+from storm.store import AutoReload
 from storm.expr import (And, Eq, LeftJoin, Alias, Sum, Coalesce, Select, Join,
                         Cast, Or, In)
 from zope.interface import implementer
@@ -97,6 +98,7 @@ from stoqlib.api import api
 from stoqlib.database.expr import (Field, TransactionTimestamp,
                                    ArrayAgg, Contains, IsContainedBy,
                                    SplitPart)
+from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import (BoolCol, DateTimeCol, DecimalCol,
                                          EnumCol, IdCol, IntCol, PercentCol,
                                          PriceCol, QuantityCol, UnicodeCol)
@@ -1148,6 +1150,31 @@ class ProductHistory(Domain):
             sold_date=TransactionTimestamp(),
             store=store)
 
+    @classmethod
+    def add_sold_items(cls, store, branch, product_sellable_items):
+        """Adds many |saleitems| to the history at once
+
+        This is the same as calling :meth:`.add_sold_item` for each of the
+        items, but all of them are inserted using a single statement.
+
+        :param store: a store
+        :param branch: the |branch|
+        :param product_sellable_items: a sequence of |saleitems| for the
+            sold |products|
+        """
+        if not product_sellable_items:
+            return
+
+        params = []
+        for item in product_sellable_items:
+            params.extend([branch.id, item.sellable_id, item.quantity])
+        rows = ', '.join(['(?, ?, ?, TRANSACTION_TIMESTAMP())'] *
+                         len(product_sellable_items))
+        store.execute("""
+            INSERT INTO product_history
+                (branch_id, sellable_id, quantity_sold, sold_date)
+            VALUES %s""" % (rows, ), params, noresult=True)
+
     @classmethod
     def add_received_item(cls, store, branch, receiving_order_item):
         """
@@ -1280,6 +1307,42 @@ class ProductStockItem(Domain):
                                batch=self.batch)
 
 
+class ProductStockSummary(ORMObject):
+    """The stock of a |storable| in a |branch|, considering all its batches
+
+    This is kept up to date by the database (see patch-06-19) every time
+    a |productstockitem| changes, so it should never be changed here. It
+    exists so that the stock views don't need to aggregate all the
+    |productstockitem| to know the stock of each |storable|.
+
+    Like :class:`stoqlib.domain.event.Event`, this is not a domain object
+    and doesn't have a ``te_id``: it only holds data derived from
+    |productstockitem|, which is what gets synchronized between
+    databases, and the summary is then rebuilt by the trigger on
+    the other side.
+    """
+
+    __storm_table__ = 'product_stock_summary'
+
+    id = IdCol(primary=True, default=AutoReload)
+
+    #: the sum of the quantities of the |productstockitem|
+    quantity = QuantityCol(default=0)
+
+    #: the sum of the quantity * stock_cost of the |productstockitem|
+    total_cost = DecimalCol(default=0)
+
+    storable_id = IdCol()
+
+    #: the |storable| of the stock items
+    storable = Reference(storable_id, 'Storable.id')
+
+    branch_id = IdCol()
+
+    #: the |branch| of the stock items
+    branch = Reference(branch_id, 'Branch.id')
+
+
 class Storable(Domain):
     '''Storable represents the stock of a |product|.
 
@@ -1819,6 +1882,7 @@ class StockTransactionHistory(Domain):
         self.store.flush()
         autoreload_object(self, obj_store=True)
         autoreload_object(self.product_stock_item, obj_store=True)
+        self.store.mark_bulk_changed(ProductStockSummary)
 
     def get_object(self):
         if self.type in [self.TYPE_INITIAL, self.TYPE_IMPORTED,
@@ -1926,6 +1990,236 @@ class StockTransactionHistory(Domain):
         return self.types[self.type] % number
 
 
+class _QueuedStockTransaction(object):
+    """A stock transaction queued on a :class:`StockTransactionQueue`"""
+
+    def __init__(self, storable, branch, batch, quantity, unit_cost,
+                 type, object_id, cost_center):
+        self.storable = storable
+        self.branch = branch
+        self.batch = batch
+        self.quantity = quantity
+        self.unit_cost = unit_cost
+        self.type = type
+        self.object_id = object_id
+        self.cost_center = cost_center
+
+        #: the |productstockitem| modified by the transaction. Only
+        #: available after :meth:`StockTransactionQueue.apply` is called
+        self.stock_item = None
+        #: the id of the created |stocktransactionhistory|. Only
+        #: available after :meth:`StockTransactionQueue.apply` is called
+        self.stock_transaction_id = None
+
+    @property
+    def key(self):
+        return (self.storable.id, self.branch.id,
+                self.batch.id if self.batch else None)
+
+
+class StockTransactionQueue(object):
+    """Queue stock transactions for many |storables| and apply them at once
+
+    :meth:`Storable.increase_stock` and :meth:`Storable.decrease_stock`
+    flush the store and reload the |productstockitem| for every
+    transaction, so that the trigger on stock_transaction_history runs.
+    When moving stock for lots of storables at once (e.g. confirming a
+    sale with lots of items) that costs a lot of round trips.
+
+    This does the same thing, but it checks the available stock for all
+    transactions in a single query, inserts all of them in a single
+    multi-row statement and refreshes the affected stock items together::
+
+        queue = StockTransactionQueue(store, user)
+        for item in items:
+            queue.decrease_stock(item.storable, item.quantity, branch,
+                                 StockTransactionHistory.TYPE_SELL, item.id)
+        queue.apply()
+
+    :param store: a store
+    :param user: the |loginuser| responsible for the transactions
+    """
+
+    def __init__(self, store, user: LoginUser):
+        self.store = store
+        self.user = user
+        self._queue = []
+
+    def __len__(self):
+        return len(self._queue)
+
+    #
+    #  Public API
+    #
+
+    def increase_stock(self, storable, quantity, branch, type, object_id,
+                       unit_cost=None, batch=None):
+        """Queue a stock increase
+
+        The arguments are the same as :meth:`Storable.increase_stock`
+
+        :returns: the queued transaction. After :meth:`.apply` is called,
+            its ``stock_item`` attribute will have the updated |productstockitem|
+        """
+        if quantity <= 0:
+            raise ValueError(_(u"quantity must be a positive number"))
+        return self._queue_transaction(storable, quantity, branch, type,
+                                       object_id, unit_cost=unit_cost,
+                                       batch=batch)
+
+    def decrease_stock(self, storable, quantity, branch, type, object_id,
+                       cost_center=None, batch=None):
+        """Queue a stock decrease
+
+        The arguments are the same as :meth:`Storable.decrease_stock`. The
+        available stock will only be checked when calling :meth:`.apply`
+
+        :returns: the queued transaction. After :meth:`.apply` is called,
+            its ``stock_item`` attribute will have the updated |productstockitem|
+        """
+        if quantity <= 0:
+            raise ValueError(_(u"quantity must be a positive number"))
+        return self._queue_transaction(storable, -quantity, branch, type,
+                                       object_id, cost_center=cost_center,
+                                       batch=batch)
+
+    def apply(self):
+        """Apply all the queued transactions
+
+        :returns: a list of the transactions that were applied
+        :raises: :exc:`stoqlib.exceptions.StockError` if there's not
+            enough stock for any of the decreases. In that case,
+            nothing will be applied
+        """
+        queue = self._queue
+        if not queue:
+            return []
+
+        # Make sure that everything the transactions reference is
+        # on the database before inserting them
+        self.store.flush()
+
+        stock_items = self._get_stock_items(queue)
+        # Simulate the quantities on the same order the transactions will be
+        # inserted (and the trigger will process them), so the checks are the
+        # same as the ones done by Storable.decrease_stock
+        quantities = dict((key, stock_item.quantity)
+                          for key, stock_item in stock_items.items())
+        # The stock costs are simulated too, since a decrease may come after
+        # an increase that will create the stock item or change its cost
+        costs = dict((key, stock_item.stock_cost)
+                     for key, stock_item in stock_items.items())
+        events = []
+        for transaction in queue:
+            key = transaction.key
+            old_quantity = quantities.get(key, 0)
+            new_quantity = old_quantity + transaction.quantity
+            if transaction.quantity < 0:
+                if new_quantity < 0:
+                    raise StockError(
+                        _('Quantity to decrease is greater than the available stock.'))
+                transaction.unit_cost = costs[key]
+            elif key not in costs:
+                costs[key] = transaction.unit_cost or 0
+            elif transaction.unit_cost is not None and new_quantity != 0:
+                costs[key] = ((old_quantity * costs[key] +
+                               transaction.quantity * transaction.unit_cost) /
+                              new_quantity)
+            quantities[key] = new_quantity
+            events.append((transaction, old_quantity, new_quantity))
+
+        self._queue = []
+        self._insert_transactions(queue)
+
+        # The trigger modified the stock items on the database. Mark the ones
+        # that are alive for reload and fetch all of them at once, which will
+        # also get the ones that were created by the trigger.
+        for stock_item in stock_items.values():
+            autoreload_object(stock_item, obj_store=True)
+        self.store.mark_bulk_changed(ProductStockSummary)
+        stock_items = self._get_stock_items(queue)
+        for transaction in queue:
+            transaction.stock_item = stock_items[transaction.key]
+
+        cost_center_transactions = dict(
+            (t.stock_transaction_id, t) for t in queue if t.cost_center)
+        if cost_center_transactions:
+            for stock_transaction in self.store.find(
+                    StockTransactionHistory,
+                    StockTransactionHistory.id.is_in(cost_center_transactions)):
+                transaction = cost_center_transactions[stock_transaction.id]
+                transaction.cost_center.add_stock_transaction(stock_transaction)
+
+        # Fetch all the products at once, they are needed by the event
+        products = dict((product.id, product) for product in self.store.find(
+            Product, Product.id.is_in(set(t.storable.id for t in queue))))
+        for transaction, old_quantity, new_quantity in events:
+            ProductStockUpdateEvent.emit(products[transaction.storable.id],
+                                         transaction.branch,
+                                         old_quantity, new_quantity)
+
+        return queue
+
+    #
+    #  Private
+    #
+
+    def _queue_transaction(self, storable, quantity, branch, type, object_id,
+                           unit_cost=None, cost_center=None, batch=None):
+        if branch is None:
+            raise ValueError(u"branch cannot be None")
+        # Avoid loading the sellable when the batch is ok, validate_batch
+        # only needs it to build the error message
+        if ((batch is not None) != storable.is_batch or
+                (batch is not None and batch.storable_id != storable.id)):
+            storable.validate_batch(batch, sellable=storable.product.sellable,
+                                    storable=storable)
+
+        transaction = _QueuedStockTransaction(
+            storable=storable, branch=branch, batch=batch, quantity=quantity,
+            unit_cost=unit_cost, type=type, object_id=object_id,
+            cost_center=cost_center)
+        self._queue.append(transaction)
+        return transaction
+
+    def _get_stock_items(self, queue):
+        storable_ids = set(t.storable.id for t in queue)
+        branch_ids = set(t.branch.id for t in queue)
+        keys = set(t.key for t in queue)
+        stock_items = self.store.find(
+            ProductStockItem,
+            And(ProductStockItem.storable_id.is_in(storable_ids),
+                ProductStockItem.branch_id.is_in(branch_ids)))
+
+        retval = {}
+        for stock_item in stock_items:
+            key = (stock_item.storable_id, stock_item.branch_id,
+                   stock_item.batch_id)
+            if key in keys:
+                retval[key] = stock_item
+        return retval
+
+    def _insert_transactions(self, queue):
+        columns = ['date', 'storable_id', 'branch_id', 'batch_id', 'quantity',
+                   'unit_cost', 'responsible_id', 'type', 'object_id']
+        date = localnow()
+        params = []
+        for t in queue:
+            params.extend([date, t.storable.id, t.branch.id,
+                           t.batch and t.batch.id, t.quantity, t.unit_cost,
+                           self.user and self.user.id, t.type, t.object_id])
+
+        # The update_stock_item_trigger will run for each row, in order,
+        # updating (or creating) their product_stock_item
+        row = '(%s)' % (', '.join('?' * len(columns)), )
+        query = """
+            INSERT INTO stock_transaction_history (%s) VALUES %s RETURNING id
+            """ % (', '.join(columns), ', '.join([row] * len(queue)))
+        result = self.store.execute(query, params)
+        for t, (stock_transaction_id, ) in zip(queue, result.get_all()):
+            t.stock_transaction_id = stock_transaction_id
+
+
 class ProductComponent(Domain):
     """A |product| and it's related |component| eg other product
 
@@ -67,12 +67,15 @@ from stoqlib.domain.person import (Person, Client, Branch, LoginUser,
                                    SalesPerson, Company, Individual,
                                    ClientCategory)
 from stoqlib.domain.product import (Product, ProductHistory, Storable,
-                                    StockTransactionHistory, StorableBatch)
+                                    StockTransactionHistory,
+                                    StockTransactionQueue, StorableBatch)
 from stoqlib.domain.returnedsale import ReturnedSale, ReturnedSaleItem
 from stoqlib.domain.sellable import Sellable, SellableCategory
 from stoqlib.domain.service import Service
 from stoqlib.domain.station import BranchStation
-from stoqlib.domain.taxes import check_tax_info_presence, InvoiceItemIpi
+from stoqlib.domain.taxes import (check_tax_info_presence, InvoiceItemCofins,
+                                  InvoiceItemIcms, InvoiceItemIpi,
+                                  InvoiceItemPis)
 from stoqlib.exceptions import SellError, StockError, DatabaseInconsistency
 from stoqlib.lib.dateutils import localnow
 from stoqlib.lib.defaults import quantize, DECIMAL_PRECISION
@@ -315,17 +318,7 @@ class SaleItem(Domain):
     #
 
     def sell(self, user: LoginUser):
-        if not self.sellable.is_available(branch=self.sale.branch):
-            raise SellError(_(u"%s is not available for sale. Try making it "
-                              u"available first and then try again.") % (
-                self.sellable.get_description()))
-
-        # This is emitted here instead of inside the if bellow because one can
-        # connect on it and change this item in a way that, if it wasn't going
-        # to decrease stock before, it will after
-        SaleItemBeforeDecreaseStockEvent.emit(self)
-
-        quantity_to_decrease = self.quantity - self.quantity_decreased
+        quantity_to_decrease = self._prepare_sell()
         storable = self.sellable.product_storable
         if storable and quantity_to_decrease:
             try:
@@ -337,8 +330,7 @@ class SaleItem(Domain):
                 raise SellError(str(err))
 
             self.average_cost = item.stock_cost
-        self.quantity_decreased += quantity_to_decrease
-        self.update_tax_values()
+        self._finish_sell(quantity_to_decrease)
 
     def cancel(self, user: LoginUser):
         # This is emitted here instead of inside the if bellow because one can
@@ -522,6 +514,27 @@ class SaleItem(Domain):
                 return component
         return None
 
+    #
+    #  Private
+    #
+
+    def _prepare_sell(self):
+        # Returns the quantity that should be decreased from the stock
+        if not self.sellable.is_available(branch=self.sale.branch):
+            raise SellError(_(u"%s is not available for sale. Try making it "
+                              u"available first and then try again.") % (
+                self.sellable.get_description()))
+
+        # This is emitted here instead of when decreasing the stock because
+        # one can connect on it and change this item in a way that, if it
+        # wasn't going to decrease stock before, it will after
+        SaleItemBeforeDecreaseStockEvent.emit(self)
+        return self.quantity - self.quantity_decreased
+
+    def _finish_sell(self, quantity_decreased):
+        self.quantity_decreased += quantity_decreased
+        self.update_tax_values()
+
 
 @implementer(IContainer)
 class Delivery(Domain):
@@ -1283,24 +1296,26 @@ class Sale(IdentifiableDomain):
         assert self.can_confirm()
         assert self.branch
 
-        for item in self.get_items():
+        items = self._get_items_for_confirm()
+        for item in items:
             self.validate_batch(item.batch, sellable=item.sellable)
-            if item.sellable.product:
-                ProductHistory.add_sold_item(self.store, self.branch, item)
-            item.sell(user)
+        ProductHistory.add_sold_items(
+            self.store, self.branch,
+            [item for item in items if item.sellable.product])
+        self._sell_items(user, items)
 
-        self.total_amount = self.get_total_sale_amount()
+        subtotal = currency(sum(item.get_total() for item in items))
+        self.total_amount = self.get_total_sale_amount(subtotal=subtotal)
 
         self.group.confirm()
         self._add_inpayments(till=till)
-        self._create_fiscal_entries(user)
+        self._create_fiscal_entries(user, items=items)
 
         # Save operation_nature and branch in Invoice table.
         self.invoice.branch = self.branch
 
         if self._create_commission_at_confirm():
-            for payment in self.payments:
-                self.create_commission(payment)
+            self._create_commissions(self.payments)
 
         if self.client:
             self.group.payer = self.client.person
@@ -1313,11 +1328,14 @@ class Sale(IdentifiableDomain):
         # set payments as paid before the status change.
         source_account = sysparam.get_object(self.store, 'SALES_ACCOUNT')
         destination_account = sysparam.get_object(self.store, 'TILLS_ACCOUNT')
-        for method in self.store.find(PaymentMethod):
-            if method.operation.pay_on_sale_confirm():
-                self.group.pay_method_payments(method.method_name,
-                                               source_account=source_account,
-                                               destination_account=destination_account)
+        # Go through the payments only once instead of once for each method
+        method_names = set(method.method_name
+                           for method in self.store.find(PaymentMethod)
+                           if method.operation.pay_on_sale_confirm())
+        for payment in self.group.get_valid_payments():
+            if payment.method.method_name in method_names and not payment.is_paid():
+                payment.pay(source_account=source_account,
+                            destination_account=destination_account)
 
         old_status = self.status
         self._set_sale_status(Sale.STATUS_CONFIRMED, user)
@@ -1353,8 +1371,7 @@ class Sale(IdentifiableDomain):
         # This code is still here for the users that some payments created
         # (and paid) but no commission created yet.
         # This can be removed sometime in the future.
-        for payment in self.payments:
-            self.create_commission(payment)
+        self._create_commissions(self.payments)
 
         self.close_date = TransactionTimestamp()
 
@@ -1884,12 +1901,17 @@ class Sale(IdentifiableDomain):
                                  parent_item=r_item)
         return returned_sale
 
-    def create_commission(self, payment):
+    def create_commission(self, payment, item_rates=None):
         """Creates a commission for the *payment*
 
         This will create a |commission| for the given |payment|,
         :obj:`.sale` and :obj:`.sale.salesperson`. Note that, if the
         payment already has a commission, nothing will be done.
+
+        :param payment: the |payment|
+        :param item_rates: the commission rates of the items, as returned
+          by :meth:`Commission.get_item_rates`. If not given, they will be
+          resolved again
         """
         from stoqlib.domain.commission import Commission
         if payment.has_commission():
@@ -1899,6 +1921,7 @@ class Sale(IdentifiableDomain):
             commission_type=self._get_commission_type(),
             sale=self,
             payment=payment,
+            item_rates=item_rates,
             store=self.store)
         if payment.is_outpayment():
             commission.value = -commission.value
@@ -2032,6 +2055,84 @@ class Sale(IdentifiableDomain):
 
         SaleStatusChangedEvent.emit(self, old_status, user)
 
+    def _get_items_for_confirm(self):
+        # Fetch the items and everything needed to sell them using just a
+        # few queries, so that confirming a sale with lots of items does not
+        # need to query each sellable, product, storable, etc separately.
+        tables = [
+            SaleItem,
+            Join(Sellable, Sellable.id == SaleItem.sellable_id),
+            LeftJoin(SellableCategory,
+                     SellableCategory.id == Sellable.category_id),
+            LeftJoin(Product, Product.id == Sellable.id),
+            LeftJoin(Storable, Storable.id == Sellable.id),
+            LeftJoin(Service, Service.id == Sellable.id),
+            LeftJoin(StorableBatch, StorableBatch.id == SaleItem.batch_id),
+        ]
+        result = self.store.using(*tables).find(
+            (SaleItem, Sellable, SellableCategory, Product, Storable,
+             Service, StorableBatch),
+            SaleItem.sale_id == self.id).order_by(SaleItem.te_id)
+
+        items = []
+        for item, sellable, category, product, storable, service, batch in result:
+            # Accessing the references while the objects are alive links
+            # them, so they will not be queried again later
+            item.sellable
+            item.batch
+            sellable.category
+            if product is not None:
+                sellable.product
+                product.sellable
+            if storable is not None:
+                sellable.product_storable
+                storable.product
+            if service is not None:
+                sellable.service
+            items.append(item)
+
+        for tax_class, attr in [(InvoiceItemIcms, 'icms_info'),
+                                (InvoiceItemIpi, 'ipi_info'),
+                                (InvoiceItemPis, 'pis_info'),
+                                (InvoiceItemCofins, 'cofins_info')]:
+            tax_ids = set(getattr(item, attr + '_id') for item in items)
+            tax_ids.discard(None)
+            if not tax_ids:
+                continue
+            # Keep a reference to the result while linking the items to them
+            taxes = list(self.store.find(tax_class, tax_class.id.is_in(tax_ids)))
+            for item in items:
+                getattr(item, attr)
+            del taxes
+
+        return items
+
+    def _sell_items(self, user: LoginUser, items):
+        # The same as calling item.sell() for each item, but all the stock
+        # is decreased at once
+        stock_queue = StockTransactionQueue(self.store, user)
+        sold = []
+        for item in items:
+            quantity_to_decrease = item._prepare_sell()
+            storable = item.sellable.product_storable
+            transaction = None
+            if storable and quantity_to_decrease:
+                transaction = stock_queue.decrease_stock(
+                    storable, quantity_to_decrease, self.branch,
+                    StockTransactionHistory.TYPE_SELL, item.id,
+                    cost_center=self.cost_center, batch=item.batch)
+            sold.append((item, quantity_to_decrease, transaction))
+
+        try:
+            stock_queue.apply()
+        except StockError as err:
+            raise SellError(str(err))
+
+        for item, quantity_to_decrease, transaction in sold:
+            if transaction is not None:
+                item.average_cost = transaction.unit_cost
+            item._finish_sell(quantity_to_decrease)
+
     def _get_percentage_value(self, percentage):
         if not percentage:
             return currency(0)
@@ -2060,6 +2161,17 @@ class Sale(IdentifiableDomain):
     def _create_commission_at_confirm(self):
         return sysparam.get_bool('SALE_PAY_COMMISSION_WHEN_CONFIRMED')
 
+    def _create_commissions(self, payments):
+        from stoqlib.domain.commission import Commission
+        payments = [p for p in payments if not p.has_commission()]
+        if not payments:
+            return
+
+        # Resolve the rates of the items only once for all the payments
+        item_rates = Commission.get_item_rates(self)
+        for payment in payments:
+            self.create_commission(payment, item_rates=item_rates)
+
     def _get_commission_type(self):
         from stoqlib.domain.commission import Commission
 
@@ -2079,16 +2191,21 @@ class Sale(IdentifiableDomain):
         """
         return currency(0)
 
-    def _get_icms_total(self, av_difference):
+    def _get_icms_total(self, av_difference, products=None):
         """A Brazil-specific method
         Calculates the icms total value
 
         :param av_difference: the average difference for the sale items.
                               it means the average discount or surcharge
                               applied over all sale items
+        :param products: the |saleitems| containing products, if
+            already fetched
         """
+        if products is None:
+            products = self.products
+
         icms_total = Decimal(0)
-        for item in self.products:
+        for item in products:
             price = item.price + av_difference
             sellable = item.sellable
             tax_constant = sellable.get_tax_constant()
@@ -2099,36 +2216,43 @@ class Sale(IdentifiableDomain):
 
         return icms_total
 
-    def _get_iss_total(self, av_difference):
+    def _get_iss_total(self, av_difference, services=None):
         """A Brazil-specific method
         Calculates the iss total value
 
         :param av_difference: the average difference for the sale items.
                               it means the average discount or surcharge
                               applied over all sale items
+        :param services: the |saleitems| containing services, if
+            already fetched
         """
+        if services is None:
+            services = self.services
+
         iss_total = Decimal(0)
         iss_tax = sysparam.get_decimal('ISS_TAX') / Decimal(100)
-        for item in self.services:
+        for item in services:
             price = item.price + av_difference
             iss_total += iss_tax * quantize(price * item.quantity)
         return iss_total
 
-    def _get_average_difference(self):
-        if self.get_items().is_empty():
+    def _get_average_difference(self, items=None):
+        if items is None:
+            items = list(self.get_items())
+        if not items:
             raise DatabaseInconsistency(
                 _(u"Sale orders must have items, which means products or "
                   u"services"))
-        total_quantity = self.get_items_total_quantity()
+        total_quantity = sum(item.quantity for item in items)
         if not total_quantity:
             raise DatabaseInconsistency(
                 _(u"Sale total quantity should never be zero"))
         # If there is a discount or a surcharge applied in the whole total
         # sale amount, we must share it between all the item values
         # otherwise the icms and iss won't be calculated properly
-        total = (self.get_total_sale_amount() -
+        subtotal = currency(sum(item.get_total() for item in items))
+        total = (self.get_total_sale_amount(subtotal=subtotal) -
                  self._get_pm_commission_total())
-        subtotal = self.get_sale_subtotal()
         return (total - subtotal) / total_quantity
 
     def _get_iss_entry(self):
@@ -2136,7 +2260,7 @@ class Sale(IdentifiableDomain):
             self.store, self.group,
             FiscalBookEntry.TYPE_SERVICE)
 
-    def _create_fiscal_entries(self, user: LoginUser):
+    def _create_fiscal_entries(self, user: LoginUser, items=None):
         """A Brazil-specific method
         Create new ICMS and ISS entries in the fiscal book
         for a given sale.
@@ -2144,20 +2268,27 @@ class Sale(IdentifiableDomain):
         Important: freight and interest are not part of the base value for
         ICMS. Only product values and surcharge which applies increasing the
         product totals are considered here.
+
+        :param items: the |saleitems| of this sale, if already fetched
         """
-        av_difference = self._get_average_difference()
+        if items is None:
+            items = list(self.get_items())
+        av_difference = self._get_average_difference(items)
+        products = [item for item in items if item.sellable.product]
+        services = [item for item in items
+                    if not item.sellable.product and item.sellable.service]
 
-        if not self.products.is_empty():
+        if products:
             FiscalBookEntry.create_product_entry(
                 self.store, self.branch, user,
                 self.group, self.cfop, self.coupon_id,
-                self._get_icms_total(av_difference))
+                self._get_icms_total(av_difference, products))
 
-        if not self.services.is_empty() and self.service_invoice_number:
+        if services and self.service_invoice_number:
             FiscalBookEntry.create_service_entry(
                 self.store, self.branch, user,
                 self.group, self.cfop, self.service_invoice_number,
-                self._get_iss_total(av_difference))
+                self._get_iss_total(av_difference, services))
 
 
 class SaleToken(Domain):
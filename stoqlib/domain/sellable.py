@@ -40,7 +40,7 @@ from decimal import Decimal
 
 from kiwi.currency import currency
 from stoqdrivers.enum import TaxType, UnitType
-from storm.expr import And, Or, In, Eq
+from storm.expr import And, Or, In, Eq, SQL
 from storm.references import Reference, ReferenceSet
 from zope.interface import implementer
 
@@ -65,6 +65,34 @@ _ = stoqlib_gettext
 # pyflakes: Sellable.has_image requires that Image is imported at least once
 Image  # pylint: disable=W0104
 
+# The ids of the category and its parents
+_CATEGORY_ANCESTORS_QUERY = """
+    WITH RECURSIVE ancestors(id, category_id) AS (
+        SELECT id, category_id FROM sellable_category WHERE id = ?
+        UNION ALL
+        SELECT c.id, c.category_id
+          FROM sellable_category c JOIN ancestors a ON c.id = a.category_id)
+    SELECT id FROM ancestors"""
+
+# The ids of the categories and all of their children, recursively
+_CATEGORY_SUBTREE_QUERY = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM sellable_category WHERE id IN (%s)
+        UNION
+        SELECT c.id FROM sellable_category c
+          JOIN subtree s ON c.category_id = s.id)
+    SELECT id FROM subtree"""
+
+# The full description of all the categories
+_CATEGORY_PATHS_QUERY = """
+    WITH RECURSIVE paths(id, full_description) AS (
+        SELECT id, description FROM sellable_category
+         WHERE category_id IS NULL
+        UNION ALL
+        SELECT c.id, p.full_description || ':' || c.description
+          FROM sellable_category c JOIN paths p ON c.category_id = p.id)
+    SELECT id, full_description FROM paths"""
+
 #
 # Base Domain Classes
 #
@@ -220,14 +248,7 @@ class SellableCategory(Domain):
         """The full description of the category, including its parents,
         for instance: u"Clothes:Shoes:Black Shoe 14 SL"
         """
-
-        descriptions = [self.description]
-
-        parent = self.category
-        while parent:
-            descriptions.append(parent.description)
-            parent = parent.category
-
+        descriptions = [c.description for c in self._get_ancestors()]
         return u':'.join(reversed(descriptions))
 
     #
@@ -246,16 +267,10 @@ class SellableCategory(Domain):
 
         In this example, calling this from A will return ``set([B, C, D, E])``
         """
-        children = set(self.children)
-
-        if not len(children):
-            # Base case for the leafs
-            return set()
-
-        for child in list(children):
-            children |= child.get_children_recursively()
-
-        return children
+        return set(self.store.find(
+            SellableCategory,
+            In(SellableCategory.id, SellableCategory.get_subtree_query([self])),
+            SellableCategory.id != self.id))
 
     def get_commission(self):
         """Returns the commission for this category.
@@ -263,10 +278,12 @@ class SellableCategory(Domain):
 
         :returns: the commission
         """
-        if self.category:
-            return (self.salesperson_commission or
-                    self.category.get_commission())
-        return self.salesperson_commission
+        commissions = [c.salesperson_commission
+                       for c in self._get_ancestors()]
+        for commission in commissions:
+            if commission:
+                return commission
+        return commissions[-1]
 
     def get_markup(self):
         """Returns the markup for this category.
@@ -274,12 +291,11 @@ class SellableCategory(Domain):
 
         :returns: the markup
         """
-        if self.category:
-            # Compare to None as markup can be '0'
-            if self.suggested_markup is not None:
-                return self.suggested_markup
-            return self.category.get_markup()
-        return self.suggested_markup
+        # Compare to None as markup can be '0'
+        for category in self._get_ancestors():
+            if category.suggested_markup is not None:
+                return category.suggested_markup
+        return None
 
     def get_tax_constant(self):
         """Returns the tax constant for this category.
@@ -287,9 +303,10 @@ class SellableCategory(Domain):
 
         :returns: the tax constant
         """
-        if self.category:
-            return self.tax_constant or self.category.get_tax_constant()
-        return self.tax_constant
+        for category in self._get_ancestors():
+            if category.tax_constant_id is not None:
+                return category.tax_constant
+        return None
 
     #
     #  IDescribable
@@ -310,6 +327,61 @@ class SellableCategory(Domain):
         """
         return store.find(cls, category_id=None)
 
+    @classmethod
+    def get_subtree_query(cls, categories):
+        """Returns a subquery with the ids of the categories and their children
+
+        This can be used to filter by a category including all of its
+        children, recursively, e.g.::
+
+          In(Sellable.category_id, SellableCategory.get_subtree_query([c]))
+
+        :param categories: a sequence of |sellablecategory|
+        :returns: a subquery that selects the ids
+        """
+        ids = [category.id for category in categories]
+        if not ids:
+            ids = [None]
+        return SQL(_CATEGORY_SUBTREE_QUERY % (', '.join('?' * len(ids)), ),
+                   ids)
+
+    @classmethod
+    def get_full_descriptions(cls, store):
+        """Returns the full description of all the categories
+
+        This is the same as :obj:`.full_description`, but for all the
+        categories at once.
+
+        :param store: a store
+        :returns: a dict mapping the category ids to their full description
+        """
+        return dict(store.execute(_CATEGORY_PATHS_QUERY).get_all())
+
+    #
+    #  Private
+    #
+
+    def _get_ancestors(self):
+        # This category and all of its parents, in order. The parents that
+        # are not loaded yet are fetched with a single query, so walking the
+        # chain doesn't query the database once per level, and the next
+        # calls don't query it at all
+        store = self.store
+        category = self
+        while category.category_id is not None:
+            if not store.is_alive(SellableCategory, category.category_id):
+                # The store cache keeps them alive while they are walked
+                list(store.find(SellableCategory, In(
+                    SellableCategory.id,
+                    SQL(_CATEGORY_ANCESTORS_QUERY, (category.category_id, )))))
+                break
+            category = category.category
+
+        ancestors = [self]
+        while ancestors[-1].category is not None:
+            ancestors.append(ancestors[-1].category)
+        return ancestors
+
     #
     # Domain hooks
     #
@@ -207,6 +207,18 @@ class DomainTest(unittest.TestCase, ExampleCreator):
     def setUp(self):
         self.set_store(self.store)
 
+        # The numbers that allow gaps are reserved and committed on a new
+        # store, reserve them on the test store so they are rolled back
+        # with everything else
+        @contextlib.contextmanager
+        def allocation_store():
+            yield self.store
+
+        patcher = mock.patch('stoqlib.database.allocator.new_store',
+                             allocation_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def tearDown(self):
         self.store.rollback(close=False)
         self.clear()
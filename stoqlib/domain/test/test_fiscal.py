@@ -167,6 +167,43 @@ class TestInvoice(DomainTest):
             self.assertEqual(new_transfer.invoice.invoice_number, 1235)
             self.assertEqual(next_invoice_number, 1236)
 
+    def test_reserve_invoice_numbers(self):
+        branch = self.create_branch()
+        numbers = Invoice.reserve_invoice_numbers(self.store, branch, 3,
+                                                  series=1)
+        self.assertEqual(numbers, [1, 2, 3])
+        self.assertEqual(
+            Invoice.get_next_invoice_number(self.store, branch, series=1), 4)
+        self.assertEqual(
+            Invoice.get_next_invoice_number(self.store, branch, series=2), 1)
+
+        # A number that was typed instead of reserved is skipped
+        sale = self.create_sale(branch=branch)
+        sale.invoice.series = 1
+        sale.invoice.invoice_number = 5
+        self.assertEqual(
+            Invoice.reserve_invoice_numbers(self.store, branch, 2, series=1),
+            [6, 7])
+        self.assertEqual(
+            Invoice.get_next_invoice_number(self.store, branch, series=1), 8)
+
+    def test_peek_next_invoice_number(self):
+        branch = self.create_branch()
+        self.assertEqual(
+            Invoice.peek_next_invoice_number(self.store, branch, series=1), 1)
+        # Peeking doesn't reserve the number
+        self.assertEqual(
+            Invoice.get_next_invoice_number(self.store, branch, series=1), 1)
+        self.assertEqual(
+            Invoice.peek_next_invoice_number(self.store, branch, series=1), 2)
+
+        # A number that was typed instead of reserved is skipped
+        sale = self.create_sale(branch=branch)
+        sale.invoice.series = 1
+        sale.invoice.invoice_number = 2
+        self.assertEqual(
+            Invoice.peek_next_invoice_number(self.store, branch, series=1), 3)
+
     def test_nfe_invoice(self):
         branch = self.create_branch()
         current_mode = Invoice.NFE_MODE
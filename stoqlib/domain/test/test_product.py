@@ -34,11 +34,12 @@ from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.person import Branch
 from stoqlib.domain.product import (ProductSupplierInfo, Product,
-                                    ProductStockItem,
+                                    ProductStockItem, ProductStockSummary,
                                     ProductHistory, ProductComponent,
                                     ProductQualityTest, Storable,
                                     StorableBatch, StorableBatchView,
-                                    StockTransactionHistory, ProductManufacturer,
+                                    StockTransactionHistory, StockTransactionQueue,
+                                    ProductManufacturer,
                                     GridOption, GridGroup)
 from stoqlib.domain.production import (ProductionOrder, ProductionProducedItem,
                                        ProductionItemQualityResult,
@@ -1358,6 +1359,43 @@ class TestStorable(DomainTest):
             self.assertEqual(str(exc),
                              'Quantity to decrease is greater than the available stock.')
 
+    def test_apply_increase_then_decrease(self):
+        branch = self.create_branch()
+        storable = self.create_storable()
+        other = self.create_storable(branch=branch, stock=10, unit_cost=5)
+
+        # The stock item doesn't exist yet, it will be created by the
+        # increase that comes before the decrease
+        queue = StockTransactionQueue(self.store, self.current_user)
+        queue.increase_stock(storable, 4, branch,
+                             StockTransactionHistory.TYPE_IMPORTED, None,
+                             unit_cost=2)
+        decrease = queue.decrease_stock(storable, 3, branch,
+                                        StockTransactionHistory.TYPE_SELL, None)
+        queue.increase_stock(other, 10, branch,
+                             StockTransactionHistory.TYPE_IMPORTED, None,
+                             unit_cost=7)
+        other_decrease = queue.decrease_stock(
+            other, 15, branch, StockTransactionHistory.TYPE_SELL, None)
+        queue.apply()
+
+        self.assertEqual(storable.get_balance_for_branch(branch), 1)
+        self.assertEqual(other.get_balance_for_branch(branch), 5)
+        # The decreases use the cost the stock item had after the increases
+        self.assertEqual(decrease.unit_cost, 2)
+        self.assertEqual(other_decrease.unit_cost, 6)
+        sth = self.store.get(StockTransactionHistory,
+                             other_decrease.stock_transaction_id)
+        self.assertEqual(sth.unit_cost, 6)
+
+        # Decreasing more than the pending increases is still an error
+        queue.increase_stock(storable, 1, branch,
+                             StockTransactionHistory.TYPE_IMPORTED, None)
+        queue.decrease_stock(storable, 3, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        with self.assertRaises(StockError):
+            queue.apply()
+
     def test_decrease_stock_cost_center(self):
         storable = self.create_storable()
         branch = self.current_branch
@@ -1387,6 +1425,140 @@ class TestStorable(DomainTest):
                  (StockTransactionHistory.TYPE_UPDATE_STOCK_COST, 100)]))
 
 
+class TestStockTransactionQueue(DomainTest):
+
+    def test_apply(self):
+        branch = self.create_branch()
+        storable1 = self.create_storable(branch=branch, stock=10, unit_cost=5)
+        storable2 = self.create_storable(branch=branch, stock=5, unit_cost=3)
+        storable3 = self.create_storable()
+
+        queue = StockTransactionQueue(self.store, self.current_user)
+        self.assertEqual(queue.apply(), [])
+        queue.decrease_stock(storable1, 4, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        queue.decrease_stock(storable2, 5, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        queue.increase_stock(storable3, 7, branch,
+                             StockTransactionHistory.TYPE_IMPORTED, None,
+                             unit_cost=2)
+        self.assertEqual(len(queue), 3)
+
+        transactions = queue.apply()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(storable1.get_balance_for_branch(branch), 6)
+        self.assertEqual(storable2.get_balance_for_branch(branch), 0)
+        self.assertEqual(storable3.get_balance_for_branch(branch), 7)
+        # The stock item created by the trigger is available too
+        self.assertEqual(transactions[2].stock_item.quantity, 7)
+        self.assertEqual(transactions[2].stock_item.stock_cost, 2)
+
+        sth = self.store.get(StockTransactionHistory,
+                             transactions[0].stock_transaction_id)
+        self.assertEqual(sth.quantity, -4)
+        self.assertEqual(sth.unit_cost, 5)
+        self.assertEqual(sth.responsible, self.current_user)
+
+    def test_apply_not_enough_stock(self):
+        branch = self.create_branch()
+        storable1 = self.create_storable(branch=branch, stock=10)
+        storable2 = self.create_storable(branch=branch, stock=1)
+
+        queue = StockTransactionQueue(self.store, self.current_user)
+        queue.decrease_stock(storable1, 4, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        # The two decreases together are greater than the stock
+        queue.decrease_stock(storable2, 1, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        queue.decrease_stock(storable2, 1, branch,
+                             StockTransactionHistory.TYPE_SELL, None)
+        with self.assertRaises(StockError):
+            queue.apply()
+
+        # Nothing was applied
+        self.assertEqual(storable1.get_balance_for_branch(branch), 10)
+        self.assertEqual(storable2.get_balance_for_branch(branch), 1)
+
+    def test_decrease_stock_cost_center(self):
+        branch = self.create_branch()
+        storable = self.create_storable(branch=branch, stock=10)
+        cost_center = self.create_cost_center()
+
+        queue = StockTransactionQueue(self.store, self.current_user)
+        transaction = queue.decrease_stock(
+            storable, 2, branch, StockTransactionHistory.TYPE_STOCK_DECREASE,
+            None, cost_center=cost_center)
+        queue.apply()
+
+        entry = cost_center.get_entries().one()
+        self.assertEqual(entry.stock_transaction.id,
+                         transaction.stock_transaction_id)
+
+    def test_batch(self):
+        branch = self.create_branch()
+        storable = self.create_storable(is_batch=True)
+        batch = self.create_storable_batch(storable)
+
+        queue = StockTransactionQueue(self.store, self.current_user)
+        with self.assertRaises(ValueError):
+            queue.increase_stock(storable, 1, branch,
+                                 StockTransactionHistory.TYPE_IMPORTED, None)
+        with self.assertRaises(ValueError):
+            queue.increase_stock(storable, 0, branch,
+                                 StockTransactionHistory.TYPE_IMPORTED, None,
+                                 batch=batch)
+
+        queue.increase_stock(storable, 3, branch,
+                             StockTransactionHistory.TYPE_IMPORTED, None,
+                             batch=batch)
+        queue.apply()
+        self.assertEqual(batch.get_balance_for_branch(branch), 3)
+
+
+class TestProductStockSummary(DomainTest):
+
+    def _get_summary(self, storable, branch):
+        # The summary is updated by the database, so query the values
+        # directly instead of getting possibly outdated cached objects
+        self.store.flush()
+        return self.store.find(
+            (ProductStockSummary.quantity, ProductStockSummary.total_cost),
+            storable_id=storable.id, branch_id=branch.id).one()
+
+    def test_stock_changes(self):
+        branch1 = self.create_branch()
+        branch2 = self.create_branch()
+        storable = self.create_storable(is_batch=True)
+        batch1 = self.create_storable_batch(storable, batch_number=u'1')
+        batch2 = self.create_storable_batch(storable, batch_number=u'2')
+        self.assertIsNone(self._get_summary(storable, branch1))
+
+        storable.increase_stock(10, branch1, StockTransactionHistory.TYPE_IMPORTED,
+                                None, self.current_user, unit_cost=2, batch=batch1)
+        storable.increase_stock(5, branch1, StockTransactionHistory.TYPE_IMPORTED,
+                                None, self.current_user, unit_cost=4, batch=batch2)
+        storable.increase_stock(3, branch2, StockTransactionHistory.TYPE_IMPORTED,
+                                None, self.current_user, unit_cost=1, batch=batch1)
+        self.assertEqual(self._get_summary(storable, branch1), (15, 40))
+        self.assertEqual(self._get_summary(storable, branch2), (3, 3))
+
+        storable.decrease_stock(4, branch1, StockTransactionHistory.TYPE_SELL,
+                                None, self.current_user, batch=batch2)
+        self.assertEqual(self._get_summary(storable, branch1), (11, 24))
+        self.assertEqual(self._get_summary(storable, branch2), (3, 3))
+
+        # Increasing the stock with a different cost changes the average
+        # cost of the stock item
+        storable.increase_stock(5, branch2, StockTransactionHistory.TYPE_IMPORTED,
+                                None, self.current_user, unit_cost=3, batch=batch1)
+        self.assertEqual(self._get_summary(storable, branch2), (8, 18))
+
+        for item in self.store.find(ProductStockItem, storable=storable,
+                                    branch=branch1):
+            self.store.remove(item)
+        self.assertEqual(self._get_summary(storable, branch1), (0, 0))
+
+
 class TestStorableBatch(DomainTest):
 
     def test_get_description(self):
@@ -40,7 +40,8 @@ from stoqlib.domain.fiscal import FiscalBookEntry
 from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment, PaymentChangeHistory
 from stoqlib.domain.person import LoginUser
-from stoqlib.domain.product import StockTransactionHistory, Storable
+from stoqlib.domain.product import (ProductHistory, StockTransactionHistory,
+                                    Storable)
 from stoqlib.domain.returnedsale import ReturnedSaleItem
 from stoqlib.domain.sale import (ClientsWithSaleView, Delivery,
                                  ReturnedSaleItemsView, ReturnedSaleView, Sale,
@@ -584,6 +585,51 @@ class TestSale(DomainTest):
         self.assertEqual(storable3.get_balance_for_branch(branch),
                          stock3 - 10)
 
+    def test_confirm_many_items(self):
+        sale = self.create_sale()
+        branch = sale.branch
+        sellables = [self.add_product(sale, quantity=2) for i in range(20)]
+        service_item = sale.add_sellable(self.create_service().sellable)
+        sale.order(self.current_user)
+        self.add_payments(sale)
+
+        with self.count_tracer() as tracer:
+            sale.confirm(self.current_user)
+            self.store.flush()
+
+        # The stock transactions and the product history are inserted
+        # using a single statement, no matter how many items the sale has.
+        # The tracer sees the statements of the ORM flushes too
+        for table in ['stock_transaction_history', 'product_history']:
+            self.assertEqual(
+                len([s for s in tracer.statements
+                     if 'INSERT INTO %s' % (table, ) in s]), 1)
+
+        for sellable in sellables:
+            storable = sellable.product_storable
+            self.assertEqual(storable.get_balance_for_branch(branch), 98)
+            self.assertEqual(
+                self.store.find(ProductHistory, sellable=sellable,
+                                branch=branch).one().quantity_sold, 2)
+        for item in sale.get_items():
+            self.assertEqual(item.quantity_decreased, item.quantity)
+        self.assertEqual(service_item.average_cost, 0)
+        self.assertEqual(sale.total_amount, sale.get_total_sale_amount())
+
+    def test_confirm_not_enough_stock(self):
+        sale = self.create_sale()
+        sellable = self.add_product(sale, quantity=10)
+        sale.order(self.current_user)
+        self.add_payments(sale)
+
+        storable = sellable.product_storable
+        storable.decrease_stock(95, sale.branch,
+                                StockTransactionHistory.TYPE_INITIAL, None,
+                                self.current_user)
+        with self.assertRaises(SellError):
+            sale.confirm(self.current_user)
+        self.assertEqual(storable.get_balance_for_branch(sale.branch), 5)
+
     def test_pay(self):
         sale = self.create_sale()
         self.assertFalse(sale.can_set_paid())
@@ -1427,6 +1473,61 @@ class TestSale(DomainTest):
         self.assertEqual(commissions.count(), 1)
         self.assertEqual(commissions[0].value, Decimal('56.00'))
 
+    def test_commission_amount_category(self):
+        api.sysparam.set_bool(
+            self.store, 'SALE_PAY_COMMISSION_WHEN_CONFIRMED', True)
+        parent = self.create_sellable_category()
+        category = self.create_sellable_category(parent=parent)
+        CommissionSource(category=parent,
+                         direct_value=10,
+                         installments_value=4,
+                         store=self.store)
+
+        sale = self.create_sale()
+        sellable = self.add_product(sale, price=200)
+        sellable.category = category
+        sellable = self.add_product(sale, price=300)
+        sellable.category = category
+        CommissionSource(sellable=sellable,
+                         direct_value=12,
+                         installments_value=6,
+                         store=self.store)
+        self.add_product(sale, price=100)
+        sale.order(self.current_user)
+        self.add_payments(sale, method_type=u'bill', installments=2)
+        sale.confirm(self.current_user)
+
+        commissions = self.store.find(Commission, sale=sale)
+        self.assertEqual(commissions.count(), 2)
+        for commission in commissions:
+            self.assertEqual(commission.commission_type,
+                             Commission.INSTALLMENTS)
+        # 200 * 4% + 300 * 6%
+        self.assertEqual(commissions.sum(Commission.value), Decimal('26.00'))
+
+    def test_commission_get_item_rates(self):
+        category = self.create_sellable_category()
+        CommissionSource(category=category,
+                         direct_value=10,
+                         installments_value=4,
+                         store=self.store)
+        sale = self.create_sale()
+        sellable = self.add_product(sale, price=200)
+        sellable.category = category
+        self.add_product(sale, price=100)
+
+        self.assertEqual(Commission.get_item_rates(sale), [
+            (Decimal(200), Decimal('0.1'), Decimal('0.04')),
+            (Decimal(100), Decimal(0), Decimal(0))])
+
+        payment = self.add_payments(sale)[0]
+        with mock.patch.object(Commission, 'get_item_rates') as get_rates:
+            commission = sale.create_commission(
+                payment, item_rates=[(Decimal(300), Decimal('0.5'),
+                                      Decimal(0))])
+        self.assertEqual(get_rates.call_count, 0)
+        self.assertEqual(commission.value, Decimal(150))
+
     def test_commission_amount_when_sale_returns_completly(self):
         if True:
             raise SkipTest(u"See stoqlib.domain.returned_sale.ReturnedSale.return_ "
@@ -108,6 +108,34 @@ class TestSellableCategory(DomainTest):
         self.assertEqual(category2.get_markup(), 0)
         self.assertEqual(category3.get_markup(), 5)
 
+    def test_get_commission(self):
+        self._base_category.salesperson_commission = 10
+        category = self._create_category(u'LCD', parent=self._base_category)
+        sub_category = self._create_category(u"29'", category)
+        self.assertEqual(sub_category.get_commission(), 10)
+
+        category.salesperson_commission = 5
+        self.assertEqual(sub_category.get_commission(), 5)
+
+        sub_category.salesperson_commission = 2
+        self.assertEqual(sub_category.get_commission(), 2)
+
+        self._base_category.salesperson_commission = 0
+        self.assertEqual(self._base_category.get_commission(), 0)
+
+    def test_get_ancestors_queries(self):
+        category = self._create_category(u'LCD', parent=self._base_category)
+        sub_category = self._create_category(u"29'", category)
+        with self.count_tracer() as tracer:
+            self.assertEqual(sub_category.full_description,
+                             u"Monitor:LCD:29'")
+            count = tracer.count
+            # The parents are loaded now, so they are not queried again
+            sub_category.get_markup()
+            sub_category.get_commission()
+            category.get_tax_constant()
+            self.assertEqual(tracer.count, count)
+
     def test_get_base_categories(self):
         categories = SellableCategory.get_base_categories(self.store)
         count = categories.count()
@@ -144,6 +172,42 @@ class TestSellableCategory(DomainTest):
         self.assertEqual(category.get_children_recursively(), set())
         self.assertEqual(base_category.get_children_recursively(), set([category]))
 
+        sub_category = SellableCategory(description=u"29'",
+                                        category=category,
+                                        store=self.store)
+        self.assertEqual(category.get_children_recursively(),
+                         set([sub_category]))
+        self.assertEqual(base_category.get_children_recursively(),
+                         set([category, sub_category]))
+
+    def test_get_subtree_query(self):
+        category = self._create_category(u'LCD', parent=self._base_category)
+        sub_category = self._create_category(u"29'", category)
+        other = self._create_category(u'Keyboard')
+        sellable = self.create_sellable()
+        sellable.category = sub_category
+
+        results = self.store.find(SellableCategory, SellableCategory.id.is_in(
+            SellableCategory.get_subtree_query([category, other])))
+        self.assertEqual(set(results), set([category, sub_category, other]))
+
+        results = self.store.find(Sellable, Sellable.category_id.is_in(
+            SellableCategory.get_subtree_query([self._base_category])))
+        self.assertEqual(list(results), [sellable])
+
+        results = self.store.find(SellableCategory, SellableCategory.id.is_in(
+            SellableCategory.get_subtree_query([])))
+        self.assertTrue(results.is_empty())
+
+    def test_get_full_descriptions(self):
+        category = self._create_category(u'LCD', parent=self._base_category)
+        sub_category = self._create_category(u"29'", category)
+
+        descriptions = SellableCategory.get_full_descriptions(self.store)
+        self.assertEqual(descriptions[self._base_category.id], u'Monitor')
+        self.assertEqual(descriptions[category.id], u'Monitor:LCD')
+        self.assertEqual(descriptions[sub_category.id], u"Monitor:LCD:29'")
+
     def test_on_create(self):
         category = self._create_category(u'cat')
         with mock.patch('stoqlib.domain.sellable.CategoryCreateEvent') as f:
@@ -320,6 +320,28 @@ class TestProductFullStockView(DomainTest):
         self.assertTrue(list(results))
         self.assertEqual(len(list(results)), 1)
 
+    def test_stock_by_branch(self):
+        branch1 = self.create_branch()
+        branch2 = self.create_branch()
+        product = self.create_product(branch=branch1, stock=3)
+        product.storable.increase_stock(
+            5, branch2, StockTransactionHistory.TYPE_IMPORTED, None,
+            self.current_user, unit_cost=4)
+        self.store.flush()
+
+        query = ProductFullStockView.product_id == product.id
+        view = self.store.find(ProductFullStockView, query).one()
+        self.assertEqual(view.stock, 8)
+        self.assertEqual(view.total_stock_cost, 50)
+
+        for branch, stock, total_stock_cost in [(branch1, 3, 30),
+                                                (branch2, 5, 20),
+                                                (self.create_branch(), 0, 0)]:
+            results = ProductFullStockView.find_by_branch(self.store, branch)
+            view = results.find(query).one()
+            self.assertEqual(view.stock, stock)
+            self.assertEqual(view.total_stock_cost, total_stock_cost)
+
     def test_post_search_callback(self):
         self.clean_domain([StockTransactionHistory, ProductSupplierInfo, ProductStockItem,
                            Storable, Product])
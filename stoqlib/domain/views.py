@@ -44,6 +44,7 @@ from stoqlib.domain.person import (Person, Supplier, Company, LoginUser,
                                    Individual, SalesPerson, ClientView)
 from stoqlib.domain.product import (Product,
                                     ProductStockItem,
+                                    ProductStockSummary,
                                     ProductHistory,
                                     ProductManufacturer,
                                     ProductSupplierInfo,
@@ -70,16 +71,15 @@ from stoqlib.lib.defaults import DECIMAL_PRECISION
 _StockBranchSummary = Alias(Select(
     columns=[Alias(Storable.id, 'storable_id'),
              Alias(Branch.id, 'branch_id'),
-             Alias(Sum(ProductStockItem.quantity), 'stock'),
-             Alias(Sum(ProductStockItem.quantity
-                       * ProductStockItem.stock_cost),
-                   'total_stock_cost')],
+             Alias(ProductStockSummary.quantity, 'stock'),
+             Alias(ProductStockSummary.total_cost, 'total_stock_cost')],
     tables=[Storable,
             # This is equivalent to a cross join
             Join(Branch, And(True)),
-            LeftJoin(ProductStockItem, And(ProductStockItem.branch_id == Branch.id,
-                                           ProductStockItem.storable_id == Storable.id))],
-    group_by=[Storable.id, Branch.id]), '_stock_summary')
+            LeftJoin(ProductStockSummary,
+                     And(ProductStockSummary.branch_id == Branch.id,
+                         ProductStockSummary.storable_id == Storable.id))]),
+    '_stock_summary')
 
 _price_search = Case(
     condition=Or(And(Date(StatementTimestamp()) >= Date(Sellable.on_sale_start_date),
@@ -152,15 +152,15 @@ class ProductFullStockView(Viewable):
     unit = SellableUnit.description
 
     # Aggregates
-    total_stock_cost = Coalesce(Sum(ProductStockItem.quantity *
-                                    ProductStockItem.stock_cost), 0)
-    stock = Coalesce(Sum(ProductStockItem.quantity), 0)
+    total_stock_cost = Coalesce(Sum(ProductStockSummary.total_cost), 0)
+    stock = Coalesce(Sum(ProductStockSummary.quantity), 0)
 
     tables = [
         Sellable,
         Join(Product, Product.id == Sellable.id),
         LeftJoin(Storable, Storable.id == Product.id),
-        LeftJoin(ProductStockItem, ProductStockItem.storable_id == Storable.id),
+        LeftJoin(ProductStockSummary,
+                 ProductStockSummary.storable_id == Storable.id),
         LeftJoin(SellableTaxConstant,
                  SellableTaxConstant.id == Sellable.tax_constant_id),
         LeftJoin(SellableCategory, SellableCategory.id == Sellable.category_id),
@@ -203,7 +203,7 @@ class ProductFullStockView(Viewable):
             return store.find(cls)
 
         # Highjack the class being queried, since we need to add the branch
-        # on the ProductStockItem join to filter it.
+        # on the ProductStockSummary join to filter it.
         # Make sure to create it only once or else Viewable would fail to
         # compare both objects as their class would be different.
         hv = cls.highjacked.get(branch.id, None)
@@ -212,19 +212,25 @@ class ProductFullStockView(Viewable):
             for i, table in enumerate(tables):
                 if not isinstance(table, JoinExpr):
                     continue
-                if table.right is ProductStockItem:
+                if table.right is ProductStockSummary:
                     tables[i] = LeftJoin(
-                        ProductStockItem,
-                        And(ProductStockItem.storable_id == Storable.id,
-                            ProductStockItem.branch_id == branch.id))
+                        ProductStockSummary,
+                        And(ProductStockSummary.storable_id == Storable.id,
+                            ProductStockSummary.branch_id == branch.id))
                     break
             else:  # pragma nocoverage
-                raise AssertionError("Did not find ProductStockItem join")
+                raise AssertionError("Did not find ProductStockSummary join")
 
+            # There's at most one summary for the storable on the branch, so
+            # the stock can be read directly from it. Grouping by its id
+            # allows us to use its columns without aggregating them.
             hv = type(
                 "Highjacked%s" % (cls.__name__, ),
                 (cls, ),
-                dict(tables=tables, _branch_id=branch.id))
+                dict(tables=tables, _branch_id=branch.id,
+                     stock=Coalesce(ProductStockSummary.quantity, 0),
+                     total_stock_cost=Coalesce(ProductStockSummary.total_cost, 0),
+                     group_by=cls.group_by + [ProductStockSummary.id]))
 
             cls.highjacked[branch.id] = hv
             # Make sure we will not create a highjack highjacked view
@@ -322,7 +328,7 @@ class ProductWithStockBranchView(ProductFullStockView):
     filter, otherwise, the results may be duplicated (once for each branch in
     the database)
     """
-    branch_id = ProductStockItem.branch_id
+    branch_id = ProductStockSummary.branch_id
     minimum_quantity = Storable.minimum_quantity
     maximum_quantity = Storable.maximum_quantity
 
@@ -350,7 +356,7 @@ _PurchaseItemTotal = Select(
 
 class ProductFullStockItemView(ProductFullStockView):
     # ProductFullStockView already joins with a 1 to Many table (Sellable
-    # with ProductStockItem).
+    # with ProductStockSummary).
     #
     # This is why we must join PurchaseItem (another 1 to many table) in a
     # subquery
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""CSV exporter
+
+The rows are written to the file as soon as they are added, like
+:class:`stoqlib.exporters.xlsxexporter.XLSXExporter`.
+"""
+
+import csv
+import datetime
+import io
+import os
+import tempfile
+
+from stoqlib.database.properties import Identifier
+from stoqlib.exporters.xlsutils import iter_object_list_cells
+
+
+class CSVExporter(object):
+    """Exports rows to a csv file, writing them as they are added
+    """
+
+    def __init__(self, name=None):
+        self._headers = None
+        self._n_columns = -1
+
+        self._fp = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        # Excel only detects that the file is utf-8 if it has a BOM
+        self._file = io.TextIOWrapper(self._fp, encoding='utf-8-sig',
+                                      newline='')
+        self._writer = csv.writer(self._file)
+
+    #
+    # Private
+    #
+
+    def _convert_one(self, data):
+        if data is None:
+            return ''
+        if isinstance(data, datetime.date):
+            return data.strftime('%Y-%m-%d')
+        if isinstance(data, bytes):
+            return data.decode()
+        if isinstance(data, Identifier):
+            # Identifiers are ints, but are displayed with leading zeros
+            return str(data)
+
+        return data
+
+    #
+    # Public API
+    #
+
+    def set_column_headers(self, headers):
+        self._headers = headers
+
+    def set_column_types(self, column_types):
+        self._n_columns = len(column_types)
+
+    def add_cells(self, cells, filter_description=None):
+        """Writes the rows to the file
+
+        :param cells: an iterable of rows, each one a sequence with the
+          values of its columns. It can be a generator, so the rows don't
+          need to be all in memory
+        :param filter_description: unused, csv files only have the rows
+        """
+        if self._headers:
+            self._writer.writerow(self._headers)
+
+        for line in cells:
+            if len(line) > self._n_columns:
+                raise ValueError(line, self._n_columns)
+            self._writer.writerow([self._convert_one(data) for data in line])
+
+    def save(self, prefix=''):
+        """Finishes the file
+
+        :param prefix: the prefix of the file name
+        :returns: the temporary file
+        """
+        if prefix:
+            prefix = 'Stoq-%s-' % (prefix, )
+        else:
+            prefix = 'Stoq-'
+
+        self._file.flush()
+        self._file.detach()
+        self._fp.close()
+
+        # The file was already written, just give it the right name
+        fd, filename = tempfile.mkstemp(prefix=prefix, suffix='.csv')
+        os.close(fd)
+        os.replace(self._fp.name, filename)
+        return open(filename, 'rb')
+
+    def add_from_object_list(self, objectlist, data=None,
+                             filter_description=None, fast_iter=False):
+        columns = objectlist.get_visible_columns()
+        self.set_column_types([
+            c.data_type for c in columns])
+        self.set_column_headers([
+            getattr(c, 'long_title', None) or c.title for c in columns])
+        self.add_cells(iter_object_list_cells(objectlist, data, fast_iter),
+                       filter_description=filter_description)
@@ -76,3 +76,22 @@ def get_date_format():
     # Translators: This is the default date format in excel
     # columns, see the xlwt python library for more information
     return _('YY-MMM-D')
+
+
+def iter_object_list_cells(objectlist, data=None, fast_iter=False,
+                           batch_size=1000):
+    """Iterates over the cell contents of an objectlist
+
+    Like :meth:`kiwi.ui.objectlist.ObjectList.get_cell_contents`, but if
+    *data* is a result set, the rows will be fetched from the database
+    *batch_size* at a time, instead of all at once.
+
+    :param fast_iter: if the rows should be fetched with
+      :meth:`stoqlib.database.runtime.StoqlibResultSet.fast_iter`, like
+      the searches using fast_iter do
+    """
+    if fast_iter and hasattr(data, 'fast_iter'):
+        data = data.fast_iter(batch_size=batch_size)
+    elif hasattr(data, 'iter_pages'):
+        data = data.iter_pages(batch_size)
+    return objectlist.get_cell_contents(data)
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""XLSX exporter
+
+Unlike :class:`stoqlib.exporters.xlsexporter.XLSExporter`, the rows are
+written to the file as soon as they are added, so the memory usage
+doesn't grow with the number of rows, and it is not limited to the
+65536 rows of the xls format.
+"""
+
+import datetime
+import os
+import re
+import struct
+import tempfile
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from kiwi.currency import currency
+from kiwi.environ import environ
+
+from stoqlib.database.properties import Identifier
+from stoqlib.exporters.xlsutils import (get_date_format,
+                                        get_number_format,
+                                        iter_object_list_cells)
+from stoqlib.lib.translation import stoqlib_gettext
+
+_ = stoqlib_gettext
+
+_EPOCH = datetime.datetime(1899, 12, 30)
+# Characters that are not allowed on xml documents
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# 1 pixel in EMUs, the unit used by drawings
+_EMU_PER_PIXEL = 9525
+
+# The indexes of the cell formats defined on _STYLES
+(_STYLE_GENERAL,
+ _STYLE_HEADER,
+ _STYLE_DATE,
+ _STYLE_NUMBER,
+ _STYLE_TITLE) = range(5)
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_RELS_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_DOC_RELS_NS = ("http://schemas.openxmlformats.org/officeDocument/2006/"
+                "relationships")
+_DRAWING_NS = ("http://schemas.openxmlformats.org/drawingml/2006/"
+               "spreadsheetDrawing")
+_A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+_OFFICE_TYPE = "application/vnd.openxmlformats-officedocument"
+
+_CONTENT_TYPES = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels"
+ ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Default Extension="png" ContentType="image/png"/>
+<Override PartName="/xl/workbook.xml"
+ ContentType="%(office)s.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml"
+ ContentType="%(office)s.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml"
+ ContentType="%(office)s.spreadsheetml.styles+xml"/>
+<Override PartName="/xl/drawings/drawing1.xml"
+ ContentType="%(office)s.drawing+xml"/>
+</Types>""" % dict(office=_OFFICE_TYPE)
+
+_RELS = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="%(rels)s">
+<Relationship Id="rId1" Type="%(doc_rels)s/officeDocument"
+ Target="xl/workbook.xml"/>
+</Relationships>""" % dict(rels=_RELS_NS, doc_rels=_DOC_RELS_NS)
+
+# The sheet name is added when saving
+_WORKBOOK = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="%(main)s" xmlns:r="%(doc_rels)s">
+<sheets><sheet name=%%s sheetId="1" r:id="rId1"/></sheets>
+</workbook>""" % dict(main=_MAIN_NS, doc_rels=_DOC_RELS_NS)
+
+_WORKBOOK_RELS = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="%(rels)s">
+<Relationship Id="rId1" Type="%(doc_rels)s/worksheet"
+ Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="%(doc_rels)s/styles" Target="styles.xml"/>
+</Relationships>""" % dict(rels=_RELS_NS, doc_rels=_DOC_RELS_NS)
+
+_STYLES = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="2">
+<numFmt numFmtId="164" formatCode=%(date_format)s/>
+<numFmt numFmtId="165" formatCode=%(number_format)s/>
+</numFmts>
+<fonts count="3">
+<font><sz val="10"/><name val="Arial"/></font>
+<font><b/><sz val="10"/><name val="Arial"/></font>
+<font><sz val="12.5"/><name val="Arial"/></font>
+</fonts>
+<fills count="2">
+<fill><patternFill patternType="none"/></fill>
+<fill><patternFill patternType="gray125"/></fill>
+</fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="5">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="0" fontId="2" fillId="0" borderId="0" xfId="0" applyFont="1" applyAlignment="1">\
+<alignment horizontal="center" vertical="center"/></xf>
+</cellXfs>
+</styleSheet>"""
+
+_SHEET_START = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="%(main)s" xmlns:r="%(doc_rels)s">
+<sheetData>
+""" % dict(main=_MAIN_NS, doc_rels=_DOC_RELS_NS)
+
+_SHEET_END = """\
+</sheetData>
+<mergeCells count="2"><mergeCell ref="A1:C1"/><mergeCell ref="D1:P1"/></mergeCells>
+<drawing r:id="rId1"/>
+</worksheet>"""
+
+_SHEET_RELS = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="%(rels)s">
+<Relationship Id="rId1" Type="%(doc_rels)s/drawing"
+ Target="../drawings/drawing1.xml"/>
+</Relationships>""" % dict(rels=_RELS_NS, doc_rels=_DOC_RELS_NS)
+
+# The size of the image is added when saving
+_DRAWING = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<xdr:wsDr xmlns:xdr="%(drawing)s" xmlns:a="%(a)s" xmlns:r="%(doc_rels)s">
+<xdr:oneCellAnchor>
+<xdr:from><xdr:col>3</xdr:col><xdr:colOff>0</xdr:colOff>\
+<xdr:row>0</xdr:row><xdr:rowOff>0</xdr:rowOff></xdr:from>
+<xdr:ext cx="%%(width)d" cy="%%(height)d"/>
+<xdr:pic>
+<xdr:nvPicPr><xdr:cNvPr id="1" name="Logo"/><xdr:cNvPicPr/></xdr:nvPicPr>
+<xdr:blipFill><a:blip r:embed="rId1"/><a:stretch><a:fillRect/></a:stretch>\
+</xdr:blipFill>
+<xdr:spPr><a:xfrm><a:off x="0" y="0"/>\
+<a:ext cx="%%(width)d" cy="%%(height)d"/></a:xfrm>\
+<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></xdr:spPr>
+</xdr:pic>
+<xdr:clientData/>
+</xdr:oneCellAnchor>
+</xdr:wsDr>""" % dict(drawing=_DRAWING_NS, a=_A_NS, doc_rels=_DOC_RELS_NS)
+
+_DRAWING_RELS = """\
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="%(rels)s">
+<Relationship Id="rId1" Type="%(doc_rels)s/image"
+ Target="../media/image1.png"/>
+</Relationships>""" % dict(rels=_RELS_NS, doc_rels=_DOC_RELS_NS)
+
+
+def _get_column_name(i):
+    name = ''
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def _get_png_size(data):
+    # The size is on the IHDR chunk, right after the signature
+    return struct.unpack('>II', data[16:24])
+
+
+class XLSXExporter(object):
+    """Exports rows to a xlsx file, writing them as they are added
+
+    The rows can be added only once, with :meth:`.add_cells` or
+    :meth:`.add_from_object_list`, and then :meth:`.save` must be called
+    to finish the file.
+    """
+
+    def __init__(self, name=None):
+        self._current_row = 1
+        self._n_columns = -1
+        self._column_styles = None
+        self._headers = None
+        self._description = None
+
+        if not name:
+            name = _('Stoq sheet')
+        self._name = name
+
+        self._fp = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+        self._zip = zipfile.ZipFile(self._fp, 'w',
+                                    compression=zipfile.ZIP_DEFLATED)
+        self._sheet = self._zip.open('xl/worksheets/sheet1.xml', 'w',
+                                     force_zip64=True)
+        self._sheet.write(_SHEET_START.encode('utf-8'))
+
+    #
+    # Private
+    #
+
+    def _write(self, data):
+        self._sheet.write(data.encode('utf-8'))
+
+    def _add_row(self, columns, style=None, height=None):
+        if len(columns) > self._n_columns:
+            raise ValueError(columns, self._n_columns)
+
+        self._current_row += 1
+        cells = [self._format_one(i, column, style)
+                 for i, column in enumerate(columns)]
+        if height:
+            row = '<row r="%d" ht="%d" customHeight="1">' % (
+                self._current_row, height)
+        else:
+            row = '<row r="%d">' % (self._current_row, )
+        self._write(row + ''.join(cells) + '</row>\n')
+
+    def _format_text(self, data):
+        return escape(_INVALID_XML_CHARS.sub('', data))
+
+    def _format_one(self, i, data, style=None):
+        if style is None:
+            style = self._column_styles[i]
+
+        ref = '%s%d' % (_get_column_name(i), self._current_row)
+        if data is None:
+            return ''
+        if isinstance(data, datetime.date):
+            if not isinstance(data, datetime.datetime):
+                data = datetime.datetime.combine(data, datetime.time())
+            delta = data.replace(tzinfo=None) - _EPOCH
+            value = delta.days + delta.seconds / 86400.0
+            return '<c r="%s" s="%d"><v>%r</v></c>' % (ref, style, value)
+        if isinstance(data, (bool, Identifier)):
+            # Identifiers are ints, but are displayed with leading zeros
+            data = str(data)
+        elif isinstance(data, (Decimal, int, float)):
+            return '<c r="%s" s="%d"><v>%s</v></c>' % (ref, style, data)
+        elif isinstance(data, bytes):
+            data = data.decode()
+        elif not isinstance(data, str):
+            data = str(data)
+
+        return '<c r="%s" s="%d" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+            ref, style, self._format_text(data))
+
+    def _write_title(self, filter_description):
+        url = u"http://www.stoq.com.br/"
+        label = u"%s - %s" % (_(u"Stoq Retail Management"), url)
+        cells = []
+        if filter_description:
+            cells.append('<c r="A1" s="%d" t="inlineStr"><is><t>%s</t></is></c>' % (
+                _STYLE_TITLE, self._format_text(filter_description)))
+        formula = u'HYPERLINK("%s","%s")' % (url, label.replace('"', '""'))
+        cells.append('<c r="D1" s="%d" t="str"><f>%s</f><v>%s</v></c>' % (
+            _STYLE_TITLE, self._format_text(formula), self._format_text(label)))
+        # The same height used by the xls exporter, 1000 twips
+        self._write('<row r="1" ht="50" customHeight="1">%s</row>\n' % (
+            ''.join(cells), ))
+
+    def _write_logo(self):
+        filename = environ.get_resource_filename('stoq', 'pixmaps',
+                                                 'stoq_logo_bgwhite.png')
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        width, height = _get_png_size(data)
+        self._zip.writestr('xl/media/image1.png', data)
+        self._zip.writestr('xl/drawings/drawing1.xml', _DRAWING % dict(
+            width=width * _EMU_PER_PIXEL, height=height * _EMU_PER_PIXEL))
+        self._zip.writestr('xl/drawings/_rels/drawing1.xml.rels',
+                           _DRAWING_RELS)
+        self._zip.writestr('xl/worksheets/_rels/sheet1.xml.rels', _SHEET_RELS)
+
+    #
+    # Public API
+    #
+
+    def set_column_headers(self, headers):
+        self._headers = headers
+
+    def set_column_types(self, column_types):
+        css = []
+        for i, column_type in enumerate(column_types):
+            if column_type in (datetime.datetime, datetime.date):
+                style = _STYLE_DATE
+            elif column_type in [int, float, currency]:
+                style = _STYLE_NUMBER
+            else:
+                style = _STYLE_GENERAL
+            css.append(style)
+
+        self._column_styles = css
+        self._n_columns = len(column_types)
+
+    def add_cells(self, cells, filter_description=None):
+        """Writes the rows to the file
+
+        :param cells: an iterable of rows, each one a sequence with the
+          values of its columns. It can be a generator, so the rows don't
+          need to be all in memory
+        :param filter_description: a description written on the first row
+        """
+        self._write_title(filter_description)
+
+        if self._headers:
+            self._add_row(self._headers, style=_STYLE_HEADER)
+
+        for line in cells:
+            self._add_row(line)
+
+    def save(self, prefix=''):
+        """Finishes the file and saves it to a temporary file
+
+        :param prefix: the prefix of the temporary file name
+        :returns: the temporary file
+        """
+        self._write(_SHEET_END)
+        self._sheet.close()
+
+        self._write_logo()
+        self._zip.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        self._zip.writestr('_rels/.rels', _RELS)
+        self._zip.writestr('xl/workbook.xml', _WORKBOOK % (
+            quoteattr(self._name[:31]), ))
+        self._zip.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        self._zip.writestr('xl/styles.xml', _STYLES % dict(
+            date_format=quoteattr(get_date_format()),
+            number_format=quoteattr(get_number_format())))
+        self._zip.close()
+
+        if prefix:
+            prefix = 'Stoq-%s-' % (prefix, )
+        else:
+            prefix = 'Stoq-'
+
+        self._fp.close()
+
+        # The file was already written, just give it the right name
+        fd, filename = tempfile.mkstemp(prefix=prefix, suffix='.xlsx')
+        os.close(fd)
+        os.replace(self._fp.name, filename)
+        return open(filename, 'rb')
+
+    def add_from_object_list(self, objectlist, data=None,
+                             filter_description=None, fast_iter=False):
+        columns = objectlist.get_visible_columns()
+        self.set_column_types([
+            c.data_type for c in columns])
+        self.set_column_headers([
+            getattr(c, 'long_title', None) or c.title for c in columns])
+        self.add_cells(iter_object_list_cells(objectlist, data, fast_iter),
+                       filter_description=filter_description)
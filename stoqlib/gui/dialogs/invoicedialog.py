@@ -37,7 +37,7 @@ from stoqlib.gui.editors.invoiceeditor import (InvoiceLayoutEditor,
                                                InvoicePrinterEditor)
 from stoqlib.lib.invoice import (SaleInvoice, print_sale_invoice,
                                  validate_invoice_number)
-
+from stoqlib.lib.message import warning
 from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
@@ -93,6 +93,7 @@ class SaleInvoicePrinterDialog(BaseEditor):
 
     def __init__(self, store, model, printer):
         self._printer = printer
+        self._next_invoice_number = None
         BaseEditor.__init__(self, store, model)
         self._setup_widgets()
 
@@ -104,14 +105,31 @@ class SaleInvoicePrinterDialog(BaseEditor):
         else:
             # FIXME: This is for the old invoice printing infrastructure that is
             # no longer used. Remove this code when possible
-            next_invoice_number = Invoice.get_next_invoice_number(
+            # The number is only reserved when confirming, so other
+            # stations don't wait while this dialog is open
+            self._next_invoice_number = Invoice.peek_next_invoice_number(
                 self.store, api.get_current_branch(self.store), series=1)
-            self.invoice_number.update(next_invoice_number)
+            self.invoice_number.update(self._next_invoice_number)
 
     def setup_proxies(self):
         self.add_proxy(self.model.invoice, SaleInvoicePrinterDialog.proxy_widgets)
 
     def on_confirm(self):
+        if (self._next_invoice_number is not None and
+                self.model.invoice.invoice_number == self._next_invoice_number):
+            # The suggested number was used, reserve it now. A number typed
+            # by the user is skipped by the next reservations
+            number = Invoice.get_next_invoice_number(
+                self.store, api.get_current_branch(self.store), series=1)
+            if number != self._next_invoice_number:
+                # Another station reserved the suggested number meanwhile
+                self.invoice_number.update(number)
+                warning(_("The invoice number %d was used by another "
+                          "station while this dialog was open. The invoice "
+                          "will be printed with the number %d instead.") % (
+                              self._next_invoice_number, number))
+            self.model.invoice.invoice_number = number
+
         invoice = SaleInvoice(self.model, self._printer.layout)
         print_sale_invoice(invoice, self._printer)
 
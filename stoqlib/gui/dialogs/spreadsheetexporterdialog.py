@@ -24,16 +24,31 @@
 """Spreedsheet Exporter Dialog"""
 
 
+import os
+import shutil
+
 from gi.repository import Gtk, Gio
 
 from stoqlib.api import api
 
-from stoqlib.exporters.xlsexporter import XLSExporter
+from stoqlib.exporters.csvexporter import CSVExporter
+from stoqlib.exporters.xlsxexporter import XLSXExporter
 from stoqlib.lib.message import yesno
 from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
 
+_MIME_TYPES = {
+    '.csv': 'text/csv',
+    '.xls': 'application/vnd.ms-excel',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+_EXPORTERS = {
+    'csv': CSVExporter,
+    'xlsx': XLSXExporter,
+}
+
 
 class SpreadSheetExporter:
     """A dialog to export data to a spreadsheet
@@ -41,15 +56,24 @@ class SpreadSheetExporter:
     title = _('Exporter to Spreadseet')
 
     def export(self, object_list, name, filename_prefix, data=None,
-               filter_description=None):
-        xls = XLSExporter(name)
-        xls.add_from_object_list(object_list, data,
-                                 filter_description=filter_description)
-        temporary = xls.save(filename_prefix)
+               filter_description=None, fast_iter=False, file_format=None):
+        """Exports the rows of an object list
+
+        :param file_format: ``'xlsx'`` or ``'csv'``, defaults to the
+          ``spreadsheet-format`` user setting, or xlsx if it is not set
+        """
+        if file_format is None:
+            file_format = api.user_settings.get('spreadsheet-format') or 'xlsx'
+        exporter = _EXPORTERS[file_format](name)
+        exporter.add_from_object_list(object_list, data,
+                                      filter_description=filter_description,
+                                      fast_iter=fast_iter)
+        temporary = exporter.save(filename_prefix)
         self.export_temporary(temporary)
 
     def export_temporary(self, temporary):
-        mime_type = 'application/vnd.ms-excel'
+        ext = os.path.splitext(temporary.name)[1]
+        mime_type = _MIME_TYPES[ext]
         app_info = Gio.app_info_get_default_for_type(mime_type, False)
         if app_info:
             action = api.user_settings.get('spreadsheet-action')
@@ -65,7 +89,7 @@ class SpreadSheetExporter:
             temporary.close()
             self._open_application(mime_type, temporary.name)
         elif action == 'save':
-            self._save(temporary)
+            self._save(temporary, ext)
 
     def _ask(self, app_info):
         # FIXME: What if the user presses esc? Esc will return False
@@ -84,7 +108,7 @@ class SpreadSheetExporter:
         gfile = Gio.File.new_for_path(filename)
         app_info.launch([gfile])
 
-    def _save(self, temp):
+    def _save(self, temp, ext):
         chooser = Gtk.FileChooserDialog(
             _("Export Spreadsheet..."), None,
             Gtk.FileChooserAction.SAVE,
@@ -93,8 +117,11 @@ class SpreadSheetExporter:
         chooser.set_do_overwrite_confirmation(True)
 
         xls_filter = Gtk.FileFilter()
-        xls_filter.set_name(_('Excel Files'))
-        xls_filter.add_pattern('*.xls')
+        if ext == '.csv':
+            xls_filter.set_name(_('CSV Files'))
+        else:
+            xls_filter.set_name(_('Excel Files'))
+        xls_filter.add_pattern('*' + ext)
         chooser.add_filter(xls_filter)
 
         response = chooser.run()
@@ -105,7 +132,6 @@ class SpreadSheetExporter:
             return
 
         filename = chooser.get_filename()
-        ext = '.xls'
 
         chooser.destroy()
 
@@ -113,5 +139,6 @@ class SpreadSheetExporter:
             filename += ext
 
         # Open in binary format so windows dont replace '\n' with '\r\n'
-        open(filename, 'wb').write(temp.read())
+        with open(filename, 'wb') as fp:
+            shutil.copyfileobj(temp, fp)
         temp.close()
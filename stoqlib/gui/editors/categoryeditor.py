@@ -116,8 +116,7 @@ class SellableCategoryEditor(BaseEditor):
         # a circular hierarchy
         categories -= self.model.get_children_recursively()
 
-        self.category.prefill(
-            api.for_combo(categories, attr='full_description'))
+        self.category.prefill(api.for_category_combo(categories))
         self.suggested_markup.set_adjustment(
             Gtk.Adjustment(lower=0, upper=MAX_INT, step_increment=1))
 
@@ -34,6 +34,7 @@ from kiwi.ui.objectlist import Column
 
 from stoqlib.api import api
 from stoqlib.domain.inventory import Inventory, InventoryItem
+from stoqlib.domain.product import StockTransactionQueue
 from stoqlib.gui.base.dialogs import run_dialog
 from stoqlib.gui.editors.baseeditor import BaseEditor
 from stoqlib.gui.fields import CfopField
@@ -172,12 +173,21 @@ class InventoryAdjustmentEditor(BaseEditor):
         self._run_adjustment_dialog(selected)
 
     def on_adjust_all_button__clicked(self, button):
+        user = api.get_current_user(self.store)
+        # Apply all the stock movements at once instead of one at a time
+        stock_queue = StockTransactionQueue(self.store, user)
+        adjusted = []
         for item in self.inventory_items:
             if item.is_adjusted:
                 continue
             item.actual_quantity = item.counted_quantity
             item.reason = _(u'Automatic adjustment')
-            item.adjust(api.get_current_user(self.store), self.model.invoice_number)
+            item.adjust(user, self.model.invoice_number,
+                        stock_queue=stock_queue)
+            adjusted.append(item)
+
+        stock_queue.apply()
+        for item in adjusted:
             self.inventory_items.update(item)
 
     def on_inventory_items__row_activated(self, objectlist, item):
@@ -56,6 +56,7 @@ class _PreferencesModel(object):
     language = _PrefField('user-locale')
     toolbar_style = _PrefField('toolbar-style')
     spreadsheet = _PrefField('spreadsheet-action')
+    spreadsheet_format = _PrefField('spreadsheet-format')
     launcher_screen = _PrefField('launcher-screen')
 
     #
@@ -79,7 +80,8 @@ class PreferencesEditor(BaseEditor):
     proxy_widgets = ['toolbar_style',
                      'language',
                      'spreadsheet',
-                     'launcher_screen']
+                     'launcher_screen',
+                     'spreadsheet_format']
 
     def __init__(self, store, *args, **kwargs):
         BaseEditor.__init__(self, store, *args, **kwargs)
@@ -127,6 +129,7 @@ class PreferencesEditor(BaseEditor):
         self._prefill_language_combo()
         self._prefill_spreadsheet()
         self._prefill_launcher_screen()
+        self._prefill_spreadsheet_format()
         self.proxy = self.add_proxy(self.model, self.proxy_widgets)
 
     def setup_slaves(self):
@@ -178,7 +181,8 @@ class PreferencesEditor(BaseEditor):
 
     def _prefill_spreadsheet(self):
         app_info = Gio.app_info_get_default_for_type(
-            'application/vnd.ms-excel', False)
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            False)
 
         options = [(_("Ask (default)"), None)]
         if app_info:
@@ -186,3 +190,9 @@ class PreferencesEditor(BaseEditor):
 
         options.append((_("Save to disk"), 'save'))
         self.spreadsheet.prefill(options)
+
+    def _prefill_spreadsheet_format(self):
+        self.spreadsheet_format.prefill([
+            (_("Excel (default)"), None),
+            (_("CSV"), 'csv'),
+        ])
@@ -584,8 +584,7 @@ class ProductBrandSearch(SearchEditor):
     def create_filters(self):
         # Category
         categories = self.store.find(SellableCategory)
-        items = api.for_combo(categories, attr='full_description')
-        items.insert(0, (_('Any'), None))
+        items = api.for_category_combo(categories, empty=_('Any'))
         category_filter = ComboSearchFilter(_('Category'), items)
         self.add_filter(category_filter, columns=[Sellable.category])
 
@@ -625,8 +624,7 @@ class ProductBrandByBranchSearch(SearchDialog):
 
         # Category
         categories = self.store.find(SellableCategory)
-        items = api.for_combo(categories, attr='full_description')
-        items.insert(0, (_('Any'), None))
+        items = api.for_category_combo(categories, empty=_('Any'))
         category_filter = ComboSearchFilter(_('Category'), items)
         self.add_filter(category_filter, position=SearchFilterPosition.TOP)
         self.category_filter = category_filter
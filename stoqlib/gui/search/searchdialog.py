@@ -517,7 +517,8 @@ class SearchDialog(BasicDialog):
         sse.export(object_list=self.results,
                    data=data,
                    name=self._csv_name,
-                   filename_prefix=self._csv_prefix)
+                   filename_prefix=self._csv_prefix,
+                   fast_iter=self.fast_iter)
 
     def _on_print_button__clicked(self, button):
         self.print_report()
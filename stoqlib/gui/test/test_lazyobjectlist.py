@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+from gi.repository import Gtk
+from kiwi.ui.objectlist import empty_marker
+import mock
+
+from stoqlib.database.queryexecuter import QueryExecuter
+from stoqlib.domain.person import ClientCategory
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.gui.widgets.lazyobjectlist import LazyObjectModel
+
+
+class TestLazyObjectModel(DomainTest):
+
+    def setUp(self):
+        super(TestLazyObjectModel, self).setUp()
+        for i in range(10):
+            self.create_client_category(u'lazy category %d' % i)
+        self.result = self.store.find(
+            ClientCategory, ClientCategory.name.startswith(u'lazy category'))
+
+        self.executer = QueryExecuter(self.store)
+        self.executer.set_search_spec(ClientCategory)
+        # ClientCategory doesn't have a post_search_callback
+        self.executer.get_post_result = mock.Mock(return_value=None)
+
+    def _create_model(self, initial_count=3,
+                      sort_order=Gtk.SortType.ASCENDING):
+        objectlist = mock.Mock()
+        objectlist.get_model.return_value.get_sort_column_id.return_value = (
+            None, sort_order)
+        objectlist.get_columns.return_value = [
+            mock.Mock(attribute='name', search_attribute=None)]
+        return LazyObjectModel(objectlist, self.result, self.executer,
+                               initial_count=initial_count)
+
+    def _get_values(self, model, start, end):
+        return [model[i][0] for i in range(start, end)]
+
+    def test_load_items_from_results(self):
+        expected = list(self.result.order_by(ClientCategory.name))
+        model = self._create_model()
+        self.assertEqual(len(model), 10)
+        self.assertEqual(self._get_values(model, 0, 4),
+                         expected[:3] + [empty_marker])
+
+        self.assertTrue(model.load_items_from_results(5, 8))
+        self.assertEqual(self._get_values(model, 3, 9),
+                         [empty_marker, empty_marker] + expected[5:8] +
+                         [empty_marker])
+        # Already loaded
+        self.assertFalse(model.load_items_from_results(5, 8))
+        self.assertTrue(model.load_items_from_results(0, 10))
+        self.assertEqual(self._get_values(model, 0, 10), expected)
+        self.assertEqual(model._objectlist.set_instance_iter.call_count, 10)
+
+    def test_load_items_from_results_descending(self):
+        expected = list(self.result.order_by(ClientCategory.name))
+        expected.reverse()
+        model = self._create_model(sort_order=Gtk.SortType.DESCENDING)
+        model.load_items_from_results(6, 10)
+        self.assertEqual(self._get_values(model, 0, 10),
+                         expected[:3] + [empty_marker] * 3 + expected[6:])
+
+    def test_load_items_from_results_max_loaded_rows(self):
+        model = self._create_model()
+        with mock.patch.object(LazyObjectModel, 'MAX_LOADED_ROWS', 4):
+            model.load_items_from_results(5, 8)
+
+        # The rows loaded first were discarded
+        self.assertEqual(sorted(model._values), [2, 5, 6, 7])
+        self.assertEqual(sorted(model._iters), [2, 5, 6, 7])
+        self.assertEqual(model[0][0], empty_marker)
+
+        # And are loaded again when needed
+        self.assertTrue(model.load_items_from_results(0, 2))
+        self.assertNotEqual(model[0][0], empty_marker)
+
+    def test_estimated_count_less_rows(self):
+        expected = list(self.result.order_by(ClientCategory.name))
+        with mock.patch.object(LazyObjectModel, 'EXACT_COUNT_THRESHOLD', 0):
+            with mock.patch.object(self.executer, 'get_estimated_count',
+                                   return_value=5):
+                model = self._create_model(initial_count=5)
+
+        # There were more rows than the estimated, so the model grows
+        self.assertEqual(len(model), 5 + LazyObjectModel.GROW_ROWS)
+        # Until we find out the real count
+        model.load_items_from_results(5, len(model))
+        self.assertEqual(len(model), 10)
+        self.assertEqual(self._get_values(model, 0, 10), expected)
+
+    def test_estimated_count_more_rows(self):
+        expected = list(self.result.order_by(ClientCategory.name))
+        with mock.patch.object(LazyObjectModel, 'EXACT_COUNT_THRESHOLD', 0):
+            with mock.patch.object(self.executer, 'get_estimated_count',
+                                   return_value=20):
+                model = self._create_model(initial_count=5)
+        self.assertEqual(len(model), 20)
+
+        # Skipping past the last row fixes the count
+        self.assertFalse(model.load_items_from_results(15, 20))
+        self.assertEqual(len(model), 10)
+        model.load_items_from_results(0, 10)
+        self.assertEqual(self._get_values(model, 0, 10), expected)
@@ -22,7 +22,9 @@
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 ##
 
+import mock
 
+from stoqlib.domain.fiscal import Invoice
 from stoqlib.gui.dialogs.invoicedialog import SaleInvoicePrinterDialog
 from stoqlib.gui.test.uitestutils import GUITest
 
@@ -33,3 +35,41 @@ class TestSaleInvoicePrinterDialog(GUITest):
         printer = self.create_invoice_printer()
         editor = SaleInvoicePrinterDialog(self.store, sale, printer)
         self.check_editor(editor, 'dialog-sale-invoice-show')
+
+    @mock.patch('stoqlib.gui.dialogs.invoicedialog.print_sale_invoice')
+    def test_confirm(self, print_sale_invoice):
+        sale = self.create_sale()
+        printer = self.create_invoice_printer()
+        editor = SaleInvoicePrinterDialog(self.store, sale, printer)
+        number = editor.invoice_number.read()
+
+        # The number is not reserved until the dialog is confirmed
+        self.assertEqual(
+            Invoice.peek_next_invoice_number(self.store, self.current_branch,
+                                             series=1), number)
+        self.click(editor.main_dialog.ok_button)
+        self.assertEqual(sale.invoice.invoice_number, number)
+        self.assertEqual(print_sale_invoice.call_count, 1)
+        self.assertEqual(
+            Invoice.get_next_invoice_number(self.store, self.current_branch,
+                                            series=1), number + 1)
+
+    @mock.patch('stoqlib.gui.dialogs.invoicedialog.warning')
+    @mock.patch('stoqlib.gui.dialogs.invoicedialog.print_sale_invoice')
+    def test_confirm_number_taken(self, print_sale_invoice, warning):
+        sale = self.create_sale()
+        printer = self.create_invoice_printer()
+        editor = SaleInvoicePrinterDialog(self.store, sale, printer)
+        number = editor.invoice_number.read()
+
+        # Another station reserves the number while the dialog is open
+        Invoice.get_next_invoice_number(self.store, self.current_branch,
+                                        series=1)
+        self.click(editor.main_dialog.ok_button)
+        self.assertEqual(sale.invoice.invoice_number, number + 1)
+        self.assertEqual(editor.invoice_number.read(), number + 1)
+        warning.assert_called_once_with(
+            "The invoice number %d was used by another station while this "
+            "dialog was open. The invoice will be printed with the number "
+            "%d instead." % (number, number + 1))
+        self.assertEqual(print_sale_invoice.call_count, 1)
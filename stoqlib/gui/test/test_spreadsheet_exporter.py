@@ -34,7 +34,7 @@ from stoqlib.gui.test.uitestutils import GUITest
 
 class TestXLSExporter(GUITest):
 
-    def _run_exporter(self, sse):
+    def _run_exporter(self, sse, file_format=None):
         objectlist = ObjectList()
         path = 'stoqlib.gui.dialogs.spreadsheetexporterdialog.Gio.app_info_get_default_for_type'
         with mock.patch(path) as Gio:
@@ -43,7 +43,8 @@ class TestXLSExporter(GUITest):
             Gio.return_value = app_info
             sse.export(object_list=objectlist,
                        name='Title', filename_prefix='name-prefix',
-                       filter_description='Testing description')
+                       filter_description='Testing description',
+                       file_format=file_format)
 
     def test_export_open(self):
         api.user_settings.set('spreadsheet-action', 'open')
@@ -69,3 +70,19 @@ class TestXLSExporter(GUITest):
             ('A spreadsheet has been created, what do '
              'you want to do with it?'), Gtk.ResponseType.NO, 'Save it to disk',
             'Open with App Name')
+
+    def test_export_csv(self):
+        api.user_settings.set('spreadsheet-action', 'open')
+
+        sse = SpreadSheetExporter()
+        with mock.patch.object(sse, '_open_application') as _open:
+            self._run_exporter(sse, file_format='csv')
+        mime_type, filename = _open.call_args[0]
+        self.assertEqual(mime_type, 'text/csv')
+        self.assertTrue(filename.endswith('.csv'))
+
+        api.user_settings.set('spreadsheet-format', 'csv')
+        self.addCleanup(api.user_settings.remove, 'spreadsheet-format')
+        with mock.patch.object(sse, '_open_application') as _open:
+            self._run_exporter(sse)
+        self.assertTrue(_open.call_args[0][1].endswith('.csv'))
@@ -28,9 +28,10 @@ import platform
 import tempfile
 import threading
 
-from gi.repository import Gtk, Gio, Pango
+from gi.repository import Gtk, Gio, GLib, Pango
 
 from stoqlib.gui.base.dialogs import get_current_toplevel
+from stoqlib.gui.dialogs.progressdialog import ProgressDialog
 from stoqlib.gui.events import PrintReportEvent
 from stoqlib.lib.message import warning
 from stoqlib.lib.osutils import get_application_dir
@@ -41,6 +42,8 @@ from stoqlib.lib.threadutils import (schedule_in_main_thread,
 from stoqlib.lib.translation import stoqlib_gettext
 from stoqlib.reporting.report import HTMLReport
 from stoqlib.reporting.labelreport import LabelReport
+from stoqlib.reporting.reportqueue import (ReportArgumentError, ReportJob,
+                                           get_report_queue)
 
 
 _ = stoqlib_gettext
@@ -235,6 +238,19 @@ class PrintOperationPoppler(PrintOperation):
         os.unlink(self._report.filename)
 
 
+class _RenderedReport(object):
+    """A report already rendered to a pdf file by a :class:`ReportJob`"""
+
+    def __init__(self, job):
+        self.title = job.report_class.title
+        self.filename = job.filename
+        self.print_as_landscape = getattr(job.report_class,
+                                          'print_as_landscape', False)
+
+    def save(self):
+        pass
+
+
 class PrintOperationWEasyPrint(PrintOperation):
 
     PRINT_CSS_TEMPLATE = """
@@ -368,6 +384,41 @@ def describe_search_filters_for_reports(filters, **kwargs):
     return kwargs
 
 
+def _print_rendered_report(job):
+    if _system == "Windows":
+        log.info("Starting PDF reader for %r" % (job.filename, ))
+        os.startfile(job.filename)
+        return
+
+    op = PrintOperationPoppler(_RenderedReport(job))
+    op.run()
+
+
+def _show_report_job(job):
+    # The dialog is not modal, so the user can keep working (and print
+    # other reports) while this one is rendered
+    dialog = ProgressDialog(_("Printing %s") % (job.report_class.title, ),
+                            pulse=False)
+    dialog.toplevel.set_modal(False)
+    dialog.connect('cancel', lambda dialog: job.cancel())
+    dialog.start(wait=0)
+
+    def update_progress():
+        if not job.is_finished():
+            dialog.progressbar.set_fraction(job.get_progress())
+            return True
+
+        dialog.stop()
+        get_report_queue().clear_finished()
+        if job.status == ReportJob.STATUS_DONE:
+            _print_rendered_report(job)
+        elif job.status == ReportJob.STATUS_FAILED:
+            warning(_("Could not print the report"), str(job.error))
+        return False
+
+    GLib.timeout_add(100, update_progress)
+
+
 def print_report(report_class, *args, **kwargs):
     rv = PrintReportEvent.emit(report_class, *args, **kwargs)
     if rv:
@@ -377,6 +428,18 @@ def print_report(report_class, *args, **kwargs):
     if filters:
         kwargs = describe_search_filters_for_reports(filters, **kwargs)
 
+    if issubclass(report_class, HTMLReport):
+        # Render it on the report workers, so the application doesn't
+        # freeze while the report is rendered
+        try:
+            job = get_report_queue().submit(report_class, *args, **kwargs)
+        except ReportArgumentError as e:
+            log.info("Rendering %s on this process: %s" % (
+                report_class.__name__, e))
+        else:
+            _show_report_job(job)
+            return job
+
     tmp = tempfile.mktemp(suffix='.pdf', prefix='stoqlib-reporting')
     report = report_class(tmp, *args, **kwargs)
     report.filename = tmp
@@ -22,6 +22,8 @@
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 #
 
+import collections
+
 from gi.repository import Gtk, GObject, GLib
 from pygtkcompat.generictreemodel import GenericTreeModel
 
@@ -64,6 +66,18 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     __gtype_name__ = 'LazyObjectModel'
 
+    # If the planner estimates more rows than this, use the estimate
+    # instead of counting the rows, which is slow for big tables
+    EXACT_COUNT_THRESHOLD = 10000
+
+    # How many rows should we add at the end when we find out that
+    # there are more rows than the estimated
+    GROW_ROWS = 100
+
+    # Maximum number of rows kept in memory, the ones loaded first
+    # are discarded and loaded again if needed
+    MAX_LOADED_ROWS = 2000
+
     def __init__(self, objectlist, result, executer, initial_count):
         """
         :param objectlist: a ObjectList
@@ -75,13 +89,15 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
         old_model = objectlist.get_model()
         self._objectlist = objectlist
         self._count = 0
+        self._exact_count = True
         self._executer = executer
         self._initial_count = initial_count
-        self._iters = []
+        self._iters = {}
+        self._keys = {}
         self._orig_result = result
         self._post_result = None
         self._result = None
-        self._values = []
+        self._values = collections.OrderedDict()
         self.old_model = old_model
         (self._sort_column_id,
          self._sort_order) = old_model.get_sort_column_id()
@@ -93,16 +109,106 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     def _load_result_set(self, result):
         self._post_result = self._executer.get_post_result(result)
+        self._result = result
         if self._post_result is not None:
-            count = self._post_result.count
+            self._count = self._post_result.count
+            self._exact_count = True
+        elif self._can_use_keyset():
+            count = self._executer.get_estimated_count(result)
+            self._exact_count = count <= self.EXACT_COUNT_THRESHOLD
+            self._count = result.count() if self._exact_count else count
         else:
-            count = result.count()
-        self._count = count
-        self._iters = list(range(0, count))
-        self._result = result
-        self._values = [empty_marker] * count
+            self._count = result.count()
+            self._exact_count = True
         self.load_items_from_results(0, self._initial_count)
 
+    def _get_order_attribute(self):
+        column = self._objectlist.get_columns()[self._sort_column_id]
+        if hasattr(column, 'search_attribute'):
+            # Even if it's defined, it could be None
+            return column.search_attribute or column.attribute
+        return column.attribute
+
+    def _can_use_keyset(self):
+        return self._executer.supports_keyset(self._get_order_attribute())
+
+    def _get_iter(self, index):
+        # GenericTreeModel doesn't keep a reference to the user data of the
+        # iters it creates, so keep the objects used for each row alive
+        return self._iters.setdefault(index, index)
+
+    def _forget_row(self, index):
+        # Note that the ObjectList still knows the iter of the item, there's
+        # no api to forget it without removing the row. If the row is
+        # loaded again, set_instance_iter will just replace it.
+        self._values.pop(index, None)
+        self._iters.pop(index, None)
+
+    def _clear_rows(self):
+        for index in list(self._values):
+            self._forget_row(index)
+        self._keys.clear()
+
+    def _set_count(self, count):
+        old_count = self._count
+        self._count = count
+        for i in reversed(range(count, old_count)):
+            self._forget_row(i)
+            self._keys.pop(i, None)
+            self.row_deleted((i, ))
+        for i in range(old_count, count):
+            self.row_inserted((i, ), self.create_tree_iter(self._get_iter(i)))
+
+    def _load_keyset_page(self, order_attr, start, end, descending):
+        # Start from the nearest row before start that we know the key,
+        # so the database doesn't need to skip all the rows before it
+        known = [i for i in self._keys if i < start]
+        if known:
+            after_index = max(known)
+            after = self._keys[after_index]
+            offset = start - after_index - 1
+        else:
+            after = None
+            offset = start
+
+        limit = end - start
+        # When using an estimated count, fetch an extra row to know if
+        # there are more rows than the ones we are showing
+        results = self._executer.get_keyset_page(
+            self._orig_result, order_attr, limit + int(not self._exact_count),
+            after=after, offset=offset, descending=descending)
+
+        if not self._exact_count:
+            if len(results) > limit:
+                if end == self._count:
+                    self._set_count(self._count + self.GROW_ROWS)
+            elif results or start == 0:
+                self._set_count(start + len(results))
+                self._exact_count = True
+            else:
+                # We skipped past the last row, so we don't know where it is
+                self._set_count(self._orig_result.count())
+                self._exact_count = True
+            results = results[:limit]
+
+        if results:
+            self._keys[start + len(results) - 1] = (
+                self._executer.get_keyset_key(results[-1], order_attr))
+        return results
+
+    def _load_offset_page(self, order_attr, start, end, descending):
+        self._result = self._executer.get_ordered_result(self._orig_result,
+                                                         order_attr)
+        if descending:
+            # Results should be reversed, so we need to invert the start and
+            # end values, and use the end of the list as a reference.
+            # This should be as easy as reversed(self._results[-end:-start])
+            # but storm does not support this.
+            start_ = self._count - end
+            end_ = self._count - start
+            return reversed(list(self._result[start_:end_]))
+        return list(self._result[start:end])
+
     # GtkTreeModel
 
     @debug
@@ -119,12 +225,12 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     @debug
     def on_get_value(self, row, column):
-        return self._values[row]
+        return self._values.get(row, empty_marker)
 
     @debug
     def on_get_iter(self, path):
-        if self._iters:
-            return self._iters[path[0]]
+        if path[0] < self._count:
+            return self._get_iter(path[0])
 
     @debug
     def on_get_path(self, row):
@@ -137,7 +243,7 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
     @debug
     def on_iter_next(self, row):
         if row + 1 < self._count:
-            return self._iters[row + 1]
+            return self._get_iter(row + 1)
         else:
             return None
 
@@ -147,8 +253,8 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     @debug
     def on_iter_children(self, row):
-        if row is None and self._iters:
-            return self._iters[0]
+        if row is None and self._count:
+            return self._get_iter(0)
         else:
             return None
 
@@ -161,10 +267,10 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
 
     @debug
     def on_iter_nth_child(self, parent, n):
-        if parent:
+        if parent or n >= self._count:
             return None
         else:
-            return self._iters[n]
+            return self._get_iter(n)
 
     def __len__(self):
         return self._count
@@ -181,11 +287,12 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
             index = key[0]
         else:
             raise AssertionError(key)
-        return LazyObjectModelRow(self._values[index], (index,), (index,))
+        return LazyObjectModelRow(self._values.get(index, empty_marker),
+                                  (index,), (index,))
 
     @debug
     def __contains__(self, value):
-        return value in self._values
+        return value in self._values.values()
 
     # GtkTreeSortable
 
@@ -205,7 +312,11 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
             not changed_order):
             return
 
-        self._load_result_set(self._result)
+        self._clear_rows()
+        if not self._exact_count and not self._can_use_keyset():
+            self._set_count(self._orig_result.count())
+            self._exact_count = True
+        self.load_items_from_results(0, self._initial_count)
         self.sort_column_changed()
 
     # FIXME: If we set this to do_set_sort_func it segfaults. Why?
@@ -233,58 +344,48 @@ class LazyObjectModel(GenericTreeModel, Gtk.TreeSortable):
     def load_items_from_results(self, start, end):
         """
         Fetchs rows from the database and displays in the model
+
+        When sorting by a column of the search spec, the rows are fetched
+        using keyset pagination (see
+        :meth:`stoqlib.database.queryexecuter.QueryExecuter.get_keyset_page`),
+        otherwise using ``OFFSET``.
+
         :param start: index of the first row to load
         :param end: index of the last row to load
         """
         end = min(end, self._count)
-        load_total = end - start
-
         # Avoid loading items already loaded
-        for i in range(start, end):
-            if self._values[i] is empty_marker:
-                break
-            # Partial loading
-            start = i
-        else:
-            return
-
-        # If we moved the start value in the for above, also move the end value
-        end = min(start + load_total, self._count)
-
-        column = self._objectlist.get_columns()[self._sort_column_id]
-        if hasattr(column, 'search_attribute'):
-            # Even if it's defined, it could be None
-            order_attr = column.search_attribute or column.attribute
-        else:
-            order_attr = column.attribute
-        self._result = self._executer.get_ordered_result(self._orig_result,
-                                                         order_attr)
+        while start < end and start in self._values:
+            start += 1
+        while start < end and end - 1 in self._values:
+            end -= 1
+        if start >= end:
+            return False
 
-        if self._sort_order == Gtk.SortType.DESCENDING:
-            # Results should be reversed, so we need to invert the start and
-            # end values, and use the end of the list as a reference.
-            # This should be as easy as reversed(self._results[-end:-start])
-            # but storm does not support this.
-            start_ = self._count - end
-            end_ = self._count - start
-            results = reversed(list(self._result[start_:end_]))
+        order_attr = self._get_order_attribute()
+        descending = self._sort_order == Gtk.SortType.DESCENDING
+        if self._can_use_keyset():
+            results = self._load_keyset_page(order_attr, start, end, descending)
         else:
-            results = list(self._result[start:end])
+            results = self._load_offset_page(order_attr, start, end, descending)
 
         has_loaded = False
         for i, item in enumerate(results, start):
-            if self._values[i] is not empty_marker:
+            if i in self._values:
                 continue
             has_loaded = True
             self._values[i] = item
             path = (i, )
-            titer = self.create_tree_iter(i)
+            titer = self.create_tree_iter(self._get_iter(i))
             # We are bypassing ObjectList to insert items in the model, but
             # ObjectList depends on knowing where the model is present for a few
             # actions. Let it know about this new item
             self._objectlist.set_instance_iter(item, titer)
             self.row_changed(path, titer)
 
+        while len(self._values) > self.MAX_LOADED_ROWS:
+            self._forget_row(next(iter(self._values)))
+
         return has_loaded
 
     def get_post_data(self):
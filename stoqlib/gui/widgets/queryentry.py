@@ -475,8 +475,7 @@ class QueryEntryGadget(object):
         if self._last_operation is not None:
             self._last_operation.cancel()
         self._last_operation = self._find_items(value)
-        self._last_operation.connect(
-            'finish', lambda o: self._popup.add_items(o.get_result()))
+        self._last_operation.connect('finish', self._on_operation__finish)
 
     def _run_search(self):
         if not self.search_class:
@@ -558,6 +557,13 @@ class QueryEntryGadget(object):
         else:
             self._run_search()
 
+    def _on_operation__finish(self, operation):
+        if operation.status == operation.STATUS_FAILED:
+            # The error was already logged by the executer
+            self._popup.popdown()
+            return
+        self._popup.add_items(operation.get_result())
+
     def _on_entry_sensitive(self, entry, pspec):
         self._update_widgets()
 
@@ -29,6 +29,7 @@ from stoqlib.importers.csvimporter import CSVImporter
 
 
 class ClientImporter(CSVImporter):
+    partitionable = True
     fields = ['name',
               'phone_number',
               'mobile_number',
@@ -42,6 +43,54 @@ class ClientImporter(CSVImporter):
               'streetnumber',
               'district']
 
+    def prepare_partitions(self, store):
+        # city_location is unique, the partitions can't create the same
+        # city at the same time
+        cities = set((data.city, data.state, data.country)
+                     for data in self.iter_rows())
+        for city, state, country in sorted(cities):
+            CityLocation.get_or_create(store=store, city=city, state=state,
+                                       country=country)
+
+    def _get_city_location(self, data, store):
+        return CityLocation.get_or_create(store=store,
+                                          city=data.city,
+                                          state=data.state,
+                                          country=data.country)
+
+    def _get_streetnumber(self, data):
+        return data.streetnumber and int(data.streetnumber) or None
+
+    def get_row_key(self, data):
+        return data.cpf
+
+    def upsert_one(self, data, fields, store):
+        individual = store.find(Individual, cpf=data.cpf).one()
+        if individual is None:
+            self.process_one(data, fields, store)
+            return
+
+        person = individual.person
+        person.name = data.name
+        person.phone_number = data.phone_number
+        person.mobile_number = data.mobile_number
+        individual.rg_number = data.rg
+
+        ctloc = self._get_city_location(data, store)
+        address = person.get_main_address()
+        if address is None:
+            address = Address(is_main_address=True,
+                              person=person,
+                              city_location=ctloc,
+                              store=store)
+        address.city_location = ctloc
+        address.street = data.street
+        address.streetnumber = self._get_streetnumber(data)
+        address.district = data.district
+
+        if person.client is None:
+            Client(person=person, store=store)
+
     def process_one(self, data, fields, store):
         person = Person(
             store=store,
@@ -54,18 +103,14 @@ class ClientImporter(CSVImporter):
                    cpf=data.cpf,
                    rg_number=data.rg)
 
-        ctloc = CityLocation.get_or_create(store=store,
-                                           city=data.city,
-                                           state=data.state,
-                                           country=data.country)
-        streetnumber = data.streetnumber and int(data.streetnumber) or None
+        ctloc = self._get_city_location(data, store)
         Address(
             is_main_address=True,
             person=person,
             city_location=ctloc,
             store=store,
             street=data.street,
-            streetnumber=streetnumber,
+            streetnumber=self._get_streetnumber(data),
             district=data.district
         )
 
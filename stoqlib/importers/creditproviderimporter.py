@@ -29,6 +29,7 @@ from stoqlib.importers.csvimporter import CSVImporter
 
 
 class CreditProviderImporter(CSVImporter):
+    partitionable = True
     fields = ['name',
               'phone_number',
               'mobile_number',
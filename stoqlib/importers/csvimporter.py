@@ -29,6 +29,7 @@ CSV import classes
 
 import csv
 import datetime
+import hashlib
 import time
 
 from stoqlib.database.runtime import new_store
@@ -69,6 +70,8 @@ class CSVImporter(Importer):
         """
         Importer.__init__(self, items=lines, dry=dry)
         self.lines = lines
+        self._row_hashes = None
+        self._changed_hashes = {}
 
     #
     # Public API
@@ -79,16 +82,31 @@ class CSVImporter(Importer):
         self.before_start(store)
         store.commit(close=True)
         self.lineno = 1
-        self.rows = list(csv.reader(fp, dialect=self.dialect))
+        self.filename = filename
+        self.fp = fp
+        self.rows = None
+        if not fp.seekable():
+            # We need to read the rows more than once
+            self.rows = list(self.read(fp))
 
     def get_n_items(self):
-        return len(self.rows)
+        if self.rows is not None:
+            return len(self.rows)
 
-    def process_item(self, store, item_no):
+        # Count the rows without keeping them in memory
+        n_items = sum(1 for row in self.read(self.fp))
+        self.fp.seek(0)
+        return n_items
+
+    def iter_items(self):
+        rows = self.rows if self.rows is not None else self.read(self.fp)
+        for lineno, item in enumerate(rows, 1):
+            self.lineno = lineno
+            yield item
+
+    def process_item(self, store, item):
         t = time.time()
-        item = self.rows[item_no]
         if not item or item[0].startswith('%'):
-            self.lineno += 1
             return False
         if len(item) < len(self.fields):
             raise ValueError(
@@ -109,8 +127,27 @@ class CSVImporter(Importer):
                                                  item))
 
         row = CSVRow(item, field_names)
+        if self.upsert:
+            key = self.get_row_key(row)
+            if not key:
+                raise ValueError(
+                    "line %d in file %s has no key to be updated" % (
+                        self.lineno, self.filename))
+            row_hash = self._get_row_hash(item)
+            if self._get_row_hashes(store).get(key) == row_hash:
+                return False
+            if key in self._changed_hashes:
+                # The key was already seen in this chunk and its object may
+                # not be in the database yet. Flush it so that upsert_one
+                # updates it instead of creating it again
+                self.flush(store)
+
         try:
-            self.process_one(row, row.fields, store)
+            if self.upsert:
+                self.upsert_one(row, row.fields, store)
+                self._row_hashes[key] = self._changed_hashes[key] = row_hash
+            else:
+                self.process_one(row, row.fields, store)
         except Exception:
             print()
             print('Error while processing row %d %r' % (self.lineno, row, ))
@@ -125,9 +162,43 @@ class CSVImporter(Importer):
                     t2 - t, self.lineno))
                 t = t2
 
-        self.lineno += 1
         return True
 
+    def iter_rows(self):
+        """Returns the rows of the file
+
+        The comments and the rows with the wrong number of fields are
+        skipped, they are reported when processing them.
+
+        :returns: an iterable of :class:`CSVRow`
+        """
+        field_names = self.fields + self.optional_fields
+        for item in self.iter_items():
+            if not item or item[0].startswith('%'):
+                continue
+            if not len(self.fields) <= len(item) <= len(field_names):
+                continue
+            yield CSVRow(item, field_names)
+        if self.rows is None:
+            self.fp.seek(0)
+
+    def flush(self, store):
+        changed = list(self._changed_hashes.items())
+        importer = type(self).__name__
+        for i in range(0, len(changed), 500):
+            rows = changed[i:i + 500]
+            params = []
+            for key, row_hash in rows:
+                params.extend([importer, key, row_hash])
+            store.execute("""
+                INSERT INTO importer_row_hash (importer, row_key, content_hash)
+                VALUES %s
+                ON CONFLICT (importer, row_key) DO UPDATE
+                    SET content_hash = EXCLUDED.content_hash
+                """ % (', '.join(['(?, ?, ?)'] * len(rows)), ), params,
+                noresult=True)
+        self._changed_hashes.clear()
+
     def parse_date(self, data):
         return localdate(*map(int, data.split('-')))
 
@@ -159,3 +230,39 @@ class CSVImporter(Importer):
         :param iterable: a sequence of lines which are going to be read
         :returns: a sequence of parsed items
         """
+        return csv.reader(iterable, dialect=self.dialect)
+
+    def get_row_key(self, data):
+        """Gets the key that identifies a row in upsert mode, eg
+        the barcode of a product or the document of a client
+
+        :param data: a :class:`CSVRow`
+        :returns: the key, a string
+        """
+        raise NotImplementedError(
+            "%s does not support upsert mode" % (type(self).__name__, ))
+
+    def upsert_one(self, data, fields, store):
+        """Updates the object of a row in upsert mode, or creates it
+        (usually by calling :meth:`.process_one`) if it doesn't exist
+
+        This is only called for the rows that changed since the last
+        time they were imported.
+        """
+        raise NotImplementedError(
+            "%s does not support upsert mode" % (type(self).__name__, ))
+
+    #
+    # Private
+    #
+
+    def _get_row_hash(self, item):
+        data = '\x1f'.join(field.strip() for field in item)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _get_row_hashes(self, store):
+        if self._row_hashes is None:
+            self._row_hashes = dict(store.execute(
+                "SELECT row_key, content_hash FROM importer_row_hash "
+                "WHERE importer = ?", (type(self).__name__, )))
+        return self._row_hashes
@@ -23,11 +23,16 @@
 ##
 ##
 
+import collections
 import datetime
+import json
 import logging
+import os
 import time
+import uuid
 
 from kiwi.python import namedAny
+from storm.info import get_cls_info
 
 from stoqlib.database.runtime import new_store
 
@@ -35,10 +40,11 @@ log = logging.getLogger(__name__)
 create_log = logging.getLogger('stoqlib.importer.create')
 
 _available_importers = {
+    'account.csv': 'accountimporter.AccountImporter',
     'account.ofx': 'ofximporter.OFXImporter',
     'branch.csv': 'branchimporter.BranchImporter',
     'client.csv': 'clientimporter.ClientImporter',
-    'creditprodvider.csv': 'creditprodviderimporter.CreditProdviderImporter',
+    'creditprovider.csv': 'creditproviderimporter.CreditProviderImporter',
     'employee.csv': 'employeeimporter.EmployeeImporter',
     'gnucash.xml': 'gnucashimporter.GnuCashXMLImporter',
     'product.csv': 'productimporter.ProductImporter',
@@ -47,16 +53,122 @@ _available_importers = {
     'service.csv': 'serviceimporter.ServiceImporter',
     'supplier.csv': 'supplierimporter.SupplierImporter',
     'supplier': 'supplierimporter.SupplierImporter',
+    'transaction.csv': 'accounttransactionimporter.AccountTransactionImporter',
     'transfer.csv': 'transferimporter.TransferImporter',
     'transporter.csv': 'transporterimporter.TransporterImporter',
 }
 
 
+class BulkInserter(object):
+    """Inserts lots of rows in the database using multi-row INSERTs
+
+    This is a lot faster than creating the domain objects one by one, since
+    the ORM inserts each of them in a separate statement. Note that the
+    domain classes are only used to know the columns and their python
+    defaults, their ``__init__`` and ``on_create`` hooks are not called,
+    and neither are the column validators.
+
+    The rows are only inserted when :meth:`.flush` is called, in the
+    order their tables were first used, so rows referencing other rows
+    should be added after them.
+    """
+
+    #: The maximum number of rows inserted by each statement
+    rows_per_statement = 500
+
+    def __init__(self):
+        self._rows = collections.OrderedDict()
+        self._columns = {}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    #
+    # Public API
+    #
+
+    def add(self, cls, **values):
+        """Adds a row to be inserted
+
+        :param cls: the domain class of the table
+        :param values: the values of the row, using the attribute names
+          of *cls*. The ``id`` will be generated if not given
+        :returns: the id of the row
+        """
+        if values.get('id') is None:
+            values['id'] = str(uuid.uuid1())
+        key = (cls, frozenset(values))
+        self._rows.setdefault(key, []).append(values)
+        return values['id']
+
+    def get_rows(self, cls):
+        """Gets the rows of *cls* that were not inserted yet
+
+        :param cls: the domain class of the table
+        :returns: a list of dicts with the values of the rows
+        """
+        return [values for (row_cls, names), rows in self._rows.items()
+                if row_cls is cls for values in rows]
+
+    def flush(self, store):
+        """Inserts all the rows added so far
+
+        :param store: the store to use
+        """
+        for (cls, names), rows in self._rows.items():
+            columns = self._get_columns(cls, names)
+            for i in range(0, len(rows), self.rows_per_statement):
+                self._insert(store, cls, columns,
+                             rows[i:i + self.rows_per_statement])
+        self._rows.clear()
+
+    #
+    # Private
+    #
+
+    def _create_variable(self, column):
+        # The validators need the object being changed
+        return column.variable_factory(validator=None)
+
+    def _get_columns(self, cls, names):
+        key = (cls, names)
+        if key not in self._columns:
+            columns = []
+            for attr, column in sorted(get_cls_info(cls).attributes.items()):
+                variable = self._create_variable(column)
+                # Columns that were not given are only inserted if they
+                # have a python default, otherwise the database default is used
+                if (attr in names or
+                        (variable.is_defined() and variable.get_lazy() is None)):
+                    columns.append((attr, column))
+            self._columns[key] = columns
+        return self._columns[key]
+
+    def _insert(self, store, cls, columns, rows):
+        params = []
+        for values in rows:
+            for attr, column in columns:
+                variable = self._create_variable(column)
+                if attr in values:
+                    variable.set(values[attr])
+                params.append(variable)
+
+        row = '(%s)' % (', '.join(['?'] * len(columns)), )
+        store.execute("INSERT INTO %s (%s) VALUES %s" % (
+            cls.__storm_table__,
+            ', '.join('"%s"' % (column.name, ) for attr, column in columns),
+            ', '.join([row] * len(rows))), params, noresult=True)
+
+
 class Importer(object):
     """Class to assist the process of importing csv files.
 
     """
 
+    #: If the items are independent of each other, so they can be split
+    #: in partitions imported at the same time. See :meth:`.set_partition`
+    partitionable = False
+
     def __init__(self, items=500, dry=False):
         """
         Create a new Importer object.
@@ -65,6 +177,10 @@ class Importer(object):
         """
         self.items = items
         self.dry = dry
+        self.checkpoint_filename = None
+        self.upsert = False
+        self.partition = 0
+        self.n_partitions = 1
 
     def feed_file(self, filename):
         """Feeds csv data from filename to the importer
@@ -79,7 +195,47 @@ class Importer(object):
         before committing
         :param items: number of items or
         """
-        self.n_items = items
+        self.items = items
+
+    def set_checkpoint_file(self, filename):
+        """Sets a file used to continue an interrupted import
+
+        Every time the items are committed, the number of items already
+        imported is saved on this file. If it exists when processing,
+        the items already imported will be skipped. The file is removed
+        when the import finishes.
+
+        :param filename: the checkpoint filename
+        """
+        self.checkpoint_filename = filename
+
+    def set_partition(self, partition, n_partitions):
+        """Only import one partition of the items
+
+        The items are split in *n_partitions*, and only the ones on
+        *partition* will be imported. This can only be used by
+        :attr:`.partitionable` importers.
+
+        :param partition: the partition to import, from 0 to
+          *n_partitions* - 1
+        :param n_partitions: the number of partitions
+        """
+        if n_partitions > 1 and not self.partitionable:
+            raise ValueError("%s cannot be partitioned" % (
+                type(self).__name__, ))
+        self.partition = partition
+        self.n_partitions = n_partitions
+
+    def set_upsert(self, upsert):
+        """Tells the importer to update the items that were already
+        imported, instead of creating them again
+
+        Only the items that changed since they were imported
+        will be updated. Not all importers support this.
+
+        :param upsert: upsert mode
+        """
+        self.upsert = upsert
 
     def set_dry(self, dry):
         """Tells the CSVImporter to run in dry mode, eg without committing
@@ -89,24 +245,39 @@ class Importer(object):
         self.dry = dry
 
     def process(self, store=None):
-        """Do the main logic, create stores, import items etc"""
+        """Do the main logic, create stores, import items etc
+
+        :returns: the number of items imported
+        """
         n_items = self.get_n_items()
         log.info('Importing %d items' % (n_items, ))
         create_log.info('ITEMS:%d' % (n_items, ))
         t1 = time.time()
 
+        skip_items = self._load_checkpoint()
+        if skip_items:
+            log.info('Skipping %d items already imported' % (skip_items, ))
+
         imported_items = 0
         if not store:
             store = new_store()
         self.before_start(store)
-        for i in range(n_items):
-            if self.process_item(store, i):
+        for i, item in enumerate(self.iter_items()):
+            if i < skip_items:
+                continue
+            if i % self.n_partitions != self.partition:
+                continue
+            if self.process_item(store, item):
                 create_log.info('ITEM:%d' % (i + 1, ))
                 imported_items += 1
-            if not self.dry and i + 1 % 100 == 0:
-                store.commit(close=True)
-                store = new_store()
+            if self.items > 0 and (i + 1) % self.items == 0:
+                self.flush(store)
+                if not self.dry:
+                    store.commit(close=True)
+                    self._save_checkpoint(i + 1)
+                    store = new_store()
 
+        self.flush(store)
         if not self.dry:
             store.commit(close=True)
             store = new_store()
@@ -115,12 +286,14 @@ class Importer(object):
 
         if not self.dry:
             store.commit(close=True)
+            self._remove_checkpoint()
 
         t2 = time.time()
         log.info('%s Imported %d entries in %2.2f sec' % (
             datetime.datetime.now().strftime('%H:%M:%S'), n_items,
             t2 - t1))
         create_log.info('IMPORTED-ITEMS:%d' % (imported_items, ))
+        return imported_items
 
     def feed(self, fp, filename='<stdin>'):
         """Feeds csv data from an iterable
@@ -132,8 +305,9 @@ class Importer(object):
     def get_n_items(self):
         raise NotImplementedError
 
-    def process_item(self, store, item_no):
+    def process_item(self, store, item):
         """
+        :param item: an item returned by :meth:`.iter_items`
         :returns True if the item was imported, False if not
         """
         raise NotImplementedError
@@ -142,28 +316,103 @@ class Importer(object):
     # Optional to implement
     #
 
+    def iter_items(self):
+        """Returns an iterable with the items that will be processed
+
+        By default this returns the indexes of the items, from 0 to
+        :meth:`.get_n_items`. Subclasses can override this to read
+        the items lazily instead of keeping them all in memory.
+        """
+        return range(self.get_n_items())
+
+    def flush(self, store):
+        """This is called before committing the items processed so far,
+        subclasses that buffer items should write them here.
+        """
+
+    def get_checkpoint_state(self):
+        """Returns the state that should be saved on the checkpoint
+
+        This is needed if the importer keeps some state between items,
+        eg a counter. The state needs to be serializable as json.
+        """
+        return None
+
+    def restore_checkpoint_state(self, state):
+        """Restores the state returned by :meth:`.get_checkpoint_state`
+        when continuing an import from a checkpoint
+        """
+
     def before_start(self, store):
         """This is called before all the lines are parsed but
         after creating a store.
         """
 
+    def prepare_partitions(self, store):
+        """This is called once before the partitions are imported at the
+        same time, see :meth:`.set_partition`.
+
+        Items of different partitions that create the same object, eg
+        the city location of an address, would conflict with each other,
+        so those objects should be created here instead.
+        """
+
     def when_done(self, store):
         """This is called after all the lines are parsed but
         before committing.
         """
 
+    #
+    # Private
+    #
 
-def get_by_type(importer_type):
-    """Gets an importers class, instantiates it returns it
+    def _load_checkpoint(self):
+        if (self.dry or not self.checkpoint_filename or
+                not os.path.exists(self.checkpoint_filename)):
+            return 0
+
+        with open(self.checkpoint_filename) as fp:
+            checkpoint = json.load(fp)
+        self.restore_checkpoint_state(checkpoint['state'])
+        return checkpoint['items']
+
+    def _save_checkpoint(self, items):
+        if not self.checkpoint_filename:
+            return
+
+        # Write to a temporary file first, so the checkpoint is never
+        # left half written if we are interrupted
+        tmp_filename = self.checkpoint_filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            json.dump(dict(items=items, state=self.get_checkpoint_state()), fp)
+        os.replace(tmp_filename, self.checkpoint_filename)
+
+    def _remove_checkpoint(self):
+        if (self.checkpoint_filename and
+                os.path.exists(self.checkpoint_filename)):
+            os.remove(self.checkpoint_filename)
+
+
+def get_importer_class(importer_type):
+    """Gets the importer class for a type
     :param importer_type: an importer
     :type importer_type: string
-    :returns: an importer instance
-    :type: :class:`Importer` subclass
+    :returns: an :class:`Importer` subclass
     """
 
     if not importer_type in _available_importers:
         raise ValueError(u"Invalid importer %s, must be one of %s" % (
             importer_type, u', '.join(sorted(_available_importers))))
     name = _available_importers[importer_type]
-    cls = namedAny('stoqlib.importers.%s' % (name, ))
+    return namedAny('stoqlib.importers.%s' % (name, ))
+
+
+def get_by_type(importer_type):
+    """Gets an importers class, instantiates it returns it
+    :param importer_type: an importer
+    :type importer_type: string
+    :returns: an importer instance
+    :type: :class:`Importer` subclass
+    """
+    cls = get_importer_class(importer_type)
     return cls()
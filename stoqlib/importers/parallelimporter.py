@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+##
+
+"""Import a directory of csv files using several processes
+
+Each csv file is imported by the importer of its type (eg ``products.csv``
+by :class:`stoqlib.importers.productimporter.ProductImporter`). Files that
+depend on data imported by other files (eg purchases depend on suppliers
+and products) are only imported after them, the others are imported at
+the same time, each one on a separate process with its own store.
+"""
+
+import collections
+from concurrent import futures
+import glob
+import logging
+import multiprocessing
+import os
+import time
+
+from stoqlib.database.runtime import new_store, set_default_store
+from stoqlib.importers.importer import (_available_importers, get_by_type,
+                                        get_importer_class)
+
+log = logging.getLogger(__name__)
+
+#: The importer types that need to be imported before each importer type.
+#: Only the types present on the imported directory are considered, the
+#: others are expected to be on the database already
+_dependencies = {
+    'account.csv': [],
+    'branch.csv': [],
+    'client.csv': ['branch.csv'],
+    'creditprovider.csv': [],
+    'employee.csv': ['branch.csv'],
+    'product.csv': ['supplier.csv'],
+    'purchase.csv': ['branch.csv', 'employee.csv', 'product.csv',
+                     'supplier.csv', 'transporter.csv'],
+    'sale.csv': ['branch.csv', 'client.csv', 'employee.csv',
+                 'product.csv', 'service.csv'],
+    'service.csv': ['branch.csv'],
+    'supplier.csv': ['branch.csv'],
+    'transaction.csv': ['account.csv'],
+    'transfer.csv': ['branch.csv', 'employee.csv', 'product.csv'],
+    'transporter.csv': ['branch.csv'],
+}
+
+ImportStats = collections.namedtuple(
+    'ImportStats', ['importer_type', 'filename', 'items', 'seconds'])
+
+
+def get_importer_type(filename):
+    """Gets the importer type of a csv file
+
+    Both the singular and plural form of the types are accepted,
+    eg ``product.csv`` and ``products.csv``.
+
+    :param filename: the csv filename
+    :returns: the importer type or ``None`` if there's no importer for it
+    """
+    root, ext = os.path.splitext(os.path.basename(filename).lower())
+    # eg products.csv and branches.csv
+    for suffix in ['', 's', 'es']:
+        if not root.endswith(suffix):
+            continue
+        name = root[:len(root) - len(suffix)] + ext
+        if name in _dependencies:
+            return name
+    return None
+
+
+def _import_file(importer_type, filename, partition, n_partitions, dry):
+    # This runs on the worker processes
+    importer = get_by_type(importer_type)
+    importer.set_dry(dry)
+    importer.set_partition(partition, n_partitions)
+    importer.feed_file(filename)
+    t1 = time.time()
+    items = importer.process()
+    return items, time.time() - t1
+
+
+def _prepare_file(importer_type, filename):
+    # This runs on a worker process, before the partitions are imported
+    importer = get_by_type(importer_type)
+    importer.feed_file(filename)
+    store = new_store()
+    importer.prepare_partitions(store)
+    store.commit(close=True)
+
+
+class ParallelImporter(object):
+    """Imports all the csv files of a directory in parallel
+
+    :param directory: the directory with the csv files
+    :param workers: the number of processes to use, defaults to the
+      number of cpus
+    :param dry: if nothing should be committed. The files are not split
+      in partitions then
+    """
+
+    def __init__(self, directory, workers=None, dry=False):
+        self.directory = directory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.dry = dry
+
+    #
+    # Public API
+    #
+
+    def get_files(self):
+        """Gets the files that will be imported
+
+        :returns: a dict mapping the importer type to the filename
+        """
+        files = {}
+        for filename in sorted(glob.glob(os.path.join(self.directory,
+                                                      '*.csv'))):
+            importer_type = get_importer_type(filename)
+            if importer_type is None:
+                log.warning("Skipping %s, there's no importer for it" % (
+                    filename, ))
+                continue
+            assert importer_type in _available_importers, importer_type
+            if importer_type in files:
+                raise ValueError("Both %s and %s are %s files" % (
+                    files[importer_type], filename, importer_type))
+            files[importer_type] = filename
+        return files
+
+    def get_dependencies(self, files):
+        """Gets the dependencies between the files that will be imported
+
+        :param files: the files returned by :meth:`.get_files`
+        :returns: a dict mapping each importer type to the set of types
+          that need to be imported before it
+        """
+        return dict(
+            (importer_type, set(dep for dep in _dependencies[importer_type]
+                                if dep in files))
+            for importer_type in files)
+
+    def process(self):
+        """Imports all the files
+
+        Note that the stores of this process will be closed before
+        starting the workers, since they cannot share its connections.
+
+        :returns: a list of :class:`ImportStats`, in the order the
+          importers finished
+        """
+        files = self.get_files()
+        pending = self.get_dependencies(files)
+        stats = []
+        running = {}
+        started = {}
+        results = collections.defaultdict(list)
+
+        # The workers are forked, so they inherit the database settings,
+        # but they must open their own connections
+        set_default_store(None)
+        context = multiprocessing.get_context('fork')
+        with futures.ProcessPoolExecutor(self.workers,
+                                         mp_context=context) as executor:
+            while pending or running:
+                for importer_type in sorted(pending):
+                    if pending[importer_type]:
+                        continue
+                    del pending[importer_type]
+                    started[importer_type] = time.time()
+                    for future in self._submit(executor, importer_type,
+                                               files[importer_type]):
+                        running[future] = importer_type
+
+                if not running:
+                    raise ValueError("Circular dependency between %s" % (
+                        ', '.join(sorted(pending)), ))
+
+                done, not_done = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    importer_type = running.pop(future)
+                    results[importer_type].append(future.result())
+                    if importer_type in running.values():
+                        continue
+
+                    # All the partitions are done
+                    stat = ImportStats(
+                        importer_type, files[importer_type],
+                        sum(items for items, seconds in results[importer_type]),
+                        time.time() - started[importer_type])
+                    self._log_stats(stat)
+                    stats.append(stat)
+                    for deps in pending.values():
+                        deps.discard(importer_type)
+
+        return stats
+
+    #
+    # Private
+    #
+
+    def _submit(self, executor, importer_type, filename):
+        # Don't instantiate the importer here, some of them use the
+        # default store and this process must not have connections
+        # open when forking the workers
+        cls = get_importer_class(importer_type)
+        # The objects shared by the partitions are not committed on a dry
+        # import, so the partitions would create them at the same time
+        if cls.partitionable and not self.dry:
+            n_partitions = self.workers
+        else:
+            n_partitions = 1
+        if n_partitions > 1:
+            executor.submit(_prepare_file, importer_type, filename).result()
+        log.info('Importing %s using %d processes' % (filename, n_partitions))
+        return [executor.submit(_import_file, importer_type, filename,
+                                partition, n_partitions, self.dry)
+                for partition in range(n_partitions)]
+
+    def _log_stats(self, stat):
+        log.info('Imported %d items from %s in %2.2f sec (%.1f items/sec)' % (
+            stat.items, stat.filename, stat.seconds,
+            stat.items / stat.seconds if stat.seconds else 0))
@@ -37,7 +37,9 @@ from stoqlib.domain.taxes import (ProductIcmsTemplate,
                                   ProductPisTemplate,
                                   ProductCofinsTemplate,
                                   ProductTaxTemplate)
+from stoqlib.exceptions import SellableError
 from stoqlib.importers.csvimporter import CSVImporter
+from stoqlib.importers.importer import BulkInserter
 from stoqlib.lib.parameters import sysparam
 
 
@@ -57,6 +59,7 @@ class ProductImporter(CSVImporter):
 
     optional_fields = [
         'unit',
+        'code',
     ]
 
     def __init__(self):
@@ -66,23 +69,41 @@ class ProductImporter(CSVImporter):
         if not suppliers.count():
             raise ValueError(u'You must have at least one suppliers on your '
                              u'database at this point.')
-        self.supplier = suppliers[0]
+        self.supplier_id = suppliers[0].id
 
         self.units = {}
         for unit in default_store.find(SellableUnit):
-            self.units[unit.description] = unit
+            self.units[unit.description] = unit.id
 
         self.tax_constant_id = sysparam.get_object_id(
             'DEFAULT_PRODUCT_TAX_CONSTANT')
         self._code = 1
 
+        # Lookup caches for the objects shared by many products, so we
+        # don't need to query them for every row
+        self._ids = {}
+        self._commissions = {}
+        self._taxes = None
+        self._codes = set()
+        self._barcodes = set()
+        self._inserter = BulkInserter()
+
     def _get_or_create(self, table, store, **attributes):
-        obj = store.find(table, **attributes).one()
-        if obj is None:
-            obj = table(store=store, **attributes)
-        return obj
+        key = (table, tuple(sorted(attributes.items())))
+        obj_id = self._ids.get(key)
+        if obj_id is None:
+            obj = store.find(table, **attributes).one()
+            if obj is None:
+                obj = table(store=store, **attributes)
+            if isinstance(obj, SellableCategory):
+                self._commissions[obj.id] = obj.get_commission()
+            obj_id = self._ids[key] = obj.id
+        return obj_id
 
     def _maybe_create_taxes(self, store):
+        if self._taxes is not None:
+            return self._taxes
+
         icms_template = self._get_or_create(ProductTaxTemplate,
                                             store,
                                             name=u'icms',
@@ -99,29 +120,30 @@ class ProductImporter(CSVImporter):
         taxes = {}
         taxes['icms'] = self._get_or_create(ProductIcmsTemplate,
                                             store,
-                                            product_tax_template=icms_template,
+                                            product_tax_template_id=icms_template,
                                             csosn=102,
                                             orig=2)
         taxes['pis'] = self._get_or_create(ProductPisTemplate,
                                            store=store,
-                                           product_tax_template=pis_template,
+                                           product_tax_template_id=pis_template,
                                            cst=99,
                                            calculo=ProductPisTemplate.CALC_PERCENTAGE,
                                            p_pis=10)
         taxes['cofins'] = self._get_or_create(ProductCofinsTemplate,
                                               store=store,
-                                              product_tax_template=cofins_template,
+                                              product_tax_template_id=cofins_template,
                                               cst=99,
                                               calculo=ProductPisTemplate.CALC_PERCENTAGE,
                                               p_cofins=10)
+        self._taxes = taxes
         return taxes
 
-    def process_one(self, data, fields, store):
-        base_category = self._get_or_create(
+    def _get_category_id(self, data, store):
+        base_category_id = self._get_or_create(
             SellableCategory, store,
             suggested_markup=Decimal(data.markup),
             salesperson_commission=Decimal(data.commission),
-            category=None,
+            category_id=None,
             description=data.base_category)
 
         # create a commission source
@@ -129,39 +151,126 @@ class ProductImporter(CSVImporter):
             CommissionSource, store,
             direct_value=Decimal(data.commission),
             installments_value=Decimal(data.commission2),
-            category=base_category)
+            category_id=base_category_id)
 
-        category = self._get_or_create(
+        return self._get_or_create(
             SellableCategory, store,
             description=data.category,
             suggested_markup=Decimal(data.markup2),
-            category=base_category)
+            category_id=base_category_id)
+
+    def _get_unit_id(self, data, fields):
+        if u'unit' not in fields:
+            return None
+        if not data.unit in self.units:
+            raise ValueError(u"invalid unit: %s" % data.unit)
+        return self.units[data.unit]
+
+    def _get_next_code(self, store):
+        # The codes generated by previous imports
+        max_code = store.execute(
+            "SELECT MAX(code::bigint) FROM sellable "
+            "WHERE code ~ '^[0-9]{1,18}$'").get_one()[0]
+        return (max_code or 0) + 1
+
+    def _check_unique(self, store, attr, values, seen):
+        column = getattr(Sellable, attr)
+        values = set(value for value in values if value)
+        if not values:
+            return
+        duplicated = values & seen
+        if not duplicated:
+            duplicated = set(store.find(column, column.is_in(values)))
+        if duplicated:
+            raise SellableError(u"The sellable %s %r already exists" % (
+                attr, sorted(duplicated)[0]))
+        seen.update(values)
+
+    #
+    # Importer
+    #
+
+    def before_start(self, store):
+        if self.upsert:
+            # Don't generate the codes of the products imported before
+            self._code = max(self._code, self._get_next_code(store))
+
+    def flush(self, store):
+        sellables = self._inserter.get_rows(Sellable)
+        self._check_unique(store, 'code',
+                           [values['code'] for values in sellables],
+                           self._codes)
+        self._check_unique(store, 'barcode',
+                           [values['barcode'] for values in sellables],
+                           self._barcodes)
+        self._inserter.flush(store)
+        super(ProductImporter, self).flush(store)
 
-        sellable = Sellable(store=store,
-                            cost=Decimal(data.cost),
-                            category=category,
-                            description=data.description,
-                            price=Decimal(data.price))
+    def get_checkpoint_state(self):
+        return dict(code=self._code)
+
+    def restore_checkpoint_state(self, state):
+        self._code = state['code']
+
+    #
+    # CSVImporter
+    #
+
+    def get_row_key(self, data):
+        return getattr(data, 'code', None) or data.barcode
+
+    def upsert_one(self, data, fields, store):
+        if getattr(data, 'code', None):
+            sellable = store.find(Sellable, code=data.code).one()
+        else:
+            sellable = store.find(Sellable, barcode=data.barcode).one()
+        if sellable is None or sellable.product is None:
+            self.process_one(data, fields, store)
+            return
+
+        sellable.category_id = self._get_category_id(data, store)
+        sellable.unit_id = self._get_unit_id(data, fields)
+        sellable.description = data.description
         sellable.barcode = data.barcode
-        sellable.code = u'%02d' % self._code
-        self._code += 1
-        if u'unit' in fields:
-            if not data.unit in self.units:
-                raise ValueError(u"invalid unit: %s" % data.unit)
-            sellable.unit = store.fetch(self.units[data.unit])
-        sellable.tax_constant_id = self.tax_constant_id
+        sellable.cost = Decimal(data.cost)
+        sellable.base_price = max(Decimal(data.price), 0)
+
+        product = sellable.product
+        product.ncm = data.ncm
+        supplier_info = product.get_main_supplier_info()
+        if supplier_info is not None:
+            supplier_info.base_cost = Decimal(data.cost)
+
+    def process_one(self, data, fields, store):
+        category_id = self._get_category_id(data, store)
+
+        code = getattr(data, 'code', None)
+        if not code:
+            code = u'%02d' % self._code
+            self._code += 1
 
-        product = Product(store=store, sellable=sellable, ncm=data.ncm)
+        # Sellable.price would be set to the base price, since a new
+        # sellable is never on sale
+        sellable_id = self._inserter.add(
+            Sellable,
+            cost=Decimal(data.cost),
+            category_id=category_id,
+            commission=self._commissions[category_id],
+            description=data.description,
+            base_price=max(Decimal(data.price), 0),
+            barcode=data.barcode,
+            code=code,
+            unit_id=self._get_unit_id(data, fields),
+            tax_constant_id=self.tax_constant_id)
 
         taxes = self._maybe_create_taxes(store)
-        product.set_icms_template(taxes['icms'])
-        product.set_pis_template(taxes['pis'])
-        product.set_cofins_template(taxes['cofins'])
-
-        supplier = store.fetch(self.supplier)
-        ProductSupplierInfo(store=store,
-                            supplier=supplier,
-                            is_main_supplier=True,
-                            base_cost=Decimal(data.cost),
-                            product=product)
-        Storable(product=product, store=store)
+        self._inserter.add(Product, id=sellable_id, ncm=data.ncm,
+                           icms_template_id=taxes['icms'],
+                           pis_template_id=taxes['pis'],
+                           cofins_template_id=taxes['cofins'])
+        self._inserter.add(ProductSupplierInfo,
+                           supplier_id=self.supplier_id,
+                           is_main_supplier=True,
+                           base_cost=Decimal(data.cost),
+                           product_id=sellable_id)
+        self._inserter.add(Storable, id=sellable_id)
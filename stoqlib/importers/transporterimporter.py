@@ -31,6 +31,7 @@ from stoqlib.importers.csvimporter import CSVImporter
 
 
 class TransporterImporter(CSVImporter):
+    partitionable = True
     fields = ['name',
               'phone_number',
               'mobile_number',
@@ -46,6 +47,15 @@ class TransporterImporter(CSVImporter):
               'open_contract',
               'freight_percentage']
 
+    def prepare_partitions(self, store):
+        # city_location is unique, the partitions can't create the same
+        # city at the same time
+        cities = set((data.city, data.state, data.country)
+                     for data in self.iter_rows())
+        for city, state, country in sorted(cities):
+            CityLocation.get_or_create(store=store, city=city, state=state,
+                                       country=country)
+
     def process_one(self, data, fields, store):
         person = Person(
             store=store,
@@ -27,26 +27,90 @@ IBPT - Instituto Brasileiro de Planejamento Tributário (Brazilian Institute
 of Tributary Planning)
 According to Law 12,741 of 12/08/2012 - Taxes in Coupon.
 """
+import bisect
+import csv
+import datetime
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
 from collections import namedtuple
+from decimal import Decimal
 
 from kiwi.environ import environ
 
-import csv
-from decimal import Decimal
-
-from stoqlib.database.runtime import get_current_branch, new_store
+from stoqlib.database.runtime import get_current_branch, get_default_store
 from stoqlib.lib.defaults import quantize
+from stoqlib.lib.osutils import get_application_dir
 from stoqlib.lib.parameters import sysparam
 
-taxes_data = {}
+log = logging.getLogger(__name__)
+
 TaxInfo = namedtuple('TaxInfo', 'nacionalfederal, importadosfederal, estadual,'
                      'fonte, chave')
 
+#: The version of the compiled table format, bump it when changing the format
+INDEX_VERSION = 1
+
+_INDEX_MAGIC = b'IBPT'
+# magic, version, number of records, offset of the strings
+_header = struct.Struct('<4sHII')
+# ncm, ex, vigenciainicio, vigenciafim, nacionalfederal, importadosfederal,
+# estadual and the index of (fonte, chave) in the strings.
+# The dates are ordinals and the taxes are in hundredths of percent
+_record = struct.Struct('<9s2sIIiiiH')
+_KEY_SIZE = 11
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _pack_key(ncm, ex):
+    return ncm.encode('ascii').ljust(9, b'\0') + ex.encode('ascii').ljust(2, b'\0')
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, '%d/%m/%Y').date().toordinal()
+
+
+def _parse_tax(value):
+    return int(Decimal(value) * 100)
+
 
-def load_taxes_csv():
-    """ Load the fields of IBPT table.
+def _format_tax(value):
+    return '%d.%02d' % divmod(value, 100)
 
-    - Fields:
+
+def get_taxes_csv_filename(state):
+    """Gets the IBPT table of a state
+
+    A table on the ``ibpt_tables`` directory of the application dir takes
+    precedence over the one distributed with Stoq, so a newer version of the
+    table can be used by just copying it there.
+
+    :param state: the state, eg ``'SP'``
+    :returns: the filename of the table
+    """
+    basename = 'TabelaIBPTax%s.csv' % (state, )
+    filename = os.path.join(get_application_dir(), 'ibpt_tables', basename)
+    if os.path.exists(filename):
+        return filename
+    return environ.get_resource_filename('stoq', 'csv', 'ibpt_tables',
+                                         basename)
+
+
+def compile_taxes_index(csv_filename, index_filename):
+    """Compiles an IBPT table to an index that can be used by :class:`IBPTTable`
+
+    The index has the taxes of all the products, sorted by ncm and ex, as
+    fixed size records, so they can be searched without loading the index.
+    Services (NBS codes) are not included.
+
+    - The fields of the table are:
         - ncm: Nomenclatura Comum do Sul.
         - ex: Exceção fiscal da NCM.
         - tipo: Código que pertence a uma NCM.
@@ -60,35 +124,205 @@ def load_taxes_csv():
         - chave: Chave que associa a Tabela IBPT baixada com a empresa.
         - versao: Versão das alíquotas usadas para cálculo.
         - Fonte: Fonte
+
+    :param csv_filename: the filename of the IBPT table
+    :param index_filename: the filename of the index, it will be replaced
+      atomically if it already exists
     """
+    records = []
+    strings = []
+    string_ids = {}
+    with open(csv_filename, 'r', encoding='latin1') as f:
+        reader = csv.reader(f, delimiter=';')
+        # The header
+        next(reader)
+        for (ncm, ex, tipo, descricao, nacionalfederal, importadosfederal,
+             estadual, municipal, vigenciainicio, vigenciafim, chave,
+             versao, fonte) in reader:
+            # Ignore service codes (NBS - Nomenclatura Brasileira de Serviços)
+            if tipo == '1':
+                continue
+            string_id = string_ids.get((fonte, chave))
+            if string_id is None:
+                string_id = string_ids[fonte, chave] = len(strings)
+                strings.append((fonte, chave))
+            records.append((_pack_key(ncm, ex),
+                            _parse_date(vigenciainicio),
+                            _parse_date(vigenciafim),
+                            _parse_tax(nacionalfederal),
+                            _parse_tax(importadosfederal),
+                            _parse_tax(estadual),
+                            string_id))
+    records.sort()
 
-    # Avoid load taxes more than once.
-    if taxes_data:
-        return
+    directory = os.path.dirname(index_filename)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            strings_offset = _header.size + _record.size * len(records)
+            f.write(_header.pack(_INDEX_MAGIC, INDEX_VERSION, len(records),
+                                 strings_offset))
+            for key, start, end, nacional, importados, estadual, i in records:
+                f.write(_record.pack(key[:9], key[9:], start, end, nacional,
+                                     importados, estadual, i))
+            f.write(json.dumps(strings).encode())
+        os.replace(tmp_filename, index_filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
 
-    store = new_store()
-    branch = get_current_branch(store)
-    address = branch.person.get_main_address()
-    state = address.city_location.state
 
-    filename = environ.get_resource_filename('stoq', 'csv', 'ibpt_tables',
-                                             'TabelaIBPTax%s.csv' % state)
-    csv_file = (csv.reader(open(filename, "r", encoding='latin1'), delimiter=';'))
+def get_taxes_index_filename(csv_filename):
+    """Gets the index of an IBPT table, compiling it if needed
+
+    The index is kept on the application dir and it is compiled again
+    when the table changes.
+
+    :param csv_filename: the filename of the IBPT table
+    :returns: the filename of the index
+    """
+    stat = os.stat(csv_filename)
+    name = os.path.splitext(os.path.basename(csv_filename))[0]
+    directory = os.path.join(get_application_dir(), 'ibpt')
+    os.makedirs(directory, exist_ok=True)
+    index_filename = os.path.join(directory, '%s-%d-%d-%d.idx' % (
+        name, INDEX_VERSION, stat.st_size, stat.st_mtime_ns))
+    if os.path.exists(index_filename):
+        return index_filename
+
+    log.info('Compiling %s to %s' % (csv_filename, index_filename))
+    compile_taxes_index(csv_filename, index_filename)
+    return index_filename
 
-    for (ncm, ex, tipo, descricao, nacionalfederal, importadosfederal,
-         estadual, municipal, vigenciainicio, vigenciafim, chave,
-         versao, fonte) in csv_file:
-        # Ignore service codes (NBS - Nomenclatura Brasileira de Serviços)
-        if tipo == '1':
+
+def _remove_old_indexes(index_filename):
+    # Remove the indexes of older versions of the table. One that is still
+    # mapped can't be removed on Windows, so it is left to be removed the
+    # next time a table is opened
+    directory, basename = os.path.split(index_filename)
+    name = basename.rsplit('-', 3)[0]
+    for filename in glob.glob(os.path.join(directory, name + '-*.idx')):
+        if filename == index_filename:
             continue
-        tax_dict = taxes_data.setdefault(ncm, {})
-        tax_dict[ex] = TaxInfo(nacionalfederal, importadosfederal, estadual,
-                               fonte, chave)
+        try:
+            os.unlink(filename)
+        except OSError as e:
+            log.info('Could not remove %s: %s' % (filename, e))
+
+
+class _Keys(object):
+    # A sequence of the keys of the records, for bisect
+    def __init__(self, table):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, i):
+        offset = _header.size + _record.size * i
+        return self._table._mmap[offset:offset + _KEY_SIZE]
+
+
+class IBPTTable(object):
+    """An IBPT table, memory mapped from an index
+
+    Only the records that are looked up are read from the index, so the
+    table can be opened instantly and uses almost no memory.
+
+    :param filename: the filename of an index compiled by
+      :func:`compile_taxes_index`
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._n_records, strings_offset = (
+            _header.unpack_from(self._mmap))
+        if magic != _INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%s is not an IBPT index of version %d" % (
+                filename, INDEX_VERSION))
+        self._strings = json.loads(self._mmap[strings_offset:].decode())
+        self._keys = _Keys(self)
+
+    def __len__(self):
+        return self._n_records
+
+    def get(self, ncm, ex='', date=None):
+        """Gets the taxes of a product
+
+        When there is more than one record for the product, the one in
+        effect on *date* is used. If none of them is, the last one that
+        started before it is used, since an outdated table is still better
+        than no table at all.
+
+        :param ncm: the ncm of the product
+        :param ex: the ex tipi of the product, with 2 digits
+        :param date: the date of the sale, defaults to today
+        :returns: a :class:`TaxInfo` or ``None`` if the product is not
+          on the table
+        """
+        try:
+            key = _pack_key(ncm, ex)
+        except UnicodeEncodeError:
+            return None
+        if len(key) != _KEY_SIZE:
+            return None
+
+        date = (date or datetime.date.today()).toordinal()
+        found = None
+        i = bisect.bisect_left(self._keys, key)
+        while i < self._n_records and self._keys[i] == key:
+            record = _record.unpack_from(self._mmap,
+                                         _header.size + _record.size * i)
+            start, end = record[2:4]
+            if found is not None and start > date:
+                break
+            found = record
+            if start <= date <= end:
+                break
+            i += 1
+
+        if found is None:
+            return None
+        nacional, importados, estadual, string_id = found[4:]
+        fonte, chave = self._strings[string_id]
+        return TaxInfo(_format_tax(nacional), _format_tax(importados),
+                       _format_tax(estadual), fonte, chave)
+
+
+def get_taxes_table(state):
+    """Gets the IBPT table of a state
+
+    The table is memory mapped from its index, that is compiled when needed.
+    If the table changes, the next call will return the new version.
+
+    :param state: the state, eg ``'SP'``
+    :returns: an :class:`IBPTTable`
+    """
+    csv_filename = get_taxes_csv_filename(state)
+    index_filename = get_taxes_index_filename(csv_filename)
+    with _tables_lock:
+        table = _tables.get(state)
+        if table is None or table.filename != index_filename:
+            # Drop the old table first, so its index is unmapped as soon
+            # as nobody else is using it
+            _tables.pop(state, None)
+            table = None
+            _remove_old_indexes(index_filename)
+            table = _tables[state] = IBPTTable(index_filename)
+        return table
+
+
+def _get_current_state():
+    branch = get_current_branch(get_default_store())
+    address = branch.person.get_main_address()
+    return address.city_location.state
 
 
 class IBPTGenerator(object):
     def __init__(self, items, include_services=False):
-        load_taxes_csv()
+        self.table = get_taxes_table(_get_current_state())
         self.items = items
         self.include_services = include_services
 
@@ -114,14 +348,10 @@ class IBPTGenerator(object):
             code = '%04d' % int(service.service_list_item_code.replace('.', ''))
             ex_tipi = ''
 
-        options = taxes_data.get(code, {})
-        n_options = len(options)
-        if n_options == 0:
+        tax_values = ((ex_tipi and self.table.get(code, ex_tipi)) or
+                      self.table.get(code))
+        if tax_values is None:
             tax_values = TaxInfo('0', '0', '0', '', '0')
-        elif n_options == 1:
-            tax_values = options['']
-        else:
-            tax_values = options.get(ex_tipi) or options['']
         return tax_values
 
     def _calculate_federal_tax(self, item, tax_values):
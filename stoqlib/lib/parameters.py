@@ -27,11 +27,14 @@ import collections
 from decimal import Decimal
 from uuid import uuid4
 import logging
+import weakref
 
 from kiwi.datatypes import ValidationError
 from kiwi.python import namedAny
 from stoqdrivers.enum import TaxType
+from storm.store import Store
 
+from stoqlib.database.listener import NotifyListener
 from stoqlib.database.runtime import get_default_store
 from stoqlib.domain.parameter import ParameterData
 from stoqlib.enums import (LatePaymentPolicy, ReturnPolicy,
@@ -50,6 +53,9 @@ from stoqlib.lib.validators import (validate_int,
 _ = stoqlib_gettext
 log = logging.getLogger(__name__)
 
+#: The channel notified by the database when a parameter changes
+PARAMETER_DATA_CHANNEL = u'parameter_data'
+
 
 def _credit_limit_salary_changed(new_value, store):
     from stoqlib.domain.person import Client
@@ -1083,6 +1089,11 @@ class ParameterAccess(object):
             self.register_param(detail)
 
         self._values_cache = None
+        # Objects fetched by get_object, store -> {name: weakref(object)}.
+        # The objects reference their store, so keeping them alive here
+        # would also keep the store (the key) alive forever
+        self._objects_cache = weakref.WeakKeyDictionary()
+        self._listener = None
 
     # Lazy Mapping of database raw database values, name -> database value
     @property
@@ -1224,6 +1235,32 @@ class ParameterAccess(object):
         self._values[param_name] = data.field_value
         return data.field_value
 
+    def _on_parameters_changed(self, conn, channel, param_names):
+        # Called by the listener thread when parameters are changed on the
+        # database, by this or other processes
+        values = self._values_cache
+        if values is None:
+            # Nothing loaded yet, the values will be up to date when they are
+            return
+
+        if param_names is None:
+            # We don't know what changed, reload everything on next access
+            self._values_cache = None
+            return
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT field_name, field_value FROM parameter_data "
+                       "WHERE field_name = ANY(%s)", (list(param_names), ))
+        new_values = dict(cursor.fetchall())
+        cursor.close()
+
+        for param_name in param_names:
+            if param_name in new_values:
+                values[param_name] = new_values[param_name]
+            else:
+                values.pop(param_name, None)
+        log.info("Parameters changed: %s" % (', '.join(sorted(param_names)), ))
+
     def _remove_unused_parameters(self, store):
         """
         Remove any  parameter found in ParameterData table which is not
@@ -1245,6 +1282,32 @@ class ParameterAccess(object):
     def clear_cache(self):
         """Clears the internal cache so it can be rebuilt on next access"""
         self._values_cache = None
+        self._objects_cache.clear()
+
+    def start_listening(self):
+        """Keep the cached values up to date with the database
+
+        A background connection will listen to the notifications sent
+        by the database when a parameter changes (by any process) and
+        update only the values that were changed.
+        """
+        if self._listener is not None:
+            return
+
+        self._listener = NotifyListener([PARAMETER_DATA_CHANNEL],
+                                        self._on_parameters_changed)
+        self._listener.start()
+
+    def stop_listening(self):
+        """Stop listening to the parameters changes
+
+        See :meth:`.start_listening` for more information
+        """
+        if self._listener is None:
+            return
+
+        self._listener.stop()
+        self._listener = None
 
     def ensure_system_parameters(self, store, update=False):
         """
@@ -1403,15 +1466,29 @@ class ParameterAccess(object):
         """
         Fetches an object from the database.
 
-        ..note..:: This has to query the database to build an object and
-                   it is slower than other getters, avoid it if you can.
+        The object is cached for each store, so only the first call for
+        a given store needs to query the database.
 
         :param store: a database store
         :param param_name: the parameter name
         :returns: the object
         """
         detail = self._verify_detail(param_name)
-        return self.get(param_name, detail.type, store)
+        objects = self._objects_cache.setdefault(store, {})
+        obj_ref = objects.get(param_name)
+        obj = obj_ref() if obj_ref is not None else None
+        # Make sure the parameter was not changed to another object and
+        # that the object was not removed from the store
+        if (obj is not None and Store.of(obj) is store and
+                obj.id == self._values.get(param_name)):
+            return obj
+
+        obj = self.get(param_name, detail.type, store)
+        if obj is not None:
+            objects[param_name] = weakref.ref(obj)
+        else:
+            objects.pop(param_name, None)
+        return obj
 
     def get_object_id(self, param_name):
         """
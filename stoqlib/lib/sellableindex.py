@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+##
+
+"""Find sellables by their barcode, code or batch number
+
+This is what happens when something is scanned on the POS. The barcodes,
+codes and batch numbers of the available sellables can be kept in memory
+by a :class:`SellableIndex`, which is kept up to date by the notifications
+sent by the database when they change, so most of the lookups don't need
+to query the database.
+"""
+
+import logging
+import threading
+
+from stoqlib.database.listener import NotifyListener
+from stoqlib.domain.product import StorableBatch
+from stoqlib.domain.sellable import Sellable
+
+log = logging.getLogger(__name__)
+
+SELLABLE_LOOKUP_CHANNEL = u'sellable_lookup'
+
+# The barcode has precedence over the code, that has precedence over
+# the batch number
+_LOOKUP_QUERY = """
+    SELECT id, NULL::uuid, 1 FROM sellable
+     WHERE status = ? AND lower(barcode) = ?
+    UNION ALL
+    SELECT id, NULL::uuid, 2 FROM sellable
+     WHERE status = ? AND lower(code) = ?
+    UNION ALL
+    SELECT storable_id, id, 3 FROM storable_batch
+     WHERE lower(batch_number) = ?
+    ORDER BY 3
+    LIMIT 1"""
+
+_SELLABLES_QUERY = """
+    SELECT id, lower(barcode), lower(code) FROM sellable
+     WHERE status = %s"""
+
+_BATCHES_QUERY = """
+    SELECT id, lower(batch_number), storable_id FROM storable_batch"""
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class SellableIndex(object):
+    """An in memory index of the barcodes, codes and batch numbers
+
+    Only the available sellables are indexed. The index is loaded in the
+    background by :meth:`.start`, until then :meth:`.lookup` will not find
+    anything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listener = None
+        self._loaded = False
+        self._barcodes = {}
+        self._codes = {}
+        self._batch_numbers = {}
+        # The indexed keys of each sellable and batch, so they can be
+        # removed when they change
+        self._sellable_keys = {}
+        self._batch_keys = {}
+
+    #
+    #  Public API
+    #
+
+    def start(self):
+        """Loads the index and keeps it up to date with the database"""
+        if self._listener is not None:
+            return
+
+        self._listener = NotifyListener([SELLABLE_LOOKUP_CHANNEL],
+                                        self._on_sellables_changed,
+                                        notify_on_connect=True)
+        self._listener.start()
+
+    def stop(self):
+        """Stops keeping the index up to date and clears it"""
+        if self._listener is None:
+            return
+
+        self._listener.stop()
+        self._listener = None
+        with self._lock:
+            self._clear()
+
+    def is_loaded(self):
+        return self._loaded
+
+    def lookup(self, text):
+        """Looks up a barcode, code or batch number
+
+        :param text: the text that was scanned
+        :returns: a tuple with the id of the sellable and the id of the
+          batch, that is ``None`` unless *text* is a batch number, or
+          ``None`` if nothing was found
+        """
+        text = text.lower()
+        with self._lock:
+            sellable_id = self._barcodes.get(text) or self._codes.get(text)
+            if sellable_id is not None:
+                return sellable_id, None
+            return self._batch_numbers.get(text)
+
+    #
+    #  Private
+    #
+
+    def _clear(self):
+        self._loaded = False
+        self._barcodes.clear()
+        self._codes.clear()
+        self._batch_numbers.clear()
+        self._sellable_keys.clear()
+        self._batch_keys.clear()
+
+    def _remove_sellable(self, sellable_id):
+        barcode, code = self._sellable_keys.pop(sellable_id, (None, None))
+        if self._barcodes.get(barcode) == sellable_id:
+            del self._barcodes[barcode]
+        if self._codes.get(code) == sellable_id:
+            del self._codes[code]
+
+    def _add_sellable(self, sellable_id, barcode, code):
+        self._sellable_keys[sellable_id] = barcode, code
+        if barcode:
+            self._barcodes[barcode] = sellable_id
+        if code:
+            self._codes[code] = sellable_id
+
+    def _remove_batch(self, batch_id):
+        batch_number = self._batch_keys.pop(batch_id, None)
+        value = self._batch_numbers.get(batch_number)
+        if value is not None and value[1] == batch_id:
+            del self._batch_numbers[batch_number]
+
+    def _add_batch(self, batch_id, batch_number, sellable_id):
+        self._batch_keys[batch_id] = batch_number
+        self._batch_numbers[batch_number] = sellable_id, batch_id
+
+    def _load(self, cursor):
+        cursor.execute(_SELLABLES_QUERY, (Sellable.STATUS_AVAILABLE, ))
+        sellables = cursor.fetchall()
+        cursor.execute(_BATCHES_QUERY)
+        batches = cursor.fetchall()
+
+        with self._lock:
+            self._clear()
+            for sellable_id, barcode, code in sellables:
+                self._add_sellable(sellable_id, barcode, code)
+            for batch_id, batch_number, sellable_id in batches:
+                self._add_batch(batch_id, batch_number, sellable_id)
+            self._loaded = True
+        log.info('Indexed %d sellables and %d batches' % (len(sellables),
+                                                          len(batches)))
+
+    def _update(self, cursor, payloads):
+        ids = {}
+        for payload in payloads:
+            table, row_id = payload.split(':', 1)
+            ids.setdefault(table, []).append(row_id)
+
+        sellable_ids = ids.get('sellable', [])
+        cursor.execute(_SELLABLES_QUERY + " AND id = ANY(%s::uuid[])",
+                       (Sellable.STATUS_AVAILABLE, sellable_ids))
+        sellables = cursor.fetchall()
+        batch_ids = ids.get('storable_batch', [])
+        cursor.execute(_BATCHES_QUERY + " WHERE id = ANY(%s::uuid[])",
+                       (batch_ids, ))
+        batches = cursor.fetchall()
+
+        with self._lock:
+            # The ones that are not found were removed or are not
+            # available anymore
+            for sellable_id in sellable_ids:
+                self._remove_sellable(sellable_id)
+            for batch_id in batch_ids:
+                self._remove_batch(batch_id)
+            for sellable_id, barcode, code in sellables:
+                self._add_sellable(sellable_id, barcode, code)
+            for batch_id, batch_number, sellable_id in batches:
+                self._add_batch(batch_id, batch_number, sellable_id)
+
+    #
+    #  Callbacks
+    #
+
+    def _on_sellables_changed(self, conn, channel, payloads):
+        # Called by the listener thread after connecting and when
+        # sellables or batches change
+        cursor = conn.cursor()
+        try:
+            if payloads is None:
+                self._load(cursor)
+            elif self._loaded:
+                self._update(cursor, payloads)
+        finally:
+            cursor.close()
+
+
+def get_sellable_index():
+    """Gets the sellable index shared by the application
+
+    Note that it needs to be started with :meth:`SellableIndex.start`
+    before being used.
+
+    :returns: a :class:`SellableIndex`
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SellableIndex()
+        return _index
+
+
+def find_sellable_and_batch(store, text, index=None):
+    """Finds the available sellable that has a barcode, code or batch number
+
+    The barcode is checked first, then the code and then the batch number.
+    If the *index* is loaded and has the text, the database is only queried
+    to fetch the objects, if they are not already on the *store*. Otherwise,
+    or if the objects found don't match the text anymore because the index
+    was not updated yet, a single indexed query is used.
+
+    :param store: a store
+    :param text: the text that was scanned or typed
+    :param index: a :class:`SellableIndex`, defaults to the one returned by
+      :func:`get_sellable_index`
+    :returns: a tuple with the |sellable| and the |storablebatch| or
+      ``None`` if *text* is not a batch number. If nothing was found,
+      both will be ``None``
+    """
+    if index is None:
+        index = get_sellable_index()
+
+    if index.is_loaded():
+        ids = index.lookup(text)
+        if ids is not None:
+            sellable, batch = _get_sellable_and_batch(store, *ids)
+            if sellable is not None and _matches(sellable, batch, text):
+                return sellable, batch
+
+    # The index is not loaded or it was not updated yet
+    text = text.lower()
+    ids = store.execute(_LOOKUP_QUERY, (Sellable.STATUS_AVAILABLE, text,
+                                        Sellable.STATUS_AVAILABLE, text,
+                                        text)).get_one()
+    if ids is None:
+        return None, None
+    return _get_sellable_and_batch(store, ids[0], ids[1])
+
+
+def _get_sellable_and_batch(store, sellable_id, batch_id):
+    sellable = store.get(Sellable, sellable_id)
+    if sellable is None or not sellable.is_available:
+        return None, None
+    batch = batch_id and store.get(StorableBatch, batch_id)
+    return sellable, batch
+
+
+def _matches(sellable, batch, text):
+    text = text.lower()
+    if batch is not None:
+        return ((batch.batch_number or u'').lower() == text and
+                batch.storable_id == sellable.id)
+    return text in [(sellable.barcode or u'').lower(),
+                    (sellable.code or u'').lower()]
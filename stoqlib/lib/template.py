@@ -23,10 +23,42 @@
 ##
 """ Templating """
 
+import os
+import threading
+
 from kiwi.environ import environ
 from mako.lookup import TemplateLookup
 from mako.template import Template
 
+from stoqlib.lib.osutils import get_application_dir
+
+_lookup = None
+_lookup_lock = threading.Lock()
+
+
+def get_template_lookup():
+    """Gets the lookup used to find the templates
+
+    The lookup is shared by the whole process, so each template is only
+    compiled once. The compiled templates are also saved on the
+    application directory, so they don't need to be compiled again
+    by other processes until the template file changes.
+
+    :returns: a mako.lookup.TemplateLookup
+    """
+    global _lookup
+    with _lookup_lock:
+        if _lookup is None:
+            directories = environ.get_resource_filename('stoq', 'template')
+            module_directory = os.path.join(get_application_dir(),
+                                            'template-cache')
+            _lookup = TemplateLookup(directories=directories,
+                                     module_directory=module_directory,
+                                     output_encoding='utf8',
+                                     input_encoding='utf8',
+                                     default_filters=['h'])
+    return _lookup
+
 
 def render_template(filename, **ns):
     """Renders a template giving a filename and a keyword dictionary
@@ -34,11 +66,7 @@ def render_template(filename, **ns):
     @kwargs: keyword arguments to send to the template
     @return: the rendered template
     """
-    directories = environ.get_resource_filename('stoq', 'template')
-    lookup = TemplateLookup(directories=directories,
-                            output_encoding='utf8', input_encoding='utf8',
-                            default_filters=['h'])
-    tmpl = lookup.get_template(filename)
+    tmpl = get_template_lookup().get_template(filename)
 
     return tmpl.render(**ns).decode()
 
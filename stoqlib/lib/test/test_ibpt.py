@@ -22,12 +22,31 @@
 ##  Author(s): Stoq Team <stoq-devel@async.com.br>
 ##
 
+import datetime
 from decimal import Decimal
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
 
 from stoqlib.database.runtime import get_current_branch
 from stoqlib.domain.taxes import ProductTaxTemplate, ProductIcmsTemplate
 from stoqlib.domain.test.domaintest import DomainTest
-from stoqlib.lib.ibpt import IBPTGenerator, generate_ibpt_message
+from stoqlib.lib.ibpt import (IBPTGenerator, IBPTTable, TaxInfo,
+                              compile_taxes_index, generate_ibpt_message,
+                              get_taxes_table)
+
+IBPT_TABLE = """\
+codigo;ex;tipo;descricao;nacionalfederal;importadosfederal;estadual;municipal;vigenciainicio;vigenciafim;chave;versao;fonte
+01012100;;0;"Cavalos";4.20;6.20;18.00;0.00;01/11/2019;31/01/2020;0C3829;19.2.B;IBPT
+01012100;;0;"Cavalos";5.00;7.00;12.00;0.00;01/02/2020;30/04/2020;0C3830;20.1.A;IBPT
+39269090;;0;"Outras";13.45;24.77;18.00;0.00;01/11/2019;31/01/2020;0C3829;19.2.B;IBPT
+39269090;01;0;"Ex 01";4.20;21.45;18.00;0.00;01/11/2019;31/01/2020;0C3829;19.2.B;IBPT
+0104;;2;"Servicos";13.45;15.45;0.00;0.00;01/11/2019;31/01/2020;0C3829;19.2.B;IBPT
+010101000;;1;"NBS";13.45;15.45;0.00;0.00;01/11/2019;31/01/2020;0C3829;19.2.B;IBPT
+"""
 
 
 class TestCalculateTaxForItem(DomainTest):
@@ -162,3 +181,94 @@ class TestCalculateTaxForItem(DomainTest):
         expected_federal_tax = total_item * (Decimal("21.45") / 100)
         federal = generator._calculate_federal_tax(sale_item, tax_values)
         self.assertEqual(federal, expected_federal_tax)
+
+
+class TestIBPTTable(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'ibpt_tables'))
+        self.csv_filename = os.path.join(self.directory, 'ibpt_tables',
+                                         'TabelaIBPTaxSP.csv')
+        self._write_table(IBPT_TABLE)
+
+        patcher = mock.patch('stoqlib.lib.ibpt.get_application_dir',
+                             return_value=self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_table(self, data):
+        with open(self.csv_filename, 'w', encoding='latin1') as f:
+            f.write(data)
+
+    def _compile(self):
+        filename = os.path.join(self.directory, 'SP.idx')
+        compile_taxes_index(self.csv_filename, filename)
+        return IBPTTable(filename)
+
+    def test_get(self):
+        table = self._compile()
+        # The NBS codes are not included
+        self.assertEqual(len(table), 5)
+
+        date = datetime.date(2019, 12, 1)
+        self.assertEqual(table.get(u'39269090', u'01', date=date),
+                         TaxInfo('4.20', '21.45', '18.00', 'IBPT', '0C3829'))
+        self.assertEqual(table.get(u'39269090', date=date),
+                         TaxInfo('13.45', '24.77', '18.00', 'IBPT', '0C3829'))
+        self.assertEqual(table.get(u'0104', date=date).nacionalfederal,
+                         '13.45')
+        self.assertIsNone(table.get(u'39269090', u'02', date=date))
+        self.assertIsNone(table.get(u'99999999', date=date))
+        self.assertIsNone(table.get(u'010101000', date=date))
+        self.assertIsNone(table.get(u''))
+        self.assertIsNone(table.get(u'1234567890'))
+
+    def test_get_date(self):
+        table = self._compile()
+        for date, chave in [
+                # Before the first one starts, the first one
+                (datetime.date(2019, 1, 1), '0C3829'),
+                (datetime.date(2019, 11, 1), '0C3829'),
+                (datetime.date(2020, 1, 31), '0C3829'),
+                (datetime.date(2020, 2, 1), '0C3830'),
+                # After the last one ends, the last one
+                (datetime.date(2021, 1, 1), '0C3830')]:
+            self.assertEqual(table.get(u'01012100', date=date).chave, chave)
+
+    def test_get_taxes_table(self):
+        table = get_taxes_table('SP')
+        self.assertIs(get_taxes_table('SP'), table)
+        self.assertEqual(table.get(u'39269090').nacionalfederal, '13.45')
+
+        # A new version of the table is used as soon as it is there
+        self._write_table(IBPT_TABLE.replace('13.45;24.77', '14.00;24.77'))
+        os.utime(self.csv_filename, ns=(0, 0))
+        new_table = get_taxes_table('SP')
+        self.assertIsNot(new_table, table)
+        self.assertEqual(new_table.get(u'39269090').nacionalfederal, '14.00')
+        # And the index of the old one is removed
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'ibpt')),
+                         [os.path.basename(new_table.filename)])
+
+    def test_get_taxes_table_index_in_use(self):
+        table = get_taxes_table('SP')
+        old_basename = os.path.basename(table.filename)
+        self._write_table(IBPT_TABLE.replace('13.45;24.77', '14.00;24.77'))
+        os.utime(self.csv_filename, ns=(0, 0))
+
+        # On Windows, an index that is still mapped can't be removed
+        with mock.patch('os.unlink', side_effect=PermissionError):
+            new_table = get_taxes_table('SP')
+        new_basename = os.path.basename(new_table.filename)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.directory, 'ibpt'))),
+            sorted([old_basename, new_basename]))
+        # The old table is still usable by whoever holds it
+        self.assertEqual(table.get(u'39269090').nacionalfederal, '13.45')
+
+        # It is removed the next time the table is opened
+        with mock.patch.dict('stoqlib.lib.ibpt._tables', clear=True):
+            get_taxes_table('SP')
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'ibpt')),
+                         [new_basename])
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+
+from decimal import Decimal
+from io import StringIO
+from concurrent import futures
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+
+import mock
+
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.address import CityLocation
+from stoqlib.domain.person import Individual
+from stoqlib.domain.product import Product, Storable
+from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.exceptions import SellableError
+from stoqlib.importers.clientimporter import ClientImporter
+from stoqlib.importers.importer import BulkInserter, Importer
+from stoqlib.importers.parallelimporter import (ParallelImporter,
+                                                get_importer_type)
+from stoqlib.importers.productimporter import ProductImporter
+
+
+PRODUCTS_DATA = u"""\
+% base_category, barcode, category, description, price,
+% cost, commission, commission2, markup, markup2, ncm
+Bulk Bermudas,9900000000011,Bulk Sarja,Bulk Bermuda 1,149,70,15,28,36,15,61046300
+Bulk Bermudas,9900000000028,Bulk Sarja,Bulk Bermuda 2,129,60,15,28,36,15,61046300
+Bulk Bermudas,9900000000035,Bulk Jeans,Bulk Bermuda 3,99,40,15,28,36,15,61046300
+"""
+
+CLIENTS_DATA = (
+    u"Bulk Client 1,8653-7694,2482-1710,,5.251.375-B,900.000.001-01,"
+    u"Curitiba,Brazil,PR,Rua XV de Novembro,342,Centro\n"
+    u"Bulk Client 2,4201-2545,5456-6233,,23.352.315-5,900.000.002-02,"
+    u"Rio Claro,Brazil,SP,Avenida Paulista,213,Brigadeiro\n")
+
+
+class _ListImporter(Importer):
+    def __init__(self, items):
+        Importer.__init__(self, items=2)
+        self.values = items
+        self.processed = []
+
+    def get_n_items(self):
+        return len(self.values)
+
+    def process_item(self, store, i):
+        self.processed.append(self.values[i])
+        return True
+
+
+class ImporterTest(DomainTest):
+
+    def _process(self, importer):
+        stores = []
+
+        def _new_store():
+            store = mock.Mock()
+            stores.append(store)
+            return store
+
+        with mock.patch('stoqlib.importers.importer.new_store',
+                        side_effect=_new_store):
+            importer.process()
+        return stores
+
+    def test_process_items_per_commit(self):
+        importer = _ListImporter(['a', 'b', 'c', 'd', 'e'])
+        with mock.patch.object(importer, 'flush') as flush:
+            stores = self._process(importer)
+
+        self.assertEqual(importer.processed, ['a', 'b', 'c', 'd', 'e'])
+        # One store for each 2 items, one for the remaining item and one
+        # for when_done
+        self.assertEqual(len(stores), 4)
+        for store in stores:
+            store.commit.assert_called_once_with(close=True)
+        self.assertEqual(flush.call_count, 3)
+
+    def test_process_partition(self):
+        importer = _ListImporter(['a', 'b', 'c', 'd', 'e'])
+        with self.assertRaises(ValueError):
+            importer.set_partition(1, 2)
+
+        importer.partitionable = True
+        importer.set_partition(1, 2)
+        self._process(importer)
+        self.assertEqual(importer.processed, ['b', 'd'])
+
+    def test_process_checkpoint(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(lambda: os.path.exists(filename) and
+                        os.unlink(filename))
+        with open(filename, 'w') as fh:
+            json.dump(dict(items=2, state=dict(foo=1)), fh)
+
+        importer = _ListImporter(['a', 'b', 'c', 'd', 'e'])
+        importer.set_checkpoint_file(filename)
+        with mock.patch.object(importer, 'restore_checkpoint_state') as restore:
+            with mock.patch.object(importer, '_save_checkpoint') as save:
+                self._process(importer)
+
+        restore.assert_called_once_with(dict(foo=1))
+        self.assertEqual(importer.processed, ['c', 'd', 'e'])
+        save.assert_called_once_with(4)
+        # The import finished, there's nothing else to resume
+        self.assertFalse(os.path.exists(filename))
+
+
+class BulkInserterTest(DomainTest):
+
+    def test_flush(self):
+        inserter = BulkInserter()
+        inserter.rows_per_statement = 2
+        ids = [inserter.add(Sellable, description=u'Bulk %d' % (i, ),
+                            cost=Decimal(i))
+               for i in range(5)]
+        self.assertEqual(len(inserter), 5)
+        self.assertEqual(len(inserter.get_rows(Sellable)), 5)
+
+        inserter.flush(self.store)
+        self.assertEqual(len(inserter), 0)
+        sellables = self.store.find(Sellable, Sellable.id.is_in(ids))
+        self.assertEqual(
+            sorted((s.description, s.cost, s.status) for s in sellables),
+            [(u'Bulk %d' % (i, ), Decimal(i), Sellable.STATUS_AVAILABLE)
+             for i in range(5)])
+
+
+class ProductImporterTest(DomainTest):
+
+    def _create_importer(self, data=PRODUCTS_DATA, upsert=False):
+        importer = ProductImporter()
+        importer.set_dry(True)
+        importer.set_upsert(upsert)
+        importer.restore_checkpoint_state(dict(code=900000))
+        with mock.patch('stoqlib.importers.csvimporter.new_store',
+                        return_value=self.store):
+            with mock.patch.object(self.store, 'commit'):
+                importer.feed(StringIO(data))
+        return importer
+
+    def test_process(self):
+        importer = self._create_importer()
+        importer.process(self.store)
+
+        sellables = self.store.find(
+            Sellable, Sellable.description.startswith(u'Bulk Bermuda'))
+        self.assertEqual(sellables.count(), 3)
+        for sellable in sellables:
+            self.assertTrue(sellable.code.startswith(u'90000'))
+            self.assertEqual(sellable.price, sellable.base_price)
+            self.assertEqual(sellable.commission,
+                             sellable.category.get_commission())
+            product = self.store.get(Product, sellable.id)
+            self.assertEqual(product.ncm, u'61046300')
+            self.assertIsNotNone(product.icms_template)
+            self.assertEqual(product.get_main_supplier_info().base_cost,
+                             sellable.cost)
+            self.assertIsNotNone(self.store.get(Storable, sellable.id))
+
+        self.assertEqual(importer.get_checkpoint_state(), dict(code=900003))
+
+    def test_process_existing_barcode(self):
+        sellable = self.create_sellable()
+        sellable.barcode = u'9900000000028'
+        importer = self._create_importer()
+        with self.assertRaises(SellableError):
+            importer.process(self.store)
+
+    def test_process_upsert(self):
+        importer = self._create_importer(upsert=True)
+        self.assertEqual(importer.process(self.store), 3)
+        sellable = self.store.find(Sellable, barcode=u'9900000000028').one()
+        self.assertEqual(sellable.base_price, 129)
+
+        # Only the changed row is updated
+        data = PRODUCTS_DATA.replace(u'Bulk Bermuda 2,129',
+                                     u'Bulk Bermuda 2,139')
+        importer = self._create_importer(data, upsert=True)
+        self.assertEqual(importer.process(self.store), 1)
+        sellables = self.store.find(
+            Sellable, Sellable.description.startswith(u'Bulk Bermuda'))
+        self.assertEqual(sellables.count(), 3)
+        self.assertEqual(sellable.base_price, 139)
+
+        importer = self._create_importer(data, upsert=True)
+        self.assertEqual(importer.process(self.store), 0)
+
+    def test_process_upsert_duplicated_key(self):
+        # The same product twice in the same chunk
+        data = PRODUCTS_DATA + (u"Bulk Bermudas,9900000000028,Bulk Sarja,"
+                                u"Bulk Bermuda 2,139,60,15,28,36,15,61046300\n")
+        importer = self._create_importer(data, upsert=True)
+        self.assertEqual(importer.process(self.store), 4)
+        sellables = self.store.find(Sellable, barcode=u'9900000000028')
+        self.assertEqual(sellables.count(), 1)
+        self.assertEqual(sellables.one().base_price, 139)
+
+
+class ClientImporterTest(DomainTest):
+
+    def _process(self, data):
+        importer = ClientImporter()
+        importer.set_dry(True)
+        importer.set_upsert(True)
+        with mock.patch('stoqlib.importers.csvimporter.new_store',
+                        return_value=self.store):
+            with mock.patch.object(self.store, 'commit'):
+                importer.feed(StringIO(data))
+        return importer.process(self.store)
+
+    def test_process_upsert(self):
+        data = CLIENTS_DATA
+        self.assertEqual(self._process(data), 2)
+        individual = self.store.find(Individual, cpf=u'900.000.001-01').one()
+        self.assertEqual(individual.person.name, u'Bulk Client 1')
+        self.assertIsNotNone(individual.person.client)
+
+        data = data.replace(u'Rua XV de Novembro,342',
+                            u'Rua XV de Novembro,343')
+        self.assertEqual(self._process(data), 1)
+        self.assertEqual(
+            self.store.find(Individual, cpf=u'900.000.001-01').count(), 1)
+        self.assertEqual(individual.person.get_main_address().streetnumber,
+                         343)
+
+    def test_process_partitions_same_city(self):
+        # Both clients live on a city that is not on the database yet
+        city = u'Bulk City %s' % (uuid.uuid4().hex, )
+        data = CLIENTS_DATA.replace(u'Curitiba', city).replace(
+            u'Rio Claro,Brazil,SP', city + u',Brazil,PR')
+
+        def _create_importer(partition):
+            importer = ClientImporter()
+            importer.set_dry(True)
+            importer.set_partition(partition, 2)
+            with mock.patch('stoqlib.importers.csvimporter.new_store',
+                            return_value=self.store):
+                with mock.patch.object(self.store, 'commit'):
+                    importer.feed(StringIO(data))
+            return importer
+
+        def _remove_city():
+            with new_store() as store:
+                store.find(CityLocation, city=city).remove()
+        self.addCleanup(_remove_city)
+        with new_store() as store:
+            _create_importer(0).prepare_partitions(store)
+
+        # Import the partitions on two transactions at the same time
+        stores = []
+        for partition in range(2):
+            store = new_store()
+            self.addCleanup(store.close)
+            self.addCleanup(store.rollback, close=False)
+            # Fail instead of waiting for the other transaction to finish
+            store.execute("SET LOCAL lock_timeout = '5s'")
+            self.assertEqual(_create_importer(partition).process(store), 1)
+            store.flush()
+            stores.append(store)
+
+        city_location = self.store.find(CityLocation, city=city).one()
+        for store, cpf in zip(stores, [u'900.000.001-01', u'900.000.002-02']):
+            individual = store.find(Individual, cpf=cpf).one()
+            self.assertEqual(
+                individual.person.get_main_address().city_location_id,
+                city_location.id)
+
+
+class ParallelImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in ['branches.csv', 'suppliers.csv', 'products.csv',
+                     'clients.csv', 'purchases.csv', 'unknown.csv']:
+            open(os.path.join(self.directory, name), 'w').close()
+
+    def test_get_importer_type(self):
+        self.assertEqual(get_importer_type('/tmp/products.csv'), 'product.csv')
+        self.assertEqual(get_importer_type('product.csv'), 'product.csv')
+        self.assertEqual(get_importer_type('branches.csv'), 'branch.csv')
+        self.assertEqual(get_importer_type('transactions.csv'),
+                         'transaction.csv')
+        self.assertIsNone(get_importer_type('unknown.csv'))
+
+    def test_get_dependencies(self):
+        importer = ParallelImporter(self.directory)
+        files = importer.get_files()
+        self.assertEqual(sorted(files), ['branch.csv', 'client.csv',
+                                         'product.csv', 'purchase.csv',
+                                         'supplier.csv'])
+        self.assertEqual(importer.get_dependencies(files), {
+            'branch.csv': set(),
+            'client.csv': set(['branch.csv']),
+            'product.csv': set(['supplier.csv']),
+            'purchase.csv': set(['branch.csv', 'product.csv',
+                                 'supplier.csv']),
+            'supplier.csv': set(['branch.csv'])})
+
+    def test_process(self):
+        lock = threading.Lock()
+        finished = []
+        calls = []
+
+        def _import_file(importer_type, filename, partition, n_partitions,
+                         dry):
+            with lock:
+                calls.append((importer_type, partition, n_partitions))
+            deps = ParallelImporter(self.directory).get_dependencies(
+                {importer_type: None, 'branch.csv': None,
+                 'supplier.csv': None, 'product.csv': None})
+            # The dependencies were already imported
+            self.assertTrue(deps[importer_type].issubset(finished))
+            with lock:
+                finished.append(importer_type)
+            return 10, 1
+
+        def _create_executor(workers, mp_context):
+            return futures.ThreadPoolExecutor(workers)
+
+        importer = ParallelImporter(self.directory, workers=2)
+        with mock.patch('stoqlib.importers.parallelimporter._prepare_file') as prepare_file, \
+                mock.patch('stoqlib.importers.parallelimporter._import_file',
+                           new=_import_file), \
+                mock.patch('stoqlib.importers.parallelimporter.futures.'
+                           'ProcessPoolExecutor', new=_create_executor), \
+                mock.patch('stoqlib.importers.parallelimporter.'
+                           'set_default_store') as set_default_store:
+            stats = importer.process()
+
+        set_default_store.assert_called_once_with(None)
+        # The objects shared by the partitions are created before them
+        prepare_file.assert_called_once_with(
+            'client.csv', os.path.join(self.directory, 'clients.csv'))
+        # Clients are partitioned between the workers
+        self.assertIn(('client.csv', 0, 2), calls)
+        self.assertIn(('client.csv', 1, 2), calls)
+        self.assertIn(('product.csv', 0, 1), calls)
+        self.assertEqual(len(calls), 6)
+
+        stats = dict((stat.importer_type, stat) for stat in stats)
+        self.assertEqual(len(stats), 5)
+        self.assertEqual(stats['client.csv'].items, 20)
+        self.assertEqual(stats['product.csv'].items, 10)
+        self.assertEqual(stats['purchase.csv'].filename,
+                         os.path.join(self.directory, 'purchases.csv'))
@@ -24,8 +24,14 @@
 """ Test for lib/parameters module.  """
 
 from decimal import Decimal
+import gc
+import weakref
 
-from stoqlib.lib.parameters import sysparam
+import mock
+
+from stoqlib.database.runtime import new_store
+from stoqlib.lib.parameters import (ParameterAccess, PARAMETER_DATA_CHANNEL,
+                                    sysparam)
 from stoqlib.domain.address import CityLocation
 from stoqlib.domain.person import (Branch, Client, Company, Employee,
                                    EmployeeRole, Individual, LoginUser,
@@ -222,3 +228,75 @@ class TestParameter(DomainTest):
     def test_default_label_columns(self):
         param = self.sparam.get_string('LABEL_COLUMNS')
         self.assertEqual(param, 'code,barcode,description,price')
+
+    def test_get_object_cache(self):
+        with mock.patch.object(self.store, 'get',
+                               wraps=self.store.get) as get:
+            company = self.sparam.get_object(self.store, 'MAIN_COMPANY')
+            self.assertIs(self.sparam.get_object(self.store, 'MAIN_COMPANY'),
+                          company)
+            self.assertEqual(get.call_count, 1)
+
+        # Changing the parameter should not return the cached object
+        role = self.create_employee_role()
+        old_role = self.sparam.get_object(self.store, 'DEFAULT_SALESPERSON_ROLE')
+        try:
+            self.sparam.set_object(self.store, 'DEFAULT_SALESPERSON_ROLE', role)
+            self.assertIs(
+                self.sparam.get_object(self.store, 'DEFAULT_SALESPERSON_ROLE'),
+                role)
+        finally:
+            self.sparam.set_object(self.store, 'DEFAULT_SALESPERSON_ROLE',
+                                   old_role)
+
+    def test_get_object_cache_store_leak(self):
+        store = new_store()
+        try:
+            self.assertIsNotNone(self.sparam.get_object(store, 'MAIN_COMPANY'))
+        finally:
+            store.close()
+
+        store_ref = weakref.ref(store)
+        del store
+        gc.collect()
+        # The cached objects should not keep the store alive
+        self.assertIsNone(store_ref())
+
+    def test_on_parameters_changed(self):
+        access = ParameterAccess()
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchall.return_value = [
+            (u'POS_FULL_SCREEN', u'1')]
+
+        # Nothing loaded yet, there's nothing to update
+        access._on_parameters_changed(conn, PARAMETER_DATA_CHANNEL,
+                                      set([u'POS_FULL_SCREEN']))
+        self.assertEqual(conn.cursor.call_count, 0)
+
+        access._values_cache = {u'POS_FULL_SCREEN': u'0',
+                                u'POS_SEPARATE_CASHIER': u'0',
+                                u'ALLOW_OUTDATED_OPERATIONS': u'0'}
+        access._on_parameters_changed(
+            conn, PARAMETER_DATA_CHANNEL,
+            set([u'POS_FULL_SCREEN', u'ALLOW_OUTDATED_OPERATIONS']))
+        # Only the changed values were updated. The ones not found were removed
+        self.assertEqual(access._values_cache,
+                         {u'POS_FULL_SCREEN': u'1',
+                          u'POS_SEPARATE_CASHIER': u'0'})
+        self.assertTrue(access.get_bool(u'POS_FULL_SCREEN'))
+
+        # Notifications were lost, everything needs to be reloaded
+        access._on_parameters_changed(conn, PARAMETER_DATA_CHANNEL, None)
+        self.assertIsNone(access._values_cache)
+
+    def test_start_listening(self):
+        access = ParameterAccess()
+        with mock.patch('stoqlib.lib.parameters.NotifyListener') as listener:
+            access.start_listening()
+            access.start_listening()
+            listener.assert_called_once_with([PARAMETER_DATA_CHANNEL],
+                                             access._on_parameters_changed)
+            listener.return_value.start.assert_called_once_with()
+
+            access.stop_listening()
+            listener.return_value.stop.assert_called_once_with()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import mock
+
+from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.lib.sellableindex import (SELLABLE_LOOKUP_CHANNEL, SellableIndex,
+                                       find_sellable_and_batch)
+
+
+class TestSellableIndex(DomainTest):
+    def setUp(self):
+        super(TestSellableIndex, self).setUp()
+        self.sellable = self.create_sellable(code=u'CODE-1', storable=True)
+        self.sellable.barcode = u'BARCODE-1'
+        self.batch = self.create_storable_batch(
+            storable=self.sellable.product.storable, batch_number=u'BATCH-1')
+        self.store.flush()
+        self.index = SellableIndex()
+
+    def _notify(self, payloads=None):
+        # The notifications are handled on the listener connection, use
+        # the connection of the test store so it can see the changes
+        self.store.flush()
+        conn = self.store._connection._raw_connection
+        self.index._on_sellables_changed(conn, SELLABLE_LOOKUP_CHANNEL,
+                                         payloads)
+
+    def test_lookup(self):
+        self.assertFalse(self.index.is_loaded())
+        self.assertIsNone(self.index.lookup(u'BARCODE-1'))
+
+        self._notify()
+        self.assertTrue(self.index.is_loaded())
+        self.assertEqual(self.index.lookup(u'barcode-1'),
+                         (self.sellable.id, None))
+        self.assertEqual(self.index.lookup(u'Code-1'),
+                         (self.sellable.id, None))
+        self.assertEqual(self.index.lookup(u'BATCH-1'),
+                         (self.sellable.id, self.batch.id))
+        self.assertIsNone(self.index.lookup(u'NOTHING'))
+
+    def test_lookup_changes(self):
+        self._notify()
+
+        self.sellable.barcode = u'BARCODE-2'
+        self.batch.batch_number = u'BATCH-2'
+        other = self.create_sellable(code=u'CODE-3')
+        self._notify(set([u'sellable:' + self.sellable.id,
+                          u'sellable:' + other.id,
+                          u'storable_batch:' + self.batch.id]))
+        self.assertIsNone(self.index.lookup(u'BARCODE-1'))
+        self.assertEqual(self.index.lookup(u'BARCODE-2'),
+                         (self.sellable.id, None))
+        self.assertIsNone(self.index.lookup(u'BATCH-1'))
+        self.assertEqual(self.index.lookup(u'BATCH-2'),
+                         (self.sellable.id, self.batch.id))
+        self.assertEqual(self.index.lookup(u'CODE-3'), (other.id, None))
+
+        # Only the available sellables are indexed
+        self.sellable.status = Sellable.STATUS_CLOSED
+        self._notify(set([u'sellable:' + self.sellable.id]))
+        self.assertIsNone(self.index.lookup(u'BARCODE-2'))
+        self.assertIsNone(self.index.lookup(u'CODE-1'))
+
+    def test_start(self):
+        with mock.patch('stoqlib.lib.sellableindex.NotifyListener') as listener:
+            self.index.start()
+            self.index.start()
+        listener.assert_called_once_with([SELLABLE_LOOKUP_CHANNEL],
+                                         self.index._on_sellables_changed,
+                                         notify_on_connect=True)
+        listener.return_value.start.assert_called_once_with()
+
+        self._notify()
+        self.index.stop()
+        listener.return_value.stop.assert_called_once_with()
+        self.assertFalse(self.index.is_loaded())
+
+    def test_find_sellable_and_batch(self):
+        # The first time without the index loaded, the second with it
+        for i in range(2):
+            self.assertEqual(
+                find_sellable_and_batch(self.store, u'barcode-1', self.index),
+                (self.sellable, None))
+            self.assertEqual(
+                find_sellable_and_batch(self.store, u'CODE-1', self.index),
+                (self.sellable, None))
+            self.assertEqual(
+                find_sellable_and_batch(self.store, u'BATCH-1', self.index),
+                (self.sellable, self.batch))
+            self.assertEqual(
+                find_sellable_and_batch(self.store, u'NOTHING', self.index),
+                (None, None))
+            self._notify()
+
+    def test_find_sellable_and_batch_barcode_precedence(self):
+        self.create_sellable(code=u'BARCODE-1')
+        self._notify()
+        self.assertEqual(
+            find_sellable_and_batch(self.store, u'BARCODE-1', self.index),
+            (self.sellable, None))
+        self.assertEqual(
+            find_sellable_and_batch(self.store, u'BARCODE-1',
+                                    SellableIndex()),
+            (self.sellable, None))
+
+    def test_find_sellable_and_batch_not_available(self):
+        self._notify()
+        # The index was not updated yet
+        self.sellable.status = Sellable.STATUS_CLOSED
+        for text in [u'BARCODE-1', u'CODE-1', u'BATCH-1']:
+            self.assertEqual(
+                find_sellable_and_batch(self.store, text, self.index),
+                (None, None))
+
+    def test_find_sellable_and_batch_stale_index(self):
+        self._notify()
+        # The index was not updated yet, but the query is used when the
+        # objects found don't match the text anymore
+        self.sellable.barcode = u'BARCODE-2'
+        self.batch.batch_number = u'BATCH-2'
+        other = self.create_sellable()
+        other.barcode = u'BARCODE-1'
+        self.store.flush()
+        self.assertEqual(
+            find_sellable_and_batch(self.store, u'BARCODE-1', self.index),
+            (other, None))
+        self.assertEqual(
+            find_sellable_and_batch(self.store, u'BATCH-1', self.index),
+            (None, None))
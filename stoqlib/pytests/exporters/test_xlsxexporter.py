@@ -0,0 +1,84 @@
+from decimal import Decimal
+import datetime
+import io
+import os
+import zipfile
+
+import pytest
+
+from stoqlib.database.properties import Identifier
+from stoqlib.exporters.csvexporter import CSVExporter
+from stoqlib.exporters.xlsxexporter import XLSXExporter
+
+
+@pytest.fixture
+def xlsx_exporter():
+    exporter = XLSXExporter()
+    yield exporter
+    temporary = exporter.save()
+    temporary.close()
+    os.unlink(temporary.name)
+
+
+def _export(exporter, rows):
+    exporter.set_column_types([str, int, datetime.date])
+    exporter.set_column_headers(['Name', 'Quantity', 'Date'])
+    exporter.add_cells(iter(rows), filter_description='Description')
+    temporary = exporter.save('prefix')
+    data = temporary.read()
+    temporary.close()
+    os.unlink(temporary.name)
+    assert os.path.basename(temporary.name).startswith('Stoq-prefix-')
+    return data
+
+
+@pytest.mark.parametrize('data, expected_value', (
+    (None, ''),
+    (69, '<c r="A2" s="0"><v>69</v></c>'),
+    (Decimal('6.9'), '<c r="A2" s="0"><v>6.9</v></c>'),
+    (datetime.date(2020, 1, 7), '<c r="A2" s="0"><v>43837.0</v></c>'),
+    (datetime.datetime(2020, 1, 7, 12), '<c r="A2" s="0"><v>43837.5</v></c>'),
+    ('a < b', ('<c r="A2" s="0" t="inlineStr"><is>'
+               '<t xml:space="preserve">a &lt; b</t></is></c>')),
+    (b'foo', ('<c r="A2" s="0" t="inlineStr"><is>'
+              '<t xml:space="preserve">foo</t></is></c>')),
+    (Identifier(69), ('<c r="A2" s="0" t="inlineStr"><is>'
+                      '<t xml:space="preserve">00069</t></is></c>')),
+))
+def test_xlsx_exporter_format_one(xlsx_exporter, data, expected_value):
+    xlsx_exporter._current_row = 2
+
+    assert xlsx_exporter._format_one(0, data, style=0) == expected_value
+
+
+def test_xlsx_exporter_add_cells():
+    rows = [['Apple', i, datetime.date(2020, 1, 7)] for i in range(70000)]
+    data = _export(XLSXExporter('Fruits'), rows)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as xlsx:
+        assert b'name="Fruits"' in xlsx.read('xl/workbook.xml')
+        sheet = xlsx.read('xl/worksheets/sheet1.xml').decode()
+
+    # More rows than xls files support
+    assert '<row r="70002"><c r="A70002" s="0" t="inlineStr">' in sheet
+    assert 'HYPERLINK(' in sheet
+    assert 'Description' in sheet
+
+
+def test_xlsx_exporter_too_many_columns(xlsx_exporter):
+    xlsx_exporter.set_column_types([str])
+    with pytest.raises(ValueError):
+        xlsx_exporter.add_cells([['foo', 'bar']])
+
+
+def test_csv_exporter_add_cells():
+    data = _export(CSVExporter(), [['Apple', 1, datetime.date(2020, 1, 7)],
+                                   ['Kiwi', None, None],
+                                   [Identifier(69), 2, None]])
+
+    assert data.decode('utf-8-sig').splitlines() == [
+        'Name,Quantity,Date',
+        'Apple,1,2020-01-07',
+        'Kiwi,,',
+        '00069,2,',
+    ]
@@ -20,6 +20,8 @@
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 ##
 
+import itertools
+import logging
 import os
 import platform
 
@@ -35,6 +37,7 @@ from stoqlib.lib.formatters import (get_formatted_price, get_formatted_cost,
                                     get_formatted_percentage)
 from stoqlib.reporting.utils import get_logo_data
 _ = stoqlib_gettext
+log = logging.getLogger(__name__)
 
 
 class HTMLReport(object):
@@ -80,6 +83,13 @@ class HTMLReport(object):
         html.flush()
 
     def render(self, stylesheet=None):
+        return self._render_html(self.get_html(), stylesheet)
+
+    def save(self):
+        document = self.render(stylesheet='')
+        document.write_pdf(self.filename)
+
+    def _render_html(self, html, stylesheet):
         import weasyprint
 
         template_dir = environ.get_resource_filename('stoq', 'template')
@@ -87,15 +97,10 @@ class HTMLReport(object):
             # FIXME: Figure out why this is breaking
             # On windows, weasyprint is eating the last directory of the path
             template_dir = os.path.join(template_dir, 'foobar')
-        html = weasyprint.HTML(string=self.get_html(),
-                               base_url=template_dir)
+        html = weasyprint.HTML(string=html, base_url=template_dir)
 
         return html.render(stylesheets=[weasyprint.CSS(string=stylesheet)])
 
-    def save(self):
-        document = self.render(stylesheet='')
-        document.write_pdf(self.filename)
-
     #
     # Hook methods
     #
@@ -140,6 +145,12 @@ class TableReport(HTMLReport):
     #:
     template_filename = "objectlist.html"
 
+    #: The maximum number of rows that will be laid out at once. Reports
+    #: with more rows than this are rendered in chunks of this size, which
+    #: have their pages merged in the end, since laying out a huge table
+    #: at once is too slow and uses too much memory
+    chunk_size = 2000
+
     def __init__(self, filename, data, title=None, blocked_records=0,
                  status_name=None, filter_strings=None, status=None):
         self.title = title or self.title
@@ -152,6 +163,12 @@ class TableReport(HTMLReport):
         self.data = data
         self.columns = self.get_columns()
 
+        # The chunk being rendered, see render()
+        self._chunk = None
+        self.part_label = None
+        self.is_first_chunk = True
+        self.is_last_chunk = True
+
         self._setup_details()
         HTMLReport.__init__(self, filename)
 
@@ -159,7 +176,7 @@ class TableReport(HTMLReport):
         """ This method build the report title based on the arguments sent
         by SearchBar to its class constructor.
         """
-        rows = len(self.data)
+        rows = self.n_rows = self._count_rows()
         total_rows = rows + self.blocked_records
         item = stoqlib_ngettext(self.main_object_name[0],
                                 self.main_object_name[1], total_rows)
@@ -178,12 +195,110 @@ class TableReport(HTMLReport):
                 notes.append(filter_string)
         self.notes = notes
 
+    def _count_rows(self):
+        # Count result sets on the database, without fetching their rows
+        if hasattr(self.data, 'iter_pages'):
+            return self.data.count()
+        return len(self.data)
+
+    def _iter_data(self):
+        # Fetch the result sets one chunk at a time
+        if hasattr(self.data, 'iter_pages'):
+            return self.data.iter_pages(self.chunk_size)
+        return iter(self.data)
+
+    def _iter_chunks(self):
+        data = self._iter_data()
+        chunk = list(itertools.islice(data, self.chunk_size))
+        while chunk:
+            # Fetch the next chunk now to know if this is the last one
+            next_chunk = list(itertools.islice(data, self.chunk_size))
+            yield chunk, not next_chunk
+            chunk = next_chunk
+
     def get_data(self):
-        self.reset()
-        for obj in self.data:
+        if self._chunk is not None:
+            # Rendering in chunks, reset() was called on the first one
+            data = self._chunk
+        else:
+            self.reset()
+            data = self.data
+
+        for obj in data:
             self.accumulate(obj)
             yield self.get_row(obj)
 
+    def render(self, stylesheet=None, progress_callback=None):
+        """Renders the report
+
+        If the report has more than :attr:`.chunk_size` rows, they will be
+        laid out in chunks of that size and the pages of all the chunks
+        merged in the end. The summaries from :meth:`.accumulate` carry
+        across the chunks and the summary row is only in the last one.
+
+        :param stylesheet: an extra css stylesheet to use
+        :param progress_callback: if not ``None``, will be called as
+          ``progress_callback(rendered_rows, total_rows)`` after each
+          chunk is rendered
+        :returns: a weasyprint document
+        """
+        documents = list(self._iter_documents(stylesheet, progress_callback))
+        if len(documents) == 1:
+            return documents[0]
+
+        return documents[0].copy(
+            [page for document in documents for page in document.pages])
+
+    def save(self, progress_callback=None):
+        if self.n_rows <= self.chunk_size:
+            document = self.render(stylesheet='',
+                                   progress_callback=progress_callback)
+            document.write_pdf(self.filename)
+            return
+
+        import cairocffi
+
+        # Paint the pages of each chunk on the pdf as soon as it is laid
+        # out, so only one chunk needs to be kept in memory at a time
+        surface = cairocffi.PDFSurface(self.filename, 1, 1)
+        context = cairocffi.Context(surface)
+        for document in self._iter_documents('', progress_callback):
+            for page in document.pages:
+                # 0.75 is here because its also in weasyprint write_pdf()
+                surface.set_size(page.width * 0.75, page.height * 0.75)
+                page.paint(context, scale=0.75)
+                surface.show_page()
+        surface.finish()
+
+    def _iter_documents(self, stylesheet, progress_callback):
+        if self.n_rows <= self.chunk_size:
+            yield HTMLReport.render(self, stylesheet=stylesheet)
+            if progress_callback is not None:
+                progress_callback(self.n_rows, self.n_rows)
+            return
+
+        n_chunks = (self.n_rows + self.chunk_size - 1) // self.chunk_size
+        rendered_rows = 0
+        self.reset()
+        try:
+            for i, (chunk, is_last) in enumerate(self._iter_chunks()):
+                self._chunk = chunk
+                self.is_first_chunk = i == 0
+                self.is_last_chunk = is_last
+                self.part_label = _("Part %d of %d") % (i + 1, n_chunks)
+                document = self._render_html(self.get_html(), stylesheet)
+
+                rendered_rows += len(chunk)
+                log.debug('Rendered %d of %d rows of %s' % (
+                    rendered_rows, self.n_rows, self.title))
+                if progress_callback is not None:
+                    progress_callback(rendered_rows, self.n_rows)
+                yield document
+        finally:
+            self._chunk = None
+            self.part_label = None
+            self.is_first_chunk = self.is_last_chunk = True
+
     def accumulate(self, row):
         """This method is called once for each row in the report.
 
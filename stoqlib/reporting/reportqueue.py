@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+##
+
+"""Render reports in the background, on a pool of worker processes
+
+Reports are submitted to a :class:`ReportQueue` with the same arguments
+they would receive when created, but instead of the objects themselves
+only references to them (their classes and ids) are sent to the workers.
+Each worker has its own connection to the database, fetches the objects
+on a new store, renders the report to a pdf file and returns its path.
+
+Domain objects, viewables and result sets of them can be used as
+arguments, even inside lists, tuples and dicts, as long as they don't
+have uncommitted changes, that the workers wouldn't see. Anything else
+must be picklable, so for instance an objectlist cannot be sent to the
+workers. :meth:`ReportQueue.submit` raises :class:`ReportArgumentError`
+for those, and the report should be rendered on the calling process.
+"""
+
+import atexit
+import collections
+from concurrent import futures
+import itertools
+import locale
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import threading
+
+from kiwi.component import get_utility, provide_utility
+from storm.expr import In
+from storm.store import Store
+
+from stoqlib.database.interfaces import (ICurrentBranch,
+                                         ICurrentBranchStation, ICurrentUser)
+from stoqlib.database.runtime import (StoqlibResultSet, get_current_station,
+                                      get_default_store, new_store)
+from stoqlib.database.settings import db_settings
+from stoqlib.database.viewable import Viewable
+from stoqlib.domain.base import Domain
+from stoqlib.lib.environment import configure_locale
+from stoqlib.reporting.report import TableReport
+
+log = logging.getLogger(__name__)
+
+#: The number of objects fetched at a time when resolving result sets
+BATCH_SIZE = 1000
+
+_ObjectReference = collections.namedtuple('_ObjectReference', ['cls', 'id'])
+_ResultSetReference = collections.namedtuple('_ResultSetReference',
+                                             ['cls', 'ids'])
+# A viewable class created by find_by_branch for a branch
+_BranchViewableReference = collections.namedtuple(
+    '_BranchViewableReference', ['viewable', 'branch_id'])
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class ReportCancelled(Exception):
+    """Raised on the worker when the job being rendered was cancelled"""
+
+
+class ReportArgumentError(Exception):
+    """Raised when the arguments of a report cannot be sent to the workers"""
+
+
+#
+#  References
+#
+
+def _check_committed(store):
+    if store is not None and store.get_pending_count():
+        raise ReportArgumentError("Objects with uncommitted changes cannot "
+                                  "be sent to the report workers")
+
+
+def _get_class_reference(cls):
+    module = sys.modules.get(cls.__module__)
+    if getattr(module, cls.__qualname__, None) is cls:
+        return cls
+
+    # The class was created on the fly, so it can't be pickled. The
+    # viewables created by find_by_branch can be created again by the worker
+    branch_id = getattr(cls, '_branch_id', None)
+    for base in cls.__bases__:
+        if getattr(base, 'highjacked', {}).get(branch_id) is cls:
+            return _BranchViewableReference(_get_class_reference(base),
+                                            branch_id)
+    raise ReportArgumentError("%s cannot be sent to the report workers" % (
+        cls.__name__, ))
+
+
+def _get_reference(value):
+    if isinstance(value, Domain):
+        _check_committed(Store.of(value))
+        return _ObjectReference(_get_class_reference(type(value)), value.id)
+    elif isinstance(value, Viewable):
+        _check_committed(value.store)
+        return _ObjectReference(_get_class_reference(type(value)), value.id)
+    elif isinstance(value, StoqlibResultSet):
+        _check_committed(value._store)
+        first = value.any()
+        if first is None:
+            return []
+        if isinstance(first, tuple):
+            raise ReportArgumentError("Result sets of tuples cannot be sent "
+                                      "to the report workers")
+        # The ids are fetched without building all the objects
+        return _ResultSetReference(
+            _get_class_reference(type(first)),
+            [obj.id for obj in value.fast_iter(batch_size=BATCH_SIZE)])
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_get_reference(v) for v in value)
+    elif isinstance(value, dict):
+        return dict((k, _get_reference(v)) for k, v in value.items())
+    return value
+
+
+def _get_objects(store, cls, ids):
+    objects = {}
+    ids_iter = iter(ids)
+    while True:
+        batch = list(itertools.islice(ids_iter, BATCH_SIZE))
+        if not batch:
+            break
+        for obj in store.find(cls, In(cls.id, batch)):
+            objects[obj.id] = obj
+    # Keep the order of the original result set
+    return [objects[id_] for id_ in ids if id_ in objects]
+
+
+def _resolve_class(store, cls):
+    if isinstance(cls, _BranchViewableReference):
+        from stoqlib.domain.person import Branch
+        viewable = _resolve_class(store, cls.viewable)
+        # This creates the class for the branch, if it wasn't yet
+        viewable.find_by_branch(store, store.get(Branch, cls.branch_id))
+        return viewable.highjacked[cls.branch_id]
+    return cls
+
+
+def _resolve_reference(store, value):
+    if isinstance(value, _ObjectReference):
+        cls = _resolve_class(store, value.cls)
+        return store.find(cls, cls.id == value.id).one()
+    elif isinstance(value, _ResultSetReference):
+        return _get_objects(store, _resolve_class(store, value.cls),
+                            value.ids)
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_resolve_reference(store, v) for v in value)
+    elif isinstance(value, dict):
+        return dict((k, _resolve_reference(store, v))
+                    for k, v in value.items())
+    return value
+
+
+#
+#  Workers
+#
+
+def _init_worker(settings, station_id, user_id, lang):
+    # This runs once on each worker process, which is a new interpreter
+    # and needs to connect to the database and setup the locale and the
+    # utilities of the application that submitted the reports
+    from stoqlib.domain.person import LoginUser
+    from stoqlib.domain.station import BranchStation
+    from stoqlib.lib.kiwilibrary import library
+    library  # pylint: disable=W0104
+
+    # Otherwise the prices and dates would be formatted in the C locale
+    try:
+        configure_locale(lang)
+    except locale.Error as err:
+        log.warning('Could not set the locale of the worker to %s: %s' % (
+            lang, err))
+
+    for attr, value in settings.items():
+        setattr(db_settings, attr, value)
+
+    store = get_default_store()
+    if station_id is not None:
+        station = store.get(BranchStation, station_id)
+        provide_utility(ICurrentBranchStation, station, replace=True)
+        if station.branch:
+            provide_utility(ICurrentBranch, station.branch, replace=True)
+    if user_id is not None:
+        provide_utility(ICurrentUser, store.get(LoginUser, user_id),
+                        replace=True)
+
+
+def _render_report(job_id, report_class, args, kwargs, progress, cancelled):
+    # This runs on the worker processes
+    def check_cancelled():
+        if job_id in cancelled:
+            raise ReportCancelled(job_id)
+
+    check_cancelled()
+    progress.put((job_id, 0, None))
+
+    def progress_callback(rendered_rows, total_rows):
+        check_cancelled()
+        progress.put((job_id, rendered_rows, total_rows))
+
+    fd, filename = tempfile.mkstemp(suffix='.pdf',
+                                    prefix='stoqlib-reporting')
+    os.close(fd)
+    store = new_store()
+    try:
+        report = report_class(filename,
+                              *_resolve_reference(store, args),
+                              **_resolve_reference(store, kwargs))
+        if isinstance(report, TableReport):
+            report.save(progress_callback=progress_callback)
+        else:
+            report.save()
+            progress_callback(1, 1)
+    except BaseException:
+        os.unlink(filename)
+        raise
+    finally:
+        store.rollback(close=True)
+
+    return filename
+
+
+#
+#  Jobs
+#
+
+class ReportJob(object):
+    """A report submitted to a :class:`ReportQueue`"""
+
+    STATUS_PENDING = u'pending'
+    STATUS_RUNNING = u'running'
+    STATUS_DONE = u'done'
+    STATUS_FAILED = u'failed'
+    STATUS_CANCELLED = u'cancelled'
+
+    def __init__(self, queue, job_id, report_class):
+        self._queue = queue
+        self.id = job_id
+        self.report_class = report_class
+        self.status = self.STATUS_PENDING
+
+        #: The number of rows already rendered, for table reports
+        self.rendered_rows = 0
+        #: The total number of rows, ``None`` until the job is running
+        self.total_rows = None
+        #: The path of the pdf, after the job is done. The file belongs
+        #: to the caller, that should remove it when it's not needed anymore
+        self.filename = None
+        #: The exception raised while rendering, if the job failed
+        self.error = None
+
+    def __repr__(self):
+        return '<ReportJob %d %s %s>' % (
+            self.id, self.report_class.__name__, self.status)
+
+    #
+    #  Public API
+    #
+
+    def get_progress(self):
+        """Gets how much of the report was rendered
+
+        :returns: a number between 0 and 1
+        """
+        if self.status == self.STATUS_DONE:
+            return 1.0
+        if not self.total_rows:
+            return 0.0
+        return min(self.rendered_rows / self.total_rows, 1.0)
+
+    def is_finished(self):
+        return self.status in [self.STATUS_DONE, self.STATUS_FAILED,
+                               self.STATUS_CANCELLED]
+
+    def cancel(self):
+        """Cancels the job
+
+        A pending job will never start, a running one will stop when the
+        next chunk of the report is rendered.
+        """
+        self._queue.cancel(self)
+
+
+class ReportQueue(object):
+    """A queue of reports rendered by a pool of worker processes
+
+    The workers are only started when the first report is submitted.
+
+    :param workers: the number of processes to use, defaults to the
+      number of cpus
+    :param callback: if not ``None``, will be called as ``callback(job)``
+      each time a :class:`ReportJob` makes progress or its status changes.
+      Note that it is called from a thread, so GUI code should use
+      :func:`stoqlib.lib.threadutils.schedule_in_main_thread`
+    """
+
+    def __init__(self, workers=None, callback=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.callback = callback
+        self._jobs = collections.OrderedDict()
+        self._futures = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+        self._cancelled = None
+        self._progress_thread = None
+
+    #
+    #  Public API
+    #
+
+    def submit(self, report_class, *args, **kwargs):
+        """Submits a report to be rendered
+
+        :param report_class: the report class, that will be created with
+          a filename and *args* and *kwargs*
+        :returns: a :class:`ReportJob`
+        :raises: :class:`ReportArgumentError` if the arguments cannot be
+          sent to the workers
+        """
+        args = _get_reference(args)
+        kwargs = _get_reference(kwargs)
+        # Fail now, instead of on the thread sending the job to the workers
+        try:
+            pickle.dumps((report_class, args, kwargs))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise ReportArgumentError(str(e))
+
+        with self._lock:
+            self._start()
+            job = ReportJob(self, next(self._job_ids), report_class)
+            future = self._executor.submit(
+                _render_report, job.id, report_class, args, kwargs,
+                self._progress, self._cancelled)
+            self._jobs[job.id] = job
+            self._futures[job.id] = future
+        future.add_done_callback(
+            lambda future: self._on_future_done(job, future))
+        return job
+
+    def cancel(self, job):
+        """Cancels a job, see :meth:`ReportJob.cancel`"""
+        with self._lock:
+            if job.is_finished():
+                return
+            future = self._futures[job.id]
+            if not future.cancel():
+                self._cancelled[job.id] = True
+
+    def get_jobs(self):
+        """Gets all the jobs submitted to the queue
+
+        :returns: a list of :class:`ReportJob`, in the order they were
+          submitted
+        """
+        return list(self._jobs.values())
+
+    def clear_finished(self):
+        """Forgets about the jobs that are finished"""
+        with self._lock:
+            for job in self.get_jobs():
+                if job.is_finished():
+                    del self._jobs[job.id]
+                    del self._futures[job.id]
+                    self._cancelled.pop(job.id, None)
+
+    def shutdown(self, cancel=False):
+        """Stops the workers, waiting for the jobs to finish
+
+        :param cancel: if the unfinished jobs should be cancelled
+        """
+        if cancel:
+            for job in self.get_jobs():
+                self.cancel(job)
+
+        with self._lock:
+            if self._executor is None:
+                return
+            self._executor.shutdown(wait=True)
+            self._progress.put(None)
+            self._progress_thread.join()
+            self._manager.shutdown()
+            self._executor = None
+
+    #
+    #  Private
+    #
+
+    def _start(self):
+        if self._executor is not None:
+            return
+
+        # The workers are spawned instead of forked, since they must not
+        # share the database connections of this process
+        context = multiprocessing.get_context('spawn')
+        self._manager = context.Manager()
+        self._progress = self._manager.Queue()
+        self._cancelled = self._manager.dict()
+
+        settings = dict(rdbms=db_settings.rdbms,
+                        address=db_settings.address,
+                        port=db_settings.port,
+                        dbname=db_settings.dbname,
+                        username=db_settings.username,
+                        password=db_settings.password)
+        station = get_current_station()
+        user = get_utility(ICurrentUser, None)
+        # The locale the application configured on startup
+        lang = locale.getlocale()[0]
+        self._executor = futures.ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=_init_worker,
+            initargs=(settings, station and station.id, user and user.id,
+                      lang))
+
+        self._progress_thread = threading.Thread(target=self._read_progress,
+                                                 name='ReportQueueProgress')
+        self._progress_thread.daemon = True
+        self._progress_thread.start()
+
+    def _read_progress(self):
+        while True:
+            item = self._progress.get()
+            if item is None:
+                break
+
+            job_id, rendered_rows, total_rows = item
+            job = self._jobs.get(job_id)
+            if job is None or job.is_finished():
+                continue
+            job.status = ReportJob.STATUS_RUNNING
+            job.rendered_rows = rendered_rows
+            if total_rows is not None:
+                job.total_rows = total_rows
+            self._notify(job)
+
+    def _notify(self, job):
+        if self.callback is None:
+            return
+        try:
+            self.callback(job)
+        except Exception:
+            log.exception("Error notifying about %r", job)
+
+    #
+    #  Callbacks
+    #
+
+    def _on_future_done(self, job, future):
+        if future.cancelled():
+            job.status = ReportJob.STATUS_CANCELLED
+        elif isinstance(future.exception(), ReportCancelled):
+            job.status = ReportJob.STATUS_CANCELLED
+        elif future.exception() is not None:
+            job.error = future.exception()
+            job.status = ReportJob.STATUS_FAILED
+            log.warning("Could not render %r: %s", job, job.error)
+        elif job.id in self._cancelled:
+            # It was cancelled after the last chunk was rendered
+            os.unlink(future.result())
+            job.status = ReportJob.STATUS_CANCELLED
+        else:
+            job.filename = future.result()
+            job.status = ReportJob.STATUS_DONE
+        self._notify(job)
+
+
+def get_report_queue():
+    """Gets the report queue shared by the application
+
+    :returns: a :class:`ReportQueue`
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ReportQueue()
+            # Don't keep the application alive rendering reports
+            atexit.register(_queue.shutdown, cancel=True)
+        return _queue
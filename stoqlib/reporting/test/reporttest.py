@@ -27,6 +27,7 @@ import os
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.lib.diffutils import diff_files
 from stoqlib.lib.unittestutils import get_tests_datadir
+from stoqlib.reporting.utils import clear_cache
 
 
 class ReportTest(DomainTest):
@@ -37,6 +38,8 @@ class ReportTest(DomainTest):
         output = os.path.join(basedir, '%s-tmp.html' % expected_name)
 
         def save_report(filename, *args, **kwargs):
+            # The header may have been cached by other tests
+            clear_cache()
             report = report_class(filename, *args, **kwargs)
             report.adjust_for_test()
             report.save_html(filename)
@@ -60,6 +60,7 @@ from stoqlib.reporting.payment import (BillCheckPaymentReport,
 from stoqlib.reporting.product import ProductReport, ProductPriceReport
 from stoqlib.reporting.production import ProductionOrderReport
 from stoqlib.reporting.purchase import PurchaseQuoteReport
+from stoqlib.reporting.report import TableReport
 from stoqlib.reporting.service import ServicePriceReport
 from stoqlib.reporting.sale import (SaleOrderReport, SalesPersonReport,
                                     SoldItemsByBranchReport)
@@ -656,3 +657,109 @@ class TestReport(ReportTest):
 
         self._diff_expected(WorkOrdersReport, 'workorders-report',
                             search.results, list(search.results))
+
+
+class _NumbersReport(TableReport):
+    title = 'Numbers'
+    chunk_size = 3
+
+    def get_columns(self):
+        return [dict(title='Number', align='right')]
+
+    def get_row(self, obj):
+        return [str(obj)]
+
+    def reset(self):
+        self.total = 0
+
+    def accumulate(self, row):
+        self.total += row
+
+    def get_summary_row(self):
+        return ['Total: %d' % self.total]
+
+
+class TestTableReport(ReportTest):
+    def _render(self, data):
+        report = _NumbersReport('foo.pdf', data)
+        chunks = []
+        self.documents = []
+
+        def render_html(html, stylesheet):
+            chunks.append(html)
+            document = mock.Mock()
+            document.pages = ['page %d' % len(chunks)]
+            self.documents.append(document)
+            return document
+
+        progress = mock.Mock()
+        with mock.patch.object(report, '_render_html', render_html):
+            document = report.render(progress_callback=progress)
+        return document, chunks, progress
+
+    def test_render(self):
+        document, chunks, progress = self._render([1, 2, 3])
+        self.assertIs(document, self.documents[0])
+        self.assertEqual(len(chunks), 1)
+        self.assertIn('Total: 6', chunks[0])
+        self.assertNotIn('Part 1', chunks[0])
+        progress.assert_called_once_with(3, 3)
+
+    def test_render_chunks(self):
+        document, chunks, progress = self._render(list(range(1, 8)))
+        self.assertEqual(len(chunks), 3)
+
+        # The header only in the first chunk and the summary, that
+        # accumulates the rows of all chunks, only in the last one
+        self.assertIn('<h1>Numbers</h1>', chunks[0])
+        self.assertNotIn('<h1>Numbers</h1>', chunks[1])
+        self.assertNotIn('Total:', chunks[0])
+        self.assertNotIn('Total:', chunks[1])
+        self.assertIn('Total: 28', chunks[2])
+        self.assertIn('<td>7</td>', chunks[2])
+        self.assertNotIn('<td>4</td>', chunks[2])
+        self.assertIn('Part 2 of 3', chunks[1])
+
+        self.assertEqual(progress.call_args_list,
+                         [mock.call(3, 7), mock.call(6, 7), mock.call(7, 7)])
+        self.documents[0].copy.assert_called_once_with(
+            ['page 1', 'page 2', 'page 3'])
+        self.assertIs(document, self.documents[0].copy.return_value)
+
+    def test_render_chunks_result_set(self):
+        data = mock.Mock()
+        data.count.return_value = 7
+        data.iter_pages.return_value = iter(range(1, 8))
+        document, chunks, progress = self._render(data)
+        self.assertEqual(len(chunks), 3)
+        self.assertIn('Total: 28', chunks[2])
+        # The rows are fetched a chunk at a time
+        data.iter_pages.assert_called_once_with(3)
+
+    def test_save_chunks(self):
+        report = _NumbersReport('foo.pdf', list(range(1, 8)))
+        events = []
+
+        def render_html(html, stylesheet):
+            n_chunk = len([e for e in events if e[0] == 'render']) + 1
+            events.append(('render', n_chunk))
+            page = mock.Mock(width=100, height=200)
+            page.paint.side_effect = lambda *args, **kwargs: events.append(
+                ('paint', n_chunk))
+            return mock.Mock(pages=[page])
+
+        with mock.patch.object(report, '_render_html', render_html), \
+                mock.patch('cairocffi.PDFSurface') as PDFSurface, \
+                mock.patch('cairocffi.Context'):
+            report.save()
+
+        # The pages of each chunk are painted before the next one is laid out
+        self.assertEqual(events, [('render', 1), ('paint', 1),
+                                  ('render', 2), ('paint', 2),
+                                  ('render', 3), ('paint', 3)])
+        PDFSurface.assert_called_once_with('foo.pdf', 1, 1)
+        surface = PDFSurface.return_value
+        self.assertEqual(surface.set_size.call_args_list,
+                         [mock.call(75, 150)] * 3)
+        self.assertEqual(surface.show_page.call_count, 3)
+        surface.finish.assert_called_once_with()
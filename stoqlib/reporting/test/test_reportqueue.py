@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2019 Stoq Tecnologia <https://stoq.com.br/>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+from concurrent import futures
+from decimal import Decimal
+import pickle
+import queue
+import threading
+
+import mock
+
+from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.domain.views import ProductFullStockView
+from stoqlib.lib.formatters import get_formatted_price
+from stoqlib.reporting.product import ProductReport
+from stoqlib.reporting.report import TableReport
+from stoqlib.reporting.reportqueue import (ReportArgumentError,
+                                           ReportCancelled, ReportJob,
+                                           ReportQueue, _get_reference,
+                                           _resolve_reference)
+
+
+def _get_committed_reference(store, value):
+    # The tests never commit, so pretend the objects were committed
+    with mock.patch.object(store, 'get_pending_count', return_value=0):
+        return _get_reference(value)
+
+
+class TestReferences(DomainTest):
+    def test_references(self):
+        client = self.create_client()
+        sellables = []
+        for i in range(3):
+            sellables.append(self.create_sellable(description=u'Foo %d' % i))
+        results = self.store.find(Sellable, Sellable.description.startswith(
+            u'Foo ')).order_by(Sellable.description)
+
+        reference = _get_committed_reference(
+            self.store, (client, [client], {'results': results}, 'bar', 10))
+        reference = pickle.loads(pickle.dumps(reference))
+        resolved = _resolve_reference(self.store, reference)
+        self.assertEqual(resolved, (client, [client], {'results': sellables},
+                                    'bar', 10))
+
+    def test_references_viewable(self):
+        self.create_product(description=u'Foo')
+        results = self.store.find(ProductFullStockView,
+                                  ProductFullStockView.description == u'Foo')
+        view = results.one()
+
+        reference = _get_committed_reference(self.store, [view, results])
+        resolved = _resolve_reference(self.store, reference)
+        self.assertEqual([v.id for v in resolved[1]], [view.id])
+        self.assertEqual(resolved[0].id, view.id)
+        self.assertIsInstance(resolved[0], ProductFullStockView)
+
+    def test_references_empty(self):
+        results = self.store.find(Sellable, description=u'Does not exist')
+        self.assertEqual(_get_committed_reference(self.store, results), [])
+
+    def test_references_branch_viewable(self):
+        branch = self.create_branch()
+        self.create_product(description=u'Foo')
+        results = ProductFullStockView.find_by_branch(self.store, branch).find(
+            ProductFullStockView.description == u'Foo')
+        view = results.one()
+
+        reference = _get_committed_reference(self.store, [view, results])
+        reference = pickle.loads(pickle.dumps(reference))
+        # Make sure the worker creates the class again
+        del ProductFullStockView.highjacked[branch.id]
+        resolved = _resolve_reference(self.store, reference)
+        self.assertEqual(resolved[0].id, view.id)
+        self.assertEqual(type(resolved[0]).__name__, type(view).__name__)
+        self.assertIs(type(resolved[0]),
+                      ProductFullStockView.highjacked[branch.id])
+        self.assertEqual([v.id for v in resolved[1]], [view.id])
+
+    def test_references_uncommitted(self):
+        client = self.create_client()
+        # The workers would not see the uncommitted client
+        self.assertTrue(self.store.get_pending_count())
+        with self.assertRaises(ReportArgumentError):
+            _get_reference(client)
+
+
+class _Manager(object):
+    Queue = queue.Queue
+    dict = dict
+
+    def shutdown(self):
+        pass
+
+
+class TestReportQueue(DomainTest):
+    def setUp(self):
+        super(TestReportQueue, self).setUp()
+        self.jobs = []
+        self.queue = ReportQueue(workers=1, callback=self.jobs.append)
+
+        context = mock.Mock()
+        context.Manager.return_value = _Manager()
+
+        def create_executor(workers, mp_context, initializer, initargs):
+            return futures.ThreadPoolExecutor(workers)
+
+        for target, kwargs in [
+                ('multiprocessing.get_context', dict(return_value=context)),
+                ('futures.ProcessPoolExecutor', dict(new=create_executor))]:
+            patcher = mock.patch('stoqlib.reporting.reportqueue.' + target,
+                                 **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _submit(self, render_report, *args):
+        with mock.patch('stoqlib.reporting.reportqueue._render_report',
+                        new=render_report):
+            with mock.patch.object(self.store, 'get_pending_count',
+                                   return_value=0):
+                return self.queue.submit(ProductReport, *args)
+
+    def test_submit(self):
+        sellable = self.create_sellable()
+
+        def render_report(job_id, report_class, args, kwargs, progress,
+                          cancelled):
+            self.assertEqual(report_class, ProductReport)
+            self.assertEqual(
+                args, (_get_committed_reference(self.store, sellable), 'foo'))
+            progress.put((job_id, 0, None))
+            progress.put((job_id, 5, 10))
+            return '/tmp/report.pdf'
+
+        job = self._submit(render_report, sellable, 'foo')
+        self.queue.shutdown()
+
+        self.assertEqual(job.status, ReportJob.STATUS_DONE)
+        self.assertEqual(job.filename, '/tmp/report.pdf')
+        self.assertEqual(job.get_progress(), 1)
+        self.assertEqual(self.queue.get_jobs(), [job])
+        self.assertIn(job, self.jobs)
+
+        self.queue.clear_finished()
+        self.assertEqual(self.queue.get_jobs(), [])
+
+    def test_submit_unpicklable(self):
+        with self.assertRaises(ReportArgumentError):
+            self.queue.submit(ProductReport, threading.Lock())
+        self.assertEqual(self.queue.get_jobs(), [])
+
+    def test_submit_error(self):
+        def render_report(job_id, report_class, args, kwargs, progress,
+                          cancelled):
+            raise ValueError('foo')
+
+        job = self._submit(render_report)
+        self.queue.shutdown()
+
+        self.assertEqual(job.status, ReportJob.STATUS_FAILED)
+        self.assertIsInstance(job.error, ValueError)
+        self.assertIsNone(job.filename)
+
+    def test_cancel(self):
+        started = threading.Event()
+        cancel = threading.Event()
+
+        def render_report(job_id, report_class, args, kwargs, progress,
+                          cancelled):
+            started.set()
+            cancel.wait()
+            if job_id in cancelled:
+                raise ReportCancelled(job_id)
+            return '/tmp/report.pdf'
+
+        running = self._submit(render_report)
+        started.wait()
+        # There's only one worker, so this one will never start
+        pending = self._submit(render_report)
+
+        pending.cancel()
+        running.cancel()
+        cancel.set()
+        self.queue.shutdown()
+
+        self.assertEqual(running.status, ReportJob.STATUS_CANCELLED)
+        self.assertEqual(pending.status, ReportJob.STATUS_CANCELLED)
+
+    def test_get_progress(self):
+        job = ReportJob(self.queue, 1, ProductReport)
+        self.assertEqual(job.get_progress(), 0)
+        job.rendered_rows = 5
+        job.total_rows = 20
+        self.assertEqual(job.get_progress(), 0.25)
+
+
+class _PricesReport(TableReport):
+    title = 'Prices'
+
+    def get_columns(self):
+        return [dict(title='Price', align='right')]
+
+    def get_row(self, obj):
+        return [get_formatted_price(obj)]
+
+
+def _get_report_html(report_class, data):
+    # This also runs on the worker process
+    return report_class('prices.pdf', data).get_html()
+
+
+class TestReportQueueWorker(DomainTest):
+    def test_locale(self):
+        data = [Decimal('1234.5'), Decimal('10')]
+        html = _get_report_html(_PricesReport, data)
+        self.assertIn(get_formatted_price(Decimal('1234.5')), html)
+
+        # A real worker, that is spawned without the locale of this process
+        queue = ReportQueue(workers=1)
+        queue._start()
+        try:
+            worker_html = queue._executor.submit(
+                _get_report_html, _PricesReport, data).result()
+        finally:
+            queue.shutdown()
+        self.assertEqual(worker_html, html)
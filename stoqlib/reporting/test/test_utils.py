@@ -28,13 +28,18 @@ from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.lib.formatters import format_phone_number
 from stoqlib.lib.parameters import sysparam
 from stoqlib.lib.translation import stoqlib_gettext
-from stoqlib.reporting.utils import get_logo_data, get_header_data
+from stoqlib.reporting.utils import (clear_cache, get_logo_data,
+                                     get_header_data)
 from stoqlib.database.runtime import get_current_branch
 
 _ = stoqlib_gettext
 
 
 class TestUtils(DomainTest):
+    def setUp(self):
+        super(TestUtils, self).setUp()
+        clear_cache()
+
     def test_get_logo_data(self):
         image = self.create_image()
         image.image = b'foobar'
@@ -42,6 +47,24 @@ class TestUtils(DomainTest):
         data = get_logo_data(self.store)
         self.assertEqual(data, 'data:image/png;base64,Zm9vYmFy')
 
+    def test_get_logo_data_cache(self):
+        image = self.create_image()
+        image.image = b'foobar'
+        sysparam.set_object(self.store, 'CUSTOM_LOGO_FOR_REPORTS', image)
+        self.assertEqual(get_logo_data(self.store),
+                         'data:image/png;base64,Zm9vYmFy')
+
+        image.image = b'foo'
+        self.assertEqual(get_logo_data(self.store),
+                         'data:image/png;base64,Zm9vYmFy')
+
+        # Changing the parameter drops the cache
+        other_image = self.create_image()
+        other_image.image = b'bar'
+        sysparam.set_object(self.store, 'CUSTOM_LOGO_FOR_REPORTS', other_image)
+        self.assertEqual(get_logo_data(self.store),
+                         'data:image/png;base64,YmFy')
+
     def test_get_header_data(self):
         branch = get_current_branch(self.store)
         person = branch.person
@@ -64,3 +87,20 @@ class TestUtils(DomainTest):
         register = ' - '.join([_("CNPJ: %s") % company.cnpj,
                                _("State Registry: %s") % company.state_registry])
         self.assertEqual(data['lines'], [address, contact, register])
+
+    def test_get_header_data_cache(self):
+        with mock.patch('stoqlib.reporting.utils.get_default_store') as ds:
+            ds.return_value = self.store
+            with mock.patch('stoqlib.reporting.utils.time') as time:
+                time.monotonic.return_value = 100
+                data = get_header_data()
+
+                branch = get_current_branch(self.store)
+                branch.person.email = u'changed@bar'
+                self.assertIs(get_header_data(), data)
+
+                time.monotonic.return_value = 1000
+                new_data = get_header_data()
+
+        self.assertIsNot(new_data, data)
+        self.assertIn(u'changed@bar', new_data['lines'][1])
@@ -27,6 +27,7 @@
 import base64
 import logging
 import platform
+import time
 
 from kiwi.environ import environ
 
@@ -41,21 +42,60 @@ _system = platform.system()
 log = logging.getLogger(__name__)
 # a list of programs to be tried when a report needs be viewed
 
+#: Seconds the header data of a branch is kept on the cache, so that
+#: printing lots of reports at once doesn't need to query it every time
+HEADER_CACHE_TIMEOUT = 60
+
+# The logo and header data used by the reports, see _get_cache()
+_cache = {}
+
+
+def _get_cache():
+    # Everything is dropped when the logo parameter changes
+    logo_id = sysparam.get_object_id('CUSTOM_LOGO_FOR_REPORTS')
+    if 'logo_id' not in _cache or _cache['logo_id'] != logo_id:
+        _cache.clear()
+        _cache['logo_id'] = logo_id
+    return _cache
+
+
+def clear_cache():
+    """Clears the cached logo and header data of the reports"""
+    _cache.clear()
+
 
 def get_logo_data(store):
+    cache = _get_cache()
+    if 'logo_data' in cache:
+        return cache['logo_data']
+
     logo_domain = sysparam.get_object(store, 'CUSTOM_LOGO_FOR_REPORTS')
     if logo_domain and logo_domain.image:
         data = logo_domain.image
     else:
         data = environ.get_resource_string('stoq', 'pixmaps', 'stoq_logo_bgwhite.png')
 
-    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+    cache['logo_data'] = 'data:image/png;base64,' + base64.b64encode(data).decode()
+    return cache['logo_data']
 
 
 def get_header_data():
     default_store = get_default_store()
 
     branch = get_current_branch(default_store)
+    cache = _get_cache()
+    key = ('header_data', branch.id)
+    if key in cache:
+        timestamp, data = cache[key]
+        if time.monotonic() - timestamp < HEADER_CACHE_TIMEOUT:
+            return data
+
+    data = _get_header_data(branch)
+    cache[key] = time.monotonic(), data
+    return data
+
+
+def _get_header_data(branch):
     person = branch.person
     company = person.company
     main_address = person.get_main_address()
@@ -24,6 +24,7 @@
 
 from stoqlib.api import api
 from stoqlib.domain.person import Client, Individual
+from stoqlib.domain.sellable import SellableCategory
 from stoqlib.domain.test.domaintest import DomainTest
 
 
@@ -58,3 +59,16 @@ class APITest(DomainTest):
         items = api.for_combo(results,
                               empty=u'All')
         self.assertEqual(items, [('All', None), ('Client', client)])
+
+    def test_for_category_combo(self):
+        base = SellableCategory(description=u'Monitor', store=self.store)
+        lcd = SellableCategory(description=u'LCD', category=base,
+                               store=self.store)
+        items = api.for_category_combo(
+            self.store.find(SellableCategory,
+                            SellableCategory.id.is_in([base.id, lcd.id])),
+            empty=u'Any')
+        self.assertEqual(items, [(u'Any', None),
+                                 (u'Monitor', base),
+                                 (u'Monitor:LCD', lcd)])
+        self.assertEqual(api.for_category_combo([]), [])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure how the time to confirm a sale grows with its number of items
+
+This uses the same database as the test suite (configured by the
+STOQLIB_TEST_* environment variables) and nothing is committed.
+
+Usage: tools/benchmark-sale-confirm.py [N_ITEMS ...]
+"""
+
+import os
+import sys
+import time
+
+DEFAULT_SIZES = [10, 100, 1000]
+
+
+def _bootstrap():
+    from stoqlib.database.testsuite import bootstrap_suite
+    bootstrap_suite(address=os.environ.get('STOQLIB_TEST_HOSTNAME'),
+                    dbname=os.environ.get('STOQLIB_TEST_DBNAME'),
+                    port=int(os.environ.get('STOQLIB_TEST_PORT') or 0),
+                    username=os.environ.get('STOQLIB_TEST_USERNAME'),
+                    password=os.environ.get('STOQLIB_TEST_PASSWORD'),
+                    quick=True)
+
+
+def _benchmark(size):
+    from stoqlib.database.runtime import get_current_user, new_store
+    from stoqlib.database.testsuite import StoqlibTestsuiteTracer
+    from stoqlib.domain.exampledata import ExampleCreator
+
+    store = new_store()
+    creator = ExampleCreator()
+    creator.set_store(store)
+    user = creator.current_user = get_current_user(store)
+
+    sale = creator.create_sale()
+    for i in range(size):
+        creator.add_product(sale)
+    sale.order(user)
+    creator.add_payments(sale)
+    store.flush()
+
+    tracer = StoqlibTestsuiteTracer()
+    tracer.install()
+    start = time.perf_counter()
+    try:
+        sale.confirm(user)
+        store.flush()
+        elapsed = time.perf_counter() - start
+    finally:
+        tracer.remove()
+        store.rollback(close=True)
+
+    return elapsed, tracer.count
+
+
+def main(args):
+    sizes = [int(arg) for arg in args[1:]] or DEFAULT_SIZES
+    _bootstrap()
+
+    print('%8s %10s %10s %10s' % ('items', 'seconds', 'queries', 'ms/item'))
+    for size in sizes:
+        elapsed, queries = _benchmark(size)
+        print('%8d %10.3f %10d %10.2f' % (size, elapsed, queries,
+                                          elapsed * 1000 / size))
+
+
+if __name__ == '__main__':
+    main(sys.argv)